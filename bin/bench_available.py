@@ -0,0 +1,71 @@
+"""
+Time the availability computation behind tickets.available()
+
+No database is needed: the settings are those loaded by schema.sql,
+with made-up counts. "cold" compiles the rules on every call, which is
+roughly what available() used to do every time; "warm" evaluates rules
+compiled once, which is what it does while the settings are cached.
+"""
+
+from __future__ import unicode_literals, print_function, division
+
+import sys
+import os
+import timeit
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+from snowball_ticketing import tickets
+
+
+def row(quota, waiting_quota, smallquota, qpp, mode):
+    return {"quota": quota, "quota_met": None if quota is None else False,
+            "waiting_quota": waiting_quota,
+            "waiting_quota_met": None if waiting_quota is None else False,
+            "waiting_smallquota": smallquota, "quota_per_person": qpp,
+            "mode": mode}
+
+# as in schema.sql, but open
+settings = {
+    ("all", "any"):             row(850,  None, 25,   10,   "available"),
+    ("all", "vip"):             row(150,  None, None, None, "available"),
+    ("members", "any"):         row(600,  None, None, None, "available"),
+    ("alumni", "any"):          row(150,  None, None, None, "available"),
+    ("members", "standard"):    row(None, None, None, None, "available"),
+    ("members", "vip"):         row(None, None, None, None, "available"),
+    ("alumni", "standard"):     row(None, None, None, None, "available"),
+    ("alumni", "vip"):          row(None, None, None, None, "available"),
+}
+
+counts = dict(("{0}{1}_{2}".format(prefix, who, what), 40)
+              for prefix in ("", "waiting_")
+              for who in ("all", "members", "alumni")
+              for what in ("any", "standard", "vip"))
+
+def cold():
+    for ticket_type in ("standard", "vip"):
+        rules = tickets._compile_rules(settings, "members", ticket_type)
+        tickets._evaluate(rules, counts)
+
+compiled = dict((t, tickets._compile_rules(settings, "members", t))
+                for t in ("standard", "vip"))
+
+def warm():
+    for ticket_type in ("standard", "vip"):
+        tickets._evaluate(compiled[ticket_type], counts)
+
+def main(number=100000):
+    for name, function in (("cold", cold), ("warm", warm)):
+        best = min(timeit.repeat(function, number=number, repeat=3))
+        # two calls (standard, vip) per iteration, as in views.home
+        per_call = best / number / 2 * 1e6
+        print("{0:>5}: {1:6.2f} us per available()".format(name, per_call))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2:
+        main(int(sys.argv[1]))
+    elif len(sys.argv) == 1:
+        main()
+    else:
+        print("Usage:", sys.argv[0], "[iterations]")
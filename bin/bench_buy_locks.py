@@ -0,0 +1,126 @@
+"""
+Measure concurrent tickets.buy() throughput under each lock mode
+
+Run against a test database only: tickets_settings is temporarily modified
+(and restored afterwards), and a few users are created (and deleted).
+Every purchase is rolled back.
+
+Half the threads buy standard tickets as members, half VIP tickets as
+alumni. Each holds its transaction open for `hold` seconds after buying,
+much as a request does while it renders its response, so the locks
+are held for a realistic length of time. Unless "keep-all-quota" is
+given, the all/any quota is removed for the duration so that the two
+halves touch disjoint quotas.
+"""
+
+from __future__ import unicode_literals, print_function, division
+
+import sys
+import os
+import time
+import threading
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+import psycopg2
+
+from snowball_ticketing import utils, tickets
+
+
+def connect(postgres_settings):
+    return psycopg2.connect(connection_factory=utils.PostgreSQLConnection,
+                            **postgres_settings)
+
+def setup(conn, threads, keep_all_quota):
+    with conn.cursor(True) as cur:
+        cur.execute("SELECT * FROM tickets_settings")
+        saved = cur.fetchall()
+
+        cur.execute("UPDATE tickets_settings SET mode = 'available'")
+        if not keep_all_quota:
+            cur.execute("UPDATE tickets_settings "
+                        "SET quota = NULL, quota_met = NULL, "
+                        "    waiting_quota = NULL, waiting_quota_met = NULL, "
+                        "    waiting_smallquota = NULL "
+                        "WHERE who = 'all' AND what = 'any'")
+
+        users = []
+        for i in range(threads):
+            person_type = "alumnus" if i % 2 else "undergraduate"
+            email = "bench-buy-locks-{0}@example.com".format(i)
+            cur.execute("INSERT INTO users "
+                        "(user_type, person_type, email, password_bcrypt, "
+                        " enable_login) "
+                        "VALUES ('password', %s, %s, 'x', TRUE) "
+                        "RETURNING *", (person_type, email))
+            users.append(cur.fetchone())
+
+    conn.commit()
+    return saved, users
+
+def teardown(conn, saved, users):
+    columns = [k for k in saved[0] if k not in ("who", "what")]
+    sets = ', '.join("{0} = %({0})s".format(k) for k in columns)
+    query = "UPDATE tickets_settings SET " + sets + " " \
+            "WHERE who = %(who)s AND what = %(what)s"
+
+    with conn.cursor() as cur:
+        for row in saved:
+            cur.execute(query, row)
+        cur.execute("DELETE FROM users WHERE user_id IN %s",
+                    (tuple(u["user_id"] for u in users), ))
+
+    conn.commit()
+
+def worker(postgres_settings, user, lock_mode, hold, deadline, results):
+    conn = connect(postgres_settings)
+    ticket_type = "vip" if user["person_type"] == "alumnus" else "standard"
+    done = 0
+
+    while time.time() < deadline:
+        tickets.buy(ticket_type, False, 1, user=user,
+                    lock_mode=lock_mode, pg=conn)
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_sleep(%s)", (hold, ))
+        conn.rollback()
+        done += 1
+
+    conn.close()
+    results.append(done)
+
+def run(postgres_settings, users, lock_mode, hold, duration):
+    results = []
+    deadline = time.time() + duration
+    threads = [threading.Thread(target=worker,
+                                args=(postgres_settings, user, lock_mode,
+                                      hold, deadline, results))
+               for user in users]
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return sum(results) / duration
+
+def main(postgres_settings, threads=8, hold=0.02, duration=10,
+         keep_all_quota=False):
+    conn = connect(postgres_settings)
+    saved, users = setup(conn, threads, keep_all_quota)
+
+    try:
+        for lock_mode in tickets.buy_lock_modes:
+            rate = run(postgres_settings, users, lock_mode, hold, duration)
+            print("{0:>8}: {1:8.1f} purchases/s ({2} threads, {3}s hold)"
+                    .format(lock_mode, rate, threads, hold))
+    finally:
+        teardown(conn, saved, users)
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or \
+            (len(sys.argv) == 3 and sys.argv[2] != "keep-all-quota"):
+        print("Usage:", sys.argv[0], "test-database-name", "[keep-all-quota]")
+    else:
+        main({"database": sys.argv[1]},
+             keep_all_quota=len(sys.argv) == 3)
@@ -0,0 +1,107 @@
+"""
+Time the overhead of a log call made during a request
+
+No database is needed: records go to a handler that discards them, and the
+session is a stand-in for a loaded SessionInstance. "before" is
+LoggerAdaptor as it was, working out the request context on every call
+(even one that the level then discards); "after" is utils.LoggerAdaptor,
+which caches it on flask.g and checks the level first.
+"""
+
+from __future__ import unicode_literals, print_function, division
+
+import sys
+import os
+import timeit
+import logging
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+import flask
+import flask.sessions
+
+from snowball_ticketing import utils
+
+
+class Session(dict):
+    loaded = True
+    ok = True
+
+class SessionInterface(flask.sessions.SessionInterface):
+    def open_session(self, app, request):
+        return Session(session_id=1234, user_id=5678)
+
+    def save_session(self, app, session, response):
+        pass
+
+class OldLoggerAdaptor(logging.LoggerAdapter):
+    def __init__(self, logger):
+        super(OldLoggerAdaptor, self).__init__(logger, None)
+
+    def process(self, msg, kwargs):
+        add = {"request_path": None, "flask_endpoint": None,
+               "remote_addr": None, "session_id": None, "user_id": None}
+
+        if flask.has_request_context():
+            add["request_path"] = flask.request.path
+            add["flask_endpoint"] = flask.request.endpoint
+            add["remote_addr"] = flask.request.remote_addr
+            if getattr(flask.session, "loaded", False) and \
+                    flask.session.ok:
+                add["session_id"] = flask.session["session_id"]
+                add["user_id"] = flask.session["user_id"]
+
+        extra = kwargs.setdefault("extra", {})
+        for key in add:
+            if key not in extra:
+                extra[key] = add[key]
+
+        return msg, kwargs
+
+class DiscardHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+def make_app():
+    app = flask.Flask(__name__)
+    app.session_interface = SessionInterface()
+
+    @app.route("/buy", methods=["POST"])
+    def buy():
+        pass
+
+    return app
+
+def main(number=100000):
+    logger = logging.getLogger("snowball_ticketing.bench_log_calls")
+    logger.propagate = False
+    logger.addHandler(DiscardHandler())
+    logger.setLevel(logging.INFO)
+
+    app = make_app()
+    adaptors = (("before", OldLoggerAdaptor(logger)),
+                ("after", utils.LoggerAdaptor(logger)))
+
+    with app.test_request_context("/buy", method="POST"):
+        # as in a request: open the session, and route
+        app.preprocess_request()
+
+        for name, adaptor in adaptors:
+            calls = (("debug (discarded)",
+                      lambda: adaptor.debug("buying %s tickets", 2)),
+                     ("info (handled)",
+                      lambda: adaptor.info("bought %s tickets", 2)))
+
+            for call_name, call in calls:
+                best = min(timeit.repeat(call, number=number, repeat=3))
+                print("{0:>6} {1:<18}: {2:6.2f} us per call"
+                      .format(name, call_name, best / number * 1e6))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2:
+        main(int(sys.argv[1]))
+    elif len(sys.argv) == 1:
+        main()
+    else:
+        print("Usage:", sys.argv[0], "[iterations]")
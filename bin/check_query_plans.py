@@ -0,0 +1,265 @@
+"""
+Check the plans of the queries in queries/ against synthetic datasets
+
+Run against an empty test database only (psql test-db < schema.sql). For
+each of the mixes below, 50k tickets (and users to own them) are loaded
+and VACUUM ANALYZEd, every query is run with EXPLAIN (ANALYZE, BUFFERS),
+and everything is deleted again afterwards.
+
+A query fails if its plan sequentially scans the tickets table (unless
+it is listed under allow_seq_scan for that mix in
+queries/plan_budgets.yaml, with the reason it must read most of the table)
+or if its total cost exceeds the budget recorded there. "--record" rewrites
+the budgets from this run, with some headroom. The tickets indexes each
+plan uses are printed.
+"""
+
+from __future__ import unicode_literals, print_function, division
+
+import sys
+import os
+import re
+import json
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+import psycopg2
+import yaml
+
+from snowball_ticketing import utils, queries
+
+
+budgets_filename = os.path.join(root, "queries", "plan_budgets.yaml")
+budgets_header = """\
+# Used by bin/check_query_plans.py. Costs are the planner's total cost for
+# each query in queries/ against 50k synthetic tickets of each mix (see
+# the script), plus headroom; re-record with
+# "bin/check_query_plans.py test-db --record".
+"""
+headroom = 1.25
+
+email_prefix = "plan-check-"
+
+#: of every 20 tickets, how many are (unfinalised, expired, on the waiting
+#: list, finalised but unpaid); the rest are paid. "launch" is the first
+#: day of sales, when hardly anything has been paid for and many tickets
+#: are waiting to be finalised; "late" is towards the end of sales.
+mixes = (("launch", (5, 3, 1, 10)),
+         ("late", (1, 1, 1, 1)))
+
+_copy_re = re.compile(r"^\s*COPY\s*\((.*)\)\s*TO\s+STDOUT[^;]*;?\s*$",
+                      re.S | re.I)
+
+
+def connect(postgres_settings):
+    return psycopg2.connect(connection_factory=utils.PostgreSQLConnection,
+                            **postgres_settings)
+
+def check_empty(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM tickets")
+        if cur.fetchone()[0]:
+            raise ValueError("tickets is not empty: not a test database?")
+    conn.rollback()
+
+def load(conn, users, tickets, mix):
+    unfinalised, expired, waiting, unpaid = mix
+    finalised = unfinalised + expired
+    paid = finalised + waiting + unpaid
+
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO users "
+                    "(user_type, person_type, email, password_bcrypt, "
+                    " enable_login, surname, othernames) "
+                    "SELECT 'password', "
+                    "       CASE WHEN i %% 6 = 0 THEN 'alumnus' "
+                    "            ELSE 'undergraduate' END::person_type, "
+                    "       %s || i || '@example.com', 'x', TRUE, "
+                    "       'Surname' || i, 'Othernames' "
+                    "FROM generate_series(1, %s) AS i",
+                    (email_prefix, users))
+
+        # ticket i is of kind i % 20, numbered in the order of `mix`
+        cur.execute("INSERT INTO tickets "
+                    "(user_id, surname, othernames, person_type, vip, "
+                    " waiting_list, price, quota_exempt, created, "
+                    " finalised, paid, expires, expires_reason) "
+                    "SELECT u.ids[1 + (i * 7919) %% array_length(u.ids, 1)], "
+                    "       'Surname' || i, 'Othernames', 'non-cam', "
+                    "       i %% 7 = 0, "
+                    "       k >= %(finalised)s AND k < %(waiting)s, "
+                    "       6900, i %% 97 = 0, t, "
+                    "       CASE WHEN k >= %(finalised)s "
+                    "            THEN t + '5 minutes'::interval END, "
+                    "       CASE WHEN k >= %(paid)s "
+                    "            THEN t + '1 day'::interval END, "
+                    "       CASE WHEN k < %(unfinalised)s "
+                    "                THEN utcnow() + '10 minutes'::interval "
+                    "            WHEN k < %(finalised)s "
+                    "                THEN t + '10 minutes'::interval END, "
+                    "       CASE WHEN k < %(finalised)s "
+                    "            THEN 'not-finalised'::expires_reason END "
+                    "FROM (SELECT i, i %% 20 AS k, "
+                    "             utcnow() - '2 days'::interval "
+                    "                 + i * '1 second'::interval AS t "
+                    "      FROM generate_series(1, %(tickets)s) AS i) AS s, "
+                    "     (SELECT array_agg(user_id) AS ids FROM users "
+                    "      WHERE email LIKE %(like)s) AS u",
+                    {"unfinalised": unfinalised, "finalised": finalised,
+                     "waiting": finalised + waiting, "paid": paid,
+                     "tickets": tickets, "like": email_prefix + "%"})
+
+    conn.commit()
+
+    # VACUUM so that the visibility map permits index-only scans. A target
+    # this high makes ANALYZE read every row rather than a random sample,
+    # so that plans and costs are the same from one run to the next.
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("SET default_statistics_target = 1000")
+        for table in ("tickets", "users", "tickets_counts"):
+            cur.execute("VACUUM ANALYZE " + table)
+    conn.autocommit = False
+
+def unload(conn):
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM tickets")
+        cur.execute("DELETE FROM users WHERE email LIKE %s",
+                    (email_prefix + "%", ))
+    conn.commit()
+
+    # gives back the pages (a plain VACUUM may keep them), so that the next
+    # run starts from tables of the same size, and gets the same costs
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        # (tickets_counts, updated by a trigger for every ticket)
+        for table in ("tickets", "users", "tickets_counts"):
+            cur.execute("VACUUM FULL " + table)
+    conn.autocommit = False
+
+def plan_nodes(node):
+    yield node
+    for child in node.get("Plans", []):
+        for n in plan_nodes(child):
+            yield n
+
+def explain(conn, query):
+    m = _copy_re.match(query)
+    if m:
+        query = m.group(1)
+    query = query.strip().rstrip(";")
+
+    with conn.cursor() as cur:
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query)
+        result = cur.fetchone()[0]
+
+    # older psycopg2s do not parse json
+    if isinstance(result, basestring):
+        result = json.loads(result)
+
+    conn.rollback()
+    return result[0]
+
+def check(conn, mix_name, budgets):
+    allow_seq_scan = (budgets.get("allow_seq_scan") or {}).get(mix_name) or {}
+    costs = (budgets.get("costs") or {}).get(mix_name) or {}
+
+    measured = {}
+    failures = []
+
+    for name, query in sorted(queries.queries.items()):
+        result = explain(conn, query)
+        plan = result["Plan"]
+        cost = plan["Total Cost"]
+        measured[name] = cost
+
+        tickets_nodes = [n for n in plan_nodes(plan)
+                         if n.get("Relation Name") == "tickets"]
+        seq_scans = [n for n in tickets_nodes if n["Node Type"] == "Seq Scan"]
+        # a Bitmap Heap Scan's index is named by its Bitmap Index Scans
+        indexes = sorted(set(m["Index Name"] for n in tickets_nodes
+                             for m in plan_nodes(n) if "Index Name" in m))
+
+        print("{0:<28} cost {1:>10.1f}  time {2:>8.1f}ms  "
+              "buffers hit {3:>6} read {4:>6}"
+              .format(name, cost, result.get("Total Runtime",
+                                             result.get("Execution Time", 0)),
+                      plan.get("Shared Hit Blocks", 0),
+                      plan.get("Shared Read Blocks", 0)))
+        print("    tickets: {0}".format(
+            ", ".join(indexes + (["seq scan"] if seq_scans else []))))
+
+        if seq_scans and name not in allow_seq_scan:
+            failures.append("{0} ({1}): sequential scan of tickets"
+                            .format(name, mix_name))
+
+        budget = costs.get(name)
+        if budget is None:
+            print("    (no cost budget recorded)")
+        elif cost > budget:
+            failures.append("{0} ({1}): cost {2:.1f} exceeds budget {3:.1f}"
+                            .format(name, mix_name, cost, budget))
+
+    return measured, failures
+
+def record(budgets, measured):
+    allow_seq_scan = budgets.get("allow_seq_scan") or {}
+
+    with open(budgets_filename, "w") as f:
+        f.write(budgets_header)
+        f.write("\n# these must read most of the tickets table, in each mix: "
+                "query, why\n")
+        f.write("allow_seq_scan:\n")
+        for mix_name, mix in mixes:
+            f.write("    {0}:\n".format(mix_name))
+            reasons = allow_seq_scan.get(mix_name) or {}
+            for name, reason in sorted(reasons.items()):
+                f.write("        {0}: {1}\n".format(name, json.dumps(reason)))
+        f.write("\ncosts:\n")
+        for mix_name, mix in mixes:
+            f.write("    {0}:\n".format(mix_name))
+            for name, cost in sorted(measured[mix_name].items()):
+                f.write("        {0}: {1:.1f}\n"
+                        .format(name, cost * headroom))
+
+def main(postgres_settings, record_budgets=False, users=15000, tickets=50000):
+    with open(budgets_filename) as f:
+        budgets = yaml.safe_load(f)
+
+    conn = connect(postgres_settings)
+    check_empty(conn)
+
+    measured = {}
+    failures = []
+    for mix_name, mix in mixes:
+        print("{0} mix: {1} unfinalised, {2} expired, {3} waiting list, "
+              "{4} unpaid, {5} paid in every 20"
+                .format(mix_name, *(mix + (20 - sum(mix), ))))
+        try:
+            load(conn, users, tickets, mix)
+            measured[mix_name], mix_failures = \
+                    check(conn, mix_name, budgets)
+            failures += mix_failures
+        finally:
+            unload(conn)
+
+    if record_budgets:
+        record(budgets, measured)
+        print("recorded budgets in", budgets_filename)
+        return 0
+
+    for failure in failures:
+        print("FAIL:", failure)
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or \
+            (len(sys.argv) == 3 and sys.argv[2] != "--record"):
+        print("Usage:", sys.argv[0], "test-database-name", "[--record]")
+        sys.exit(2)
+    else:
+        sys.exit(main({"database": sys.argv[1]},
+                      record_budgets=len(sys.argv) == 3))
@@ -0,0 +1,177 @@
+"""
+Maintain the daily partitions of the log table
+
+Creates partitions for today and the next `ahead` days, and removes those
+older than `keep` days: "detach" leaves them as ordinary tables (named
+log_YYYYMMDD) for later inspection; "drop" drops them, after exporting
+each to export-directory/log_YYYYMMDD.csv.gz if a directory is given.
+
+Must run as the owner of the log table, ticketing-maint (see deploy/crontab
+and schema.sql), so that the partitions it creates are owned by that role
+too. Days are UTC, like log.created.
+"""
+
+from __future__ import unicode_literals, print_function
+
+import sys
+import os
+import re
+import gzip
+import logging
+from datetime import datetime, timedelta
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+import psycopg2
+
+from snowball_ticketing import utils, logging_setup
+
+
+logger = utils.getLogger("snowball_ticketing.bin.log_partitions")
+
+_partition_re = re.compile(r"^log_(\d{8})$")
+
+
+def partition_name(day):
+    return "log_" + day.strftime("%Y%m%d")
+
+def partitions(conn):
+    """Returns {day: name} for the daily partitions of log"""
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT c.relname FROM pg_inherits AS i "
+                    "JOIN pg_class AS c ON c.oid = i.inhrelid "
+                    "WHERE i.inhparent = 'log'::regclass")
+        names = [name for name, in cur]
+
+    days = {}
+    for name in names:
+        m = _partition_re.match(name)
+        if m:
+            days[datetime.strptime(m.group(1), "%Y%m%d").date()] = name
+    return days
+
+def create(conn, day):
+    """
+    Create the partition for `day`
+
+    Any rows for that day that landed in log_default are moved into it.
+    """
+
+    name = partition_name(day)
+    start, end = day, day + timedelta(days=1)
+
+    with conn.cursor() as cur:
+        # ATTACH rather than CREATE ... PARTITION OF, which would fail if
+        # log_default already held rows for the day
+        cur.execute("CREATE TABLE {0} "
+                    "(LIKE log INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                    .format(name))
+        cur.execute("WITH moved AS "
+                    "  (DELETE FROM log_default "
+                    "   WHERE created >= %s AND created < %s RETURNING *) "
+                    "INSERT INTO {0} SELECT * FROM moved".format(name),
+                    (start, end))
+        moved = cur.rowcount
+        cur.execute("ALTER TABLE log ATTACH PARTITION {0} "
+                    "FOR VALUES FROM (%s) TO (%s)".format(name),
+                    (start, end))
+    conn.commit()
+
+    if moved:
+        logger.warning("created %s, moving %s rows from log_default",
+                       name, moved)
+    else:
+        logger.info("created %s", name)
+
+def export(conn, name, directory):
+    """COPY partition `name` to directory/name.csv.gz"""
+
+    filename = os.path.join(directory, name + ".csv.gz")
+    temp_filename = filename + ".part"
+
+    f = gzip.open(temp_filename, "wb")
+    try:
+        with conn.cursor() as cur:
+            cur.copy_expert("COPY {0} TO STDOUT (FORMAT csv, HEADER)"
+                            .format(name), f)
+    finally:
+        f.close()
+    conn.rollback()
+
+    os.rename(temp_filename, filename)
+    logger.info("exported %s to %s", name, filename)
+
+def remove(conn, name, drop):
+    with conn.cursor() as cur:
+        cur.execute("ALTER TABLE log DETACH PARTITION {0}".format(name))
+        if drop:
+            cur.execute("DROP TABLE {0}".format(name))
+    conn.commit()
+
+    logger.info("%s %s", "dropped" if drop else "detached", name)
+
+def check_default(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM log_default")
+        count = cur.fetchone()[0]
+    conn.rollback()
+
+    if count:
+        logger.warning("log_default holds %s rows", count)
+
+def maintain(postgres_settings, ahead, keep, drop, export_directory=None):
+    # not utils.budget_connect: this runs as a different user, who cannot
+    # open the budget file
+    conn = psycopg2.connect(connection_factory=utils.PostgreSQLConnection,
+                            **postgres_settings)
+
+    try:
+        with conn.cursor() as cur:
+            # ATTACH and DETACH lock the log table, blocking inserts: rather
+            # than queue behind some long query, fail and retry tomorrow
+            cur.execute("SET lock_timeout = '5s'")
+        conn.commit()
+
+        today = datetime.utcnow().date()
+        existing = partitions(conn)
+        conn.rollback()
+
+        for i in range(ahead + 1):
+            day = today + timedelta(days=i)
+            if day not in existing:
+                create(conn, day)
+
+        oldest = today - timedelta(days=keep)
+        for day, name in sorted(existing.items()):
+            if day >= oldest:
+                continue
+            if drop and export_directory is not None:
+                export(conn, name, export_directory)
+            remove(conn, name, drop)
+
+        check_default(conn)
+    except Exception:
+        logger.exception("Unhandled log partitions exception")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5) or \
+            not sys.argv[1].isdigit() or not sys.argv[2].isdigit() or \
+            sys.argv[3] not in ("detach", "drop") or \
+            (len(sys.argv) == 5 and sys.argv[3] != "drop"):
+        print("Usage:", sys.argv[0], "ahead-days", "keep-days",
+              "detach|drop", "[export-directory]")
+        sys.exit(2)
+    else:
+        postgres = {"database": "ticketing"}
+
+        # not the PostgreSQL handler, for the same reason as above
+        logging_setup.add_syslog_handler(logging.INFO)
+        logging_setup.add_smtp_handler()
+
+        export_directory = sys.argv[4] if len(sys.argv) == 5 else None
+        maintain(postgres, int(sys.argv[1]), int(sys.argv[2]),
+                 sys.argv[3] == "drop", export_directory)
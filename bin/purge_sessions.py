@@ -0,0 +1,81 @@
+"""
+Delete destroyed and expired sessions, then VACUUM ANALYZE the table
+
+Must run as the owner of the sessions table, ticketing-maint (see
+deploy/crontab and schema.sql): the web role may not delete sessions, and
+VACUUM skips tables one does not own.
+"""
+
+from __future__ import unicode_literals, print_function, division
+
+import sys
+import os
+import logging
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+import psycopg2
+
+from snowball_ticketing import utils, logging_setup
+
+
+logger = utils.getLogger("snowball_ticketing.bin.purge_sessions")
+
+
+def report(conn, when):
+    stats = utils.sessions_table_stats(pg=conn)
+    conn.commit()
+
+    tuples = stats["live"] + stats["dead"]
+    bloat = stats["dead"] / tuples * 100 if tuples else 0
+
+    logger.info("sessions %s purge: %s rows, %s dead (%.0f%%), "
+                "table %s kB, total %s kB", when, stats["live"],
+                stats["dead"], bloat, stats["table_bytes"] // 1024,
+                stats["total_bytes"] // 1024)
+
+def purge(postgres_settings, batch_size=1000):
+    # not utils.budget_connect: this runs as a different user, who cannot
+    # open the budget file
+    conn = psycopg2.connect(connection_factory=utils.PostgreSQLConnection,
+                            **postgres_settings)
+
+    try:
+        report(conn, "before")
+
+        # one transaction per batch, so as not to hold row locks for long
+        purged = 0
+        while True:
+            n = utils.purge_sessions(batch_size=batch_size, pg=conn)
+            conn.commit()
+            purged += n
+            if n < batch_size:
+                break
+
+        logger.info("purged %s sessions", purged)
+
+        # makes the space reusable now rather than whenever autovacuum
+        # gets round to it
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("VACUUM ANALYZE sessions")
+        conn.autocommit = False
+
+        report(conn, "after")
+    except Exception:
+        logger.exception("Unhandled purge sessions exception")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) != 1:
+        print("Usage:", sys.argv[0])
+    else:
+        postgres = {"database": "ticketing"}
+
+        # not the PostgreSQL handler, for the same reason as above
+        logging_setup.add_syslog_handler()
+        logging_setup.add_smtp_handler()
+
+        purge(postgres)
@@ -0,0 +1,37 @@
+from __future__ import unicode_literals, print_function
+
+import sys
+import os
+import logging
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+from snowball_ticketing import utils, tickets, logging_setup
+
+
+def reap(postgres_settings, batch_size=500):
+    conn = utils.budget_connect(postgres_settings, "scripts")
+
+    try:
+        # one transaction per batch, so as not to hold the tickets_counts
+        # locks for long
+        while True:
+            reaped = tickets.reap_expired(batch_size=batch_size, pg=conn)
+            conn.commit()
+            if reaped < batch_size:
+                break
+    except Exception:
+        tickets.logger.exception("Unhandled reap exception")
+
+if __name__ == "__main__":
+    if len(sys.argv) != 1:
+        print("Usage:", sys.argv[0])
+    else:
+        postgres = {"database": "ticketing"}
+
+        logging_setup.add_postgresql_handler(postgres)
+        logging_setup.add_syslog_handler()
+        logging_setup.add_smtp_handler()
+
+        reap(postgres)
@@ -0,0 +1,86 @@
+"""
+Replay a sale from an export of the log table against other settings
+
+Export the log with::
+
+    \\copy (SELECT created, message FROM log
+           WHERE logger = 'snowball_ticketing.tickets' AND level = 'info'
+           ORDER BY record_id) TO 'sale.csv' CSV
+
+Each settings file is YAML, mapping "who what" to some of the columns of
+that tickets_settings row; anything left out has no limit. For example::
+
+    all any: {quota: 850, waiting_quota: 200, quota_per_person: 10}
+    all vip: {quota: 150}
+    alumni any: {quota: 150}
+
+See snowball_ticketing.tickets.replay for what is (and is not) modelled.
+"""
+
+from __future__ import unicode_literals, print_function
+
+import sys
+import os
+import time
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+import yaml
+
+from snowball_ticketing.tickets import replay
+
+
+def load_settings(filename):
+    with open(filename) as f:
+        rows = yaml.safe_load(f) or {}
+    return replay.make_settings(dict((tuple(key.split()), row)
+                                     for key, row in rows.items()))
+
+def report(filename, result, start):
+    def offset(when):
+        return "{0} (+{1})".format(when, when - start)
+
+    print("==", filename)
+    print("attempts: {0} ({1} dropped as retries)"
+            .format(result["attempts"], result["dropped_retries"]))
+    print("bought: {0}; waiting list: {1} (peak {2}, {3} released)"
+            .format(result["bought"], result["waiting_list"],
+                    result["peak_waiting_list"], result["released"]))
+    print("rejected: {0} attempts for {1} tickets"
+            .format(sum(result["rejected"].values()),
+                    result["rejected_tickets"]))
+    for reason, n in result["rejected"].most_common():
+        print("    {0:<20} {1:>6}".format(reason, n))
+    for key in ("quota_met", "waiting_quota_met"):
+        for test, when in sorted(result[key].items(), key=lambda x: x[1]):
+            print("{0}: {1} {2} at {3}"
+                    .format(key, test[0], test[1], offset(when)))
+
+def main(log_filename, settings_filenames):
+    with open(log_filename) as f:
+        events = replay.parse(replay.read_csv(f))
+
+    if not events:
+        print("no events in", log_filename)
+        return
+
+    start = events[0][0]
+    print("{0} events from {1} to {2}".format(len(events), start,
+                                              events[-1][0]))
+    print()
+
+    for filename in settings_filenames:
+        settings = load_settings(filename)
+        began = time.time()
+        result = replay.replay(events, settings)
+        report(filename, result, start)
+        print("(replayed in {0:.2f}s)".format(time.time() - began))
+        print()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage:", sys.argv[0], "log.csv", "settings.yaml",
+              "[settings.yaml ...]")
+    else:
+        main(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,37 @@
+from __future__ import unicode_literals, print_function
+
+import sys
+import os
+import logging
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+from snowball_ticketing import utils, tickets, logging_setup
+
+
+def sweep(postgres_settings, verify):
+    conn = utils.budget_connect(postgres_settings, "scripts")
+
+    try:
+        tickets.sweep_expired(pg=conn)
+        conn.commit()
+
+        if verify:
+            tickets.verify_counts(pg=conn)
+            conn.commit()
+    except Exception:
+        tickets.logger.exception("Unhandled sweep exception")
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (1, 2) or \
+            (len(sys.argv) == 2 and sys.argv[1] != "verify"):
+        print("Usage:", sys.argv[0], "[verify]")
+    else:
+        postgres = {"database": "ticketing"}
+
+        logging_setup.add_postgresql_handler(postgres)
+        logging_setup.add_syslog_handler()
+        logging_setup.add_smtp_handler()
+
+        sweep(postgres, len(sys.argv) == 2)
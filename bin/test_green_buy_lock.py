@@ -0,0 +1,110 @@
+"""
+Check that other greenlets progress while one waits for the buy lock
+
+Run against a test database (nothing is written). One greenlet takes the
+buy lock and holds it for `hold` seconds; a second then waits for it in
+the database, while others run queries on their own connections. With
+utils.make_psycopg_green in effect, those queries complete during the
+wait. Without it, the waiting greenlet would block the whole process (and
+so the holder would never release the lock: statement_timeout ends that).
+Given "not-green", make_psycopg_green is skipped, to show that failure.
+"""
+
+from __future__ import unicode_literals, print_function, division
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import sys
+import os
+import time
+
+import gevent
+import gevent.event
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+import psycopg2
+
+from snowball_ticketing import utils, tickets
+
+
+def connect(postgres_settings):
+    return psycopg2.connect(connection_factory=utils.PostgreSQLConnection,
+                            **postgres_settings)
+
+def holder(postgres_settings, hold, locked):
+    conn = connect(postgres_settings)
+    tickets.buy_lock(pg=conn)
+    locked.set()
+    gevent.sleep(hold)
+    conn.rollback()
+    conn.close()
+
+def waiter(postgres_settings, hold, result):
+    conn = connect(postgres_settings)
+    with conn.cursor() as cur:
+        cur.execute("SET statement_timeout = %s", (int(hold * 4000), ))
+
+    start = time.time()
+    tickets.buy_lock(pg=conn)
+    result["waited"] = time.time() - start
+    result["finished"] = time.time()
+
+    conn.rollback()
+    conn.close()
+
+def other(postgres_settings, deadline, completed):
+    conn = connect(postgres_settings)
+    while time.time() < deadline:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        completed.append(time.time())
+        gevent.sleep(0.01)
+    conn.close()
+
+def main(postgres_settings, hold=1.0, others=4, green=True):
+    if green:
+        utils.make_psycopg_green()
+
+    locked = gevent.event.Event()
+    result = {}
+    completed = []
+
+    h = gevent.spawn(holder, postgres_settings, hold, locked)
+    locked.wait()
+
+    start = time.time()
+    w = gevent.spawn(waiter, postgres_settings, hold, result)
+    busy = [gevent.spawn(other, postgres_settings, start + hold, completed)
+            for i in range(others)]
+    try:
+        gevent.joinall([h, w] + busy, raise_error=True)
+    except psycopg2.extensions.QueryCanceledError:
+        print("gave up waiting for the buy lock after {0:.2f}s; {1} other "
+              "queries completed meanwhile"
+                .format(time.time() - start, len(completed)))
+        print("FAIL")
+        return 1
+
+    during = [t for t in completed if t < result["finished"]]
+    print("waited {0:.2f}s for the buy lock; {1} other queries completed "
+          "meanwhile".format(result["waited"], len(during)))
+
+    if result["waited"] < hold / 2 or not during:
+        print("FAIL")
+        return 1
+    else:
+        print("PASS")
+        return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or \
+            (len(sys.argv) == 3 and sys.argv[2] != "not-green"):
+        print("Usage:", sys.argv[0], "test-database-name", "[not-green]")
+        sys.exit(2)
+    else:
+        sys.exit(main({"database": sys.argv[1]},
+                      green=len(sys.argv) == 2))
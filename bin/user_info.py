@@ -32,6 +32,7 @@ def types(ticket):
     elif ticket["finalised"]: a.append("finalised")
     elif ticket["expires"] is not None and \
          ticket["expires"] < datetime.utcnow(): a.append("expired")
+    if ticket.get("archived"): a.append("archived")
     for key in ('waiting_list', 'quota_exempt', 'printed',
                 'ticket_collected', 'entered_ball',
                 'forbid_desk_entry'):
@@ -52,7 +53,7 @@ def search(key, value, expired, postgres_settings):
     if key == "user_id":
         query = "SELECT * FROM users WHERE user_id = %s"
     elif key == "ticket_id":
-        query = "SELECT users.* FROM tickets " \
+        query = "SELECT users.* FROM tickets_history AS tickets " \
                 "JOIN users ON users.user_id = tickets.user_id " \
                 "WHERE ticket_id = %s"
     else:
@@ -89,7 +90,8 @@ def user_info(user, pg):
         notes("notes", user["notes"])
     print()
 
-    ts = tickets.tickets(user_id=user["user_id"], expired=expired, pg=pg)
+    ts = tickets.tickets(user_id=user["user_id"], expired=expired,
+                         include_archived=expired is None, pg=pg)
 
     ts.sort(key=lambda t: (t["surname"], t["othernames"],
                            t["waiting_list"], not t["vip"]))
@@ -116,7 +118,7 @@ def user_info(user, pg):
 
     with pg.cursor() as cur:
         cur.execute("SELECT created, session_id, message "
-                    "FROM log WHERE user_id = %s",
+                    "FROM log WHERE user_id = %s ORDER BY created",
                     (user["user_id"], ))
         for created, session_id, message in cur:
             session_id = str(session_id).ljust(5)
@@ -10,10 +10,11 @@ from snowball_ticketing.apps.admin import app
 postgres = {"database": "ticketing"}
 
 app.config["POSTGRES"] = postgres
+app.config["METRICS_DIRECTORY"] = "/run/www-sockets/www-ticketing/metrics"
 app.config["SESSION_COOKIE_SECURE"] = False  # TODO - committee preview
 
 logging_setup.remove_gunicorn_syslog_handler()
-logging_setup.add_postgresql_handler(postgres)
+logging_setup.add_postgresql_handler(postgres, queued=True)
 logging_setup.add_syslog_handler()
 logging_setup.add_smtp_handler()
 
@@ -10,9 +10,10 @@ from snowball_ticketing.apps.ticketing import app
 postgres = {"database": "ticketing"}
 
 app.config["POSTGRES"] = postgres
+app.config["METRICS_DIRECTORY"] = "/run/www-sockets/www-ticketing/metrics"
 
 logging_setup.remove_gunicorn_syslog_handler()
-logging_setup.add_postgresql_handler(postgres)
+logging_setup.add_postgresql_handler(postgres, queued=True)
 logging_setup.add_syslog_handler()
 logging_setup.add_smtp_handler()
 
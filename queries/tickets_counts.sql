@@ -0,0 +1,46 @@
+-- used by snowball_ticketing.tickets.__init__
+--
+-- produces the same row as unexpired_counts.sql, but from tickets_counts.
+-- Tickets stay "counted" until something writes to their row after they
+-- expire (see tickets.sweep_expired), so subtract those that have expired
+-- but not yet been swept. tickets_counted_expires_index keeps that cheap.
+-- tickets_counts only has members/alumni, standard/vip rows; the 'all' and
+-- 'any' totals are summed here.
+SELECT *,
+    all_standard                + all_vip                   AS all_any,
+    waiting_all_standard        + waiting_all_vip           AS waiting_all_any
+FROM (SELECT *,
+    members_standard            + alumni_standard           AS all_standard,
+    members_vip                 + alumni_vip                AS all_vip,
+    waiting_members_standard    + waiting_alumni_standard   AS waiting_all_standard,
+    waiting_members_vip         + waiting_alumni_vip        AS waiting_all_vip,
+    members_standard            + members_vip               AS members_any,
+    alumni_standard             + alumni_vip                AS alumni_any,
+    waiting_members_standard    + waiting_members_vip       AS waiting_members_any,
+    waiting_alumni_standard     + waiting_alumni_vip        AS waiting_alumni_any
+FROM (SELECT
+    SUM(CASE WHEN members   AND standard    AND NOT waiting_list    THEN count ELSE 0 END) AS members_standard,
+    SUM(CASE WHEN members   AND standard    AND waiting_list        THEN count ELSE 0 END) AS waiting_members_standard,
+    SUM(CASE WHEN members   AND vip         AND NOT waiting_list    THEN count ELSE 0 END) AS members_vip,
+    SUM(CASE WHEN members   AND vip         AND waiting_list        THEN count ELSE 0 END) AS waiting_members_vip,
+    SUM(CASE WHEN alumni    AND standard    AND NOT waiting_list    THEN count ELSE 0 END) AS alumni_standard,
+    SUM(CASE WHEN alumni    AND standard    AND waiting_list        THEN count ELSE 0 END) AS waiting_alumni_standard,
+    SUM(CASE WHEN alumni    AND vip         AND NOT waiting_list    THEN count ELSE 0 END) AS alumni_vip,
+    SUM(CASE WHEN alumni    AND vip         AND waiting_list        THEN count ELSE 0 END) AS waiting_alumni_vip
+FROM (SELECT user_group = 'members' AS members, user_group = 'alumni' AS alumni,
+             ticket_type = 'standard' AS standard, ticket_type = 'vip' AS vip,
+             waiting_list, count
+    FROM (
+        SELECT user_group, ticket_type, waiting_list, count
+        FROM tickets_counts
+        UNION ALL
+        SELECT tickets_user_group(users.person_type), tickets_ticket_type(vip),
+               waiting_list, -count(*)
+        FROM tickets
+        LEFT JOIN users ON users.user_id = tickets.user_id
+        WHERE counted AND expires <= utcnow()
+        GROUP BY 1, 2, 3
+    ) AS c
+) AS t
+) AS t2
+) AS t3;
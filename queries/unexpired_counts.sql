@@ -1,4 +1,5 @@
--- used by snowball_ticketing.tickets.__init__
+-- used by snowball_ticketing.tickets.verify_counts; tickets.counts() reads
+-- tickets_counts instead (see tickets_counts.sql)
 --
 -- here, I use SELECT ... FROM (SELECT ... ) since it seems to make the query faster.
 -- I suspect it allows the PostgreSQL query planner to aggregate/count the rows from the
@@ -7,13 +7,28 @@
 DROP TABLE IF EXISTS log;
 DROP TYPE IF EXISTS log_level;
 DROP TABLE IF EXISTS sessions;
+DROP TABLE IF EXISTS admission_queue;
+DROP TABLE IF EXISTS tickets_counts;
+DROP VIEW IF EXISTS tickets_history;
+DROP TABLE IF EXISTS tickets_expired;
 DROP TABLE IF EXISTS tickets;
+DROP FUNCTION IF EXISTS tickets_counted();
+DROP FUNCTION IF EXISTS tickets_counts_update();
+DROP FUNCTION IF EXISTS tickets_counts_adjust(integer, boolean, boolean, integer);
+DROP FUNCTION IF EXISTS tickets_reserve(tickets_settings_user_group,
+    tickets_settings_ticket_group, boolean, integer);
+-- CASCADE drops the trigger on users
+DROP FUNCTION IF EXISTS users_tickets_counts_update() CASCADE;
+DROP FUNCTION IF EXISTS tickets_user_group(person_type);
+DROP FUNCTION IF EXISTS tickets_ticket_type(boolean);
 DROP TYPE IF EXISTS expires_reason;
 DROP TABLE IF EXISTS tickets_settings;
+DROP FUNCTION IF EXISTS tickets_settings_notify();
 DROP TYPE IF EXISTS tickets_settings_user_group;
 DROP TYPE IF EXISTS tickets_settings_ticket_group;
 DROP TYPE IF EXISTS tickets_settings_mode;
 DROP TABLE IF EXISTS users;
+DROP FUNCTION IF EXISTS sessions_notify();
 DROP TYPE IF EXISTS person_type;
 DROP TYPE IF EXISTS user_type;
 DROP TABLE IF EXISTS colleges;
@@ -218,6 +233,19 @@ UPDATE tickets_settings
     SET quota_per_person_sentence = 'You may buy up to 10 tickets in total'
     WHERE who = 'all' AND what = 'any';
 
+-- tickets.settings() caches the table for each process until notified.
+-- NOTIFY is only delivered when (and if) the transaction commits.
+CREATE FUNCTION tickets_settings_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('tickets_settings', TG_OP);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tickets_settings_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON tickets_settings
+    FOR EACH STATEMENT EXECUTE PROCEDURE tickets_settings_notify();
+
 CREATE TYPE expires_reason AS ENUM
     ('not-finalised', 'not-paid', 'admin-intervention', 'other');
 
@@ -284,6 +312,15 @@ CREATE TABLE tickets (
     notes text NOT NULL DEFAULT '',
     desk_notes text NOT NULL DEFAULT '',
 
+    -- is this ticket included in tickets_counts? Maintained by the
+    -- tickets_counted trigger: NOT quota_exempt and not expired, as of the
+    -- last time the row was written. Expired tickets stay counted until
+    -- something touches their row (see tickets.sweep_expired).
+    counted boolean NOT NULL DEFAULT FALSE,
+    -- set by tickets.buy (lock mode 'reserve') when tickets_reserve has
+    -- already added the ticket to tickets_counts; only looked at on INSERT
+    prereserved boolean NOT NULL DEFAULT FALSE,
+
     CONSTRAINT finalised_tickets_have_details
         CHECK ( (finalised IS NULL) OR
             (surname IS NOT NULL AND
@@ -304,6 +341,327 @@ CREATE TABLE tickets (
 );
 
 CREATE INDEX tickets_user_id_index ON tickets (user_id);
+-- finds tickets that have expired but are still counted; small, since
+-- it only contains unfinalised tickets
+CREATE INDEX tickets_counted_expires_index ON tickets (expires)
+    WHERE counted AND expires IS NOT NULL;
+-- finds tickets for the reaper; also small
+CREATE INDEX tickets_expires_index ON tickets (expires)
+    WHERE expires IS NOT NULL;
+
+-- Indexes for the queries in queries/; bin/check_query_plans.py checks
+-- that they are used. Partial indexes keep each to the rows its queries
+-- want, and the extra columns let the planner use index-only scans.
+-- Queries that read most of the table (see queries/plan_budgets.yaml) get
+-- none. needs_receipt.sql groups every ticket by user: on the launch day
+-- mix an index-only scan of (user_id, finalised, paid, expires) took 13ms
+-- against 16ms for the sequential scan (docs/benchmarks.rst), too little
+-- for a once a minute job to justify another index on every ticket write.
+-- unpaid.sql, all_unpaid.sql
+CREATE INDEX tickets_unpaid_index ON tickets (user_id, created)
+    WHERE finalised IS NOT NULL AND paid IS NULL AND NOT waiting_list;
+-- waiting.sql
+CREATE INDEX tickets_waiting_index ON tickets (created)
+    WHERE finalised IS NOT NULL AND waiting_list;
+-- user_ids_with_tickets.sql, users_with_tickets.sql; paid_counts.sql,
+-- paid_tickets.sql and income.sql while few tickets are paid
+CREATE INDEX tickets_paid_index ON tickets (user_id, vip, quota_exempt)
+    WHERE paid IS NOT NULL;
+
+-- Tickets that expired a while ago are moved here, whole, by
+-- tickets.reap_expired. They are never moved back: an admin wanting to
+-- revive one must do so by hand.
+CREATE TABLE tickets_expired (
+    LIKE tickets,
+    archived timestamp NOT NULL,
+    PRIMARY KEY (ticket_id)
+);
+
+CREATE INDEX tickets_expired_user_id_index ON tickets_expired (user_id);
+
+-- for the admin scripts that want the full history
+CREATE VIEW tickets_history AS
+    SELECT *, NULL::timestamp AS archived FROM tickets
+    UNION ALL
+    SELECT * FROM tickets_expired;
+
+-- The number of unexpired, non-quota-exempt tickets of each type, so that
+-- tickets.counts() needn't scan the tickets table. Rows are only ever
+-- UPDATEd by triggers and tickets_reserve.
+-- There are only members/alumni, standard/vip rows: the 'all' and 'any'
+-- totals are summed when read, so that a ticket only ever touches its own
+-- row, and buyers of different types don't queue on a shared one.
+-- Rows are always locked in the order of the primary key (a statement that
+-- updates several must take FOR UPDATE locks first).
+CREATE TABLE tickets_counts (
+    user_group tickets_settings_user_group NOT NULL
+        CHECK ( user_group != 'all' ),
+    ticket_type tickets_settings_ticket_group NOT NULL
+        CHECK ( ticket_type != 'any' ),
+    waiting_list boolean NOT NULL,
+    count integer NOT NULL CHECK ( count >= 0 ),
+
+    PRIMARY KEY (user_group, ticket_type, waiting_list)
+);
+
+INSERT INTO tickets_counts (user_group, ticket_type, waiting_list, count)
+SELECT user_group, ticket_type, waiting_list, 0
+FROM unnest(enum_range(NULL::tickets_settings_user_group)) AS user_group,
+     unnest(enum_range(NULL::tickets_settings_ticket_group)) AS ticket_type,
+     (VALUES (FALSE), (TRUE)) AS w (waiting_list)
+WHERE user_group != 'all' AND ticket_type != 'any';
+
+-- see tickets._user_group_from_user
+CREATE FUNCTION tickets_user_group(person_type)
+    RETURNS tickets_settings_user_group
+    AS 'SELECT (CASE WHEN $1 = ''alumnus'' THEN ''alumni''
+                     ELSE ''members'' END)::tickets_settings_user_group'
+    LANGUAGE SQL
+    IMMUTABLE;
+
+CREATE FUNCTION tickets_ticket_type(boolean)
+    RETURNS tickets_settings_ticket_group
+    AS 'SELECT (CASE WHEN $1 THEN ''vip''
+                     ELSE ''standard'' END)::tickets_settings_ticket_group'
+    LANGUAGE SQL
+    IMMUTABLE;
+
+-- tickets_counts_adjust(user_id, vip, waiting_list, delta)
+-- adjusts the ticket's row (and only that row)
+CREATE FUNCTION tickets_counts_adjust(integer, boolean, boolean, integer)
+    RETURNS void
+    AS 'UPDATE tickets_counts SET count = count + $4
+        WHERE user_group = (SELECT tickets_user_group(person_type)
+                            FROM users WHERE user_id = $1) AND
+              ticket_type = tickets_ticket_type($2) AND
+              waiting_list = $3'
+    LANGUAGE SQL;
+
+CREATE FUNCTION tickets_counted() RETURNS trigger AS $$
+BEGIN
+    NEW.counted := NOT NEW.quota_exempt AND
+                   (NEW.expires IS NULL OR NEW.expires > utcnow());
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION tickets_counts_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        IF OLD.counted = NEW.counted AND OLD.user_id = NEW.user_id AND
+                OLD.vip = NEW.vip AND OLD.waiting_list = NEW.waiting_list THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+
+    -- moving a ticket between rows: lock both, in the locking order
+    IF TG_OP = 'UPDATE' THEN
+        IF OLD.counted AND NEW.counted THEN
+            PERFORM 1 FROM tickets_counts
+            WHERE (user_group, ticket_type, waiting_list) IN
+                (((SELECT tickets_user_group(person_type)
+                   FROM users WHERE user_id = OLD.user_id),
+                  tickets_ticket_type(OLD.vip), OLD.waiting_list),
+                 ((SELECT tickets_user_group(person_type)
+                   FROM users WHERE user_id = NEW.user_id),
+                  tickets_ticket_type(NEW.vip), NEW.waiting_list))
+            ORDER BY user_group, ticket_type, waiting_list
+            FOR UPDATE;
+        END IF;
+    END IF;
+
+    -- nested IFs: OLD is unassigned in INSERT triggers (and NEW in DELETE)
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        IF OLD.counted THEN
+            PERFORM tickets_counts_adjust(OLD.user_id, OLD.vip,
+                                          OLD.waiting_list, -1);
+        END IF;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        -- a prereserved ticket is already counted (unless, oddly, it
+        -- isn't counted after all, in which case give its place back)
+        IF NEW.counted != NEW.prereserved THEN
+            PERFORM tickets_counts_adjust(NEW.user_id, NEW.vip,
+                                          NEW.waiting_list,
+                                          CASE WHEN NEW.counted
+                                               THEN 1 ELSE -1 END);
+        END IF;
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NEW.counted THEN
+            PERFORM tickets_counts_adjust(NEW.user_id, NEW.vip,
+                                          NEW.waiting_list, 1);
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tickets_counted BEFORE INSERT OR UPDATE ON tickets
+    FOR EACH ROW EXECUTE PROCEDURE tickets_counted();
+CREATE TRIGGER tickets_counts AFTER INSERT OR UPDATE OR DELETE ON tickets
+    FOR EACH ROW EXECUTE PROCEDURE tickets_counts_update();
+
+-- a user changing between alumnus and not moves their tickets between groups
+CREATE FUNCTION users_tickets_counts_update() RETURNS trigger AS $$
+DECLARE
+    old_group tickets_settings_user_group;
+    new_group tickets_settings_user_group;
+    r record;
+BEGIN
+    old_group := tickets_user_group(OLD.person_type);
+    new_group := tickets_user_group(NEW.person_type);
+
+    IF old_group = new_group THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM 1 FROM tickets_counts
+    ORDER BY user_group, ticket_type, waiting_list
+    FOR UPDATE;
+
+    FOR r IN SELECT tickets_ticket_type(vip) AS ticket_type, waiting_list,
+                    count(*) AS n
+             FROM tickets
+             WHERE user_id = NEW.user_id AND counted
+             GROUP BY vip, waiting_list
+    LOOP
+        UPDATE tickets_counts SET count = count - r.n
+        WHERE user_group = old_group AND
+              ticket_type = r.ticket_type AND
+              waiting_list = r.waiting_list;
+        UPDATE tickets_counts SET count = count + r.n
+        WHERE user_group = new_group AND
+              ticket_type = r.ticket_type AND
+              waiting_list = r.waiting_list;
+    END LOOP;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_tickets_counts AFTER UPDATE OF person_type ON users
+    FOR EACH ROW EXECUTE PROCEDURE users_tickets_counts_update();
+
+-- tickets.buy's 'reserve' lock mode: check each quota that applies against
+-- the sum of the tickets_counts rows under it, less the tickets that have
+-- expired but not yet been swept, and if every quota has room add `number`
+-- to the ticket's own row. Returns one of 'ok', 'met' (ok, and now exactly
+-- at some quota), 'insufficient-spare', 'quota-met', 'quota-not-met' or
+-- 'incorrect-mode'. If not ok, nothing is changed. The tickets must then be
+-- INSERTed with prereserved set.
+-- Only the rows under a quota that applies (and the ticket's own) are
+-- locked, so buyers under disjoint quotas don't wait for one another.
+-- Rows are locked one at a time, in the order of the primary key.
+CREATE FUNCTION tickets_reserve(user_group tickets_settings_user_group,
+                                ticket_type tickets_settings_ticket_group,
+                                waiting_list boolean, number integer)
+    RETURNS text AS $$
+DECLARE
+    r record;
+    used integer;
+    met boolean := FALSE;
+BEGIN
+    SELECT bool_or(mode != 'available') AS closed,
+           bool_or(quota_met) AS quota_met,
+           bool_or(waiting_quota_met) AS waiting_quota_met
+        INTO r
+    FROM tickets_settings
+    WHERE who IN (tickets_reserve.user_group, 'all') AND
+          what IN (tickets_reserve.ticket_type, 'any');
+
+    IF r.closed THEN
+        RETURN 'incorrect-mode';
+    ELSIF waiting_list AND NOT coalesce(r.quota_met, FALSE) THEN
+        RETURN 'quota-not-met';
+    ELSIF (NOT waiting_list AND r.quota_met) OR
+            (waiting_list AND r.waiting_quota_met) THEN
+        RETURN 'quota-met';
+    END IF;
+
+    -- the ticket's own row, which is written, FOR UPDATE; the others under
+    -- its quotas, which are only read, FOR SHARE (writers to them, and so
+    -- buyers under those quotas, still wait, but readers don't). Holding
+    -- these also keeps sweep_expired (and anything else that would uncount
+    -- an expired ticket under them) out until commit.
+    FOR r IN SELECT c.user_group, c.ticket_type
+             FROM tickets_counts AS c
+             WHERE c.waiting_list = tickets_reserve.waiting_list AND
+                   ((c.user_group = tickets_reserve.user_group AND
+                     c.ticket_type = tickets_reserve.ticket_type) OR
+                    EXISTS (SELECT 1 FROM tickets_settings AS s
+                            WHERE s.who IN (tickets_reserve.user_group,
+                                            'all') AND
+                                  s.what IN (tickets_reserve.ticket_type,
+                                             'any') AND
+                                  s.who IN (c.user_group, 'all') AND
+                                  s.what IN (c.ticket_type, 'any') AND
+                                  CASE WHEN tickets_reserve.waiting_list
+                                       THEN s.waiting_quota
+                                       ELSE s.quota END IS NOT NULL))
+             ORDER BY c.user_group, c.ticket_type
+    LOOP
+        IF r.user_group = tickets_reserve.user_group AND
+                r.ticket_type = tickets_reserve.ticket_type THEN
+            PERFORM 1 FROM tickets_counts AS c
+            WHERE c.user_group = r.user_group AND
+                  c.ticket_type = r.ticket_type AND
+                  c.waiting_list = tickets_reserve.waiting_list
+            FOR UPDATE;
+        ELSE
+            PERFORM 1 FROM tickets_counts AS c
+            WHERE c.user_group = r.user_group AND
+                  c.ticket_type = r.ticket_type AND
+                  c.waiting_list = tickets_reserve.waiting_list
+            FOR SHARE;
+        END IF;
+    END LOOP;
+
+    FOR r IN SELECT s.who, s.what,
+                    CASE WHEN tickets_reserve.waiting_list
+                         THEN s.waiting_quota ELSE s.quota END AS quota
+             FROM tickets_settings AS s
+             WHERE s.who IN (tickets_reserve.user_group, 'all') AND
+                   s.what IN (tickets_reserve.ticket_type, 'any')
+    LOOP
+        CONTINUE WHEN r.quota IS NULL;
+
+        SELECT sum(c.count) INTO used
+        FROM tickets_counts AS c
+        WHERE r.who IN (c.user_group, 'all') AND
+              r.what IN (c.ticket_type, 'any') AND
+              c.waiting_list = tickets_reserve.waiting_list;
+
+        -- as in queries/tickets_counts.sql (tickets_counted_expires_index)
+        used := used - (SELECT count(*)
+                        FROM tickets AS t
+                        JOIN users AS u ON u.user_id = t.user_id
+                        WHERE t.counted AND t.expires <= utcnow() AND
+                              t.waiting_list = tickets_reserve.waiting_list AND
+                              r.who IN (tickets_user_group(u.person_type),
+                                        'all') AND
+                              r.what IN (tickets_ticket_type(t.vip), 'any'));
+
+        IF used + number > r.quota THEN
+            RETURN 'insufficient-spare';
+        END IF;
+
+        met := met OR used + number = r.quota;
+    END LOOP;
+
+    UPDATE tickets_counts AS c SET count = c.count + number
+    WHERE c.user_group = tickets_reserve.user_group AND
+          c.ticket_type = tickets_reserve.ticket_type AND
+          c.waiting_list = tickets_reserve.waiting_list;
+
+    IF met THEN
+        RETURN 'met';
+    ELSE
+        RETURN 'ok';
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
 
 CREATE TABLE sessions (
     session_id SERIAL PRIMARY KEY,
@@ -314,13 +672,59 @@ CREATE TABLE sessions (
     created timestamp NOT NULL,
     last timestamp NOT NULL,
     destroyed boolean NOT NULL DEFAULT FALSE
+) WITH (fillfactor = 70);
+
+-- last is updated every few minutes for each active session: leave room in
+-- each page for those updates to be HOT, and don't index last (which would
+-- prevent it). bin/purge_sessions.py keeps the table small enough to scan.
+-- No query looks sessions up by user; this index is for the foreign key,
+-- whose check when a user is deleted would otherwise scan the table.
+CREATE INDEX sessions_user_id_index ON sessions (user_id);
+
+-- utils.SessionCache caches sessions and their users in each process until
+-- notified that the user has changed or the session has been destroyed
+CREATE FUNCTION sessions_notify() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'users' THEN
+        PERFORM pg_notify('sessions', 'user ' || OLD.user_id);
+    ELSE
+        PERFORM pg_notify('sessions', 'session ' || OLD.session_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_sessions_notify
+    AFTER UPDATE OR DELETE ON users
+    FOR EACH ROW EXECUTE PROCEDURE sessions_notify();
+
+-- not on updates of last, which are frequent and change nothing cached, nor
+-- on deletes: only destroyed or expired sessions are purged, and neither
+-- can be served from a cache
+CREATE TRIGGER sessions_notify
+    AFTER UPDATE OF destroyed ON sessions
+    FOR EACH ROW EXECUTE PROCEDURE sessions_notify();
+
+-- the launch-day waiting room; see snowball_ticketing.tickets.admission
+CREATE TABLE admission_queue (
+    user_id integer PRIMARY KEY REFERENCES users (user_id),
+    joined timestamp NOT NULL,
+    admit_at timestamp NOT NULL,
+    CHECK (admit_at >= joined)
 );
 
+CREATE INDEX admission_queue_admit_at_index ON admission_queue (admit_at);
+
 CREATE TYPE log_level AS ENUM
     ('debug', 'info', 'warning', 'error', 'critical');
 
+-- partitioned by day (of created), so that inserts only maintain the
+-- indexes of a small partition, and old days can be dropped cheaply.
+-- bin/log_partitions.py creates the partitions ahead of time, and detaches
+-- or exports and drops old ones; rows that no partition covers land in
+-- log_default. (Needs PostgreSQL 11 or later.)
 CREATE TABLE log (
-    record_id SERIAL PRIMARY KEY,
+    record_id SERIAL,
     created timestamp NOT NULL,
     level log_level NOT NULL,
     logger text NOT NULL,
@@ -342,8 +746,12 @@ CREATE TABLE log (
     -- start logging (via the log handler's connection) before the transaction
     -- for the request has been committed.
     session_id integer,
-    user_id integer
-);
+    user_id integer,
+
+    PRIMARY KEY (record_id, created)
+) PARTITION BY RANGE (created);
+
+CREATE TABLE log_default PARTITION OF log DEFAULT;
 
 CREATE INDEX log_created_index ON log (created);
 CREATE INDEX log_session_id_created_index ON log (session_id, created);
@@ -358,12 +766,20 @@ GRANT SELECT, UPDATE ON users_user_id_seq TO "www-ticketing";
 GRANT SELECT, INSERT, UPDATE, DELETE ON tickets_settings TO "www-ticketing";
 GRANT SELECT, INSERT, UPDATE, DELETE ON tickets TO "www-ticketing";
 GRANT SELECT, UPDATE ON tickets_ticket_id_seq TO "www-ticketing";
+-- reap_expired runs as www-ticketing; archived tickets are never modified
+GRANT SELECT, INSERT ON tickets_expired TO "www-ticketing";
+GRANT SELECT ON tickets_history TO "www-ticketing";
+-- updated by the tickets triggers, which run as the invoking user
+GRANT SELECT, UPDATE ON tickets_counts TO "www-ticketing";
 
 -- allow creating, updating last, and destroying sessions via 'destroy'
 GRANT SELECT, INSERT ON sessions TO "www-ticketing";
 GRANT UPDATE ( last, destroyed ) ON sessions TO "www-ticketing";
+-- (bin/purge_sessions.py deletes sessions, and runs as the owner)
 GRANT SELECT, UPDATE ON sessions_session_id_seq TO "www-ticketing";
 
+GRANT SELECT, INSERT, UPDATE, DELETE ON admission_queue TO "www-ticketing";
+
 -- add and view only
 GRANT SELECT, INSERT ON log TO "www-ticketing";
 GRANT SELECT, UPDATE ON log_record_id_seq TO "www-ticketing";
@@ -371,3 +787,15 @@ GRANT SELECT, UPDATE ON log_record_id_seq TO "www-ticketing";
 -- backups
 GRANT SELECT ON ALL TABLES IN SCHEMA PUBLIC TO "yocto-pgdump";
 GRANT SELECT ON ALL SEQUENCES IN SCHEMA PUBLIC TO "yocto-pgdump";
+
+-- the maintenance scripts in deploy/crontab that need to own a table (to
+-- VACUUM it, say) run as "ticketing-maint": neither the web role nor a
+-- superuser. It has no other privileges.
+ALTER TABLE sessions OWNER TO "ticketing-maint";
+-- bin/log_partitions.py creates, attaches and drops partitions of log, so
+-- that the partitions it creates belong to it too (and can be backed up)
+ALTER TABLE log OWNER TO "ticketing-maint";
+ALTER TABLE log_default OWNER TO "ticketing-maint";
+GRANT CREATE ON SCHEMA public TO "ticketing-maint";
+ALTER DEFAULT PRIVILEGES FOR ROLE "ticketing-maint"
+    GRANT SELECT ON TABLES TO "yocto-pgdump";
@@ -24,10 +24,10 @@ import os
 from datetime import timedelta
  
 import pytz
-from flask import Flask, render_template
+from flask import Flask, Response, render_template
 from raven.flask_glue import AuthDecorator
 
-from .. import utils, tickets, queries
+from .. import utils, tickets, queries, metrics
  
 app = Flask(__name__,
             static_folder='../../static',
@@ -37,7 +37,8 @@ app = Flask(__name__,
 # (which there is)
 app.secret_key = os.urandom(16)
 
-utils.PostgreSQL(app)
+utils.PostgreSQL(app, budget_region="admin")
+metrics.init_app(app, "admin")
 
 users = frozenset({"djr61"})
 
@@ -53,14 +54,21 @@ def dashboard():
         quotas["waiting_{0}_{1}".format(who, what)] = settings["waiting_quota"]
 
     with utils.postgres.cursor(True) as cur:
-        cur.execute(queries.paid_counts)
+        cur.execute_prepared(queries.paid_counts)
         paid = cur.fetchone()
 
     return render_template("admin/dashboard.html",
                            quotas=quotas,
                            counts=tickets.counts(),
                            paid=paid,
-                           histogram=list(_tickets_histogram()))
+                           histogram=list(_tickets_histogram()),
+                           worst_waits=metrics.worst_waits(app),
+                           worst_window=metrics.worst_window)
+
+@app.route("/admin/metrics")
+def prometheus_metrics():
+    return Response(metrics.prometheus_text(app),
+                    content_type=b"text/plain; version=0.0.4; charset=utf-8")
 
 def _tickets_histogram():
     query = "SELECT date_trunc('hour', created) AS hour_bin, count(*) " \
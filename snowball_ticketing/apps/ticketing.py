@@ -27,7 +27,7 @@ import flask
 from flask import Flask, redirect, render_template, url_for, jsonify
 from flask import request, Response
 
-from .. import utils, login, info
+from .. import utils, login, info, metrics
 from ..tickets import views as tickets_views
 
 
@@ -39,9 +39,12 @@ app.session_interface = utils.SessionInterface()
 app.config["SESSION_COOKIE_NAME"] = "snowball_ticketing"
 app.config["SESSION_COOKIE_HTTPONLY"] = True
 app.config["SESSION_COOKIE_SECURE"] = True
+app.config["SESSION_LAST_GRANULARITY"] = 300
+app.config["SESSION_CACHE_TTL"] = 60
 
 utils.customise_jinja(app)
 utils.PostgreSQL(app)
+metrics.init_app(app, "ticketing")
 app.register_blueprint(info.bp)
 app.register_blueprint(login.bp)
 app.register_blueprint(tickets_views.bp)
@@ -56,6 +59,7 @@ def add_no_cache(response):
 
 
 @app.route("/time", endpoint="time")
+@utils.session_free
 def time_view():
     # this view is cached by my browser specifically needs to not be.
     # The decorator above might change, but this must not.
@@ -65,6 +69,7 @@ def time_view():
     return response
 
 @app.route("/heartbeat")
+@utils.session_free
 def heartbeat():
     with utils.postgres.cursor() as cur:
         cur.execute("SELECT 1")
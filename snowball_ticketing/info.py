@@ -83,7 +83,8 @@ def setup(bp, pages):
             url = "/" + endpoint.replace("_", "-")
         template = "theme/pages/{0}.html".format(endpoint)
         view = functools.partial(render_template, template, **pages_data)
-        bp.add_url_rule(url, endpoint, view)
+        # render as prerender_pages does, without a session
+        bp.add_url_rule(url, endpoint, utils.session_free(view))
 
     bp.add_app_template_global(pages, 'info_pages')
 
@@ -49,9 +49,14 @@ User ID:    %(user_id)s
 %(message)s"""
 
 
-def add_postgresql_handler(postgres, level=logging.INFO):
-    """adds :class:`utils.PostgreSQLHandler` using postgres config `postgres`"""
-    handler = utils.PostgreSQLHandler(postgres)
+def add_postgresql_handler(postgres, level=logging.INFO, queued=False):
+    """
+    adds :class:`utils.PostgreSQLHandler` using postgres config `postgres`
+
+    If `queued`, records are written by a background thread (see
+    :class:`utils.PostgreSQLHandler`)
+    """
+    handler = utils.PostgreSQLHandler(postgres, queued=queued)
     handler.setLevel(level)
     logger = logging.getLogger("snowball_ticketing")
     logger.addHandler(handler)
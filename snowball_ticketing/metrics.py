@@ -0,0 +1,597 @@
+# Copyright 2013 Daniel Richman
+#
+# This file is part of The Snowball Ticketing System.
+#
+# The Snowball Ticketing System is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# The Snowball Ticketing System is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with The Snowball Ticketing System.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Per-endpoint request latency and database time
+
+:func:`init_app` times each request, and each query it runs (via
+:attr:`utils.PostgreSQL.query_observer`). Each process keeps the totals in
+a :class:`Collector`, which writes them every few seconds to a file of its
+own in ``app.config["METRICS_DIRECTORY"]``; :func:`prometheus_text` adds up
+the files of every process and renders them in Prometheus' text format.
+The files of dead processes are folded into one per app (see
+:func:`read_all`), so that counters never go backwards.
+
+Advisory locks taken during a request (see :func:`lock_acquired`) are
+recorded too: how long the request waited for each, how many others were
+already waiting, and how long it held it (until the request's COMMIT).
+The longest waits of the last :data:`worst_window` seconds are kept, for
+the admin dashboard (:func:`worst_waits`).
+"""
+
+from __future__ import unicode_literals, division
+
+import os
+import re
+import json
+import time
+import errno
+import fcntl
+import binascii
+import datetime
+import threading
+
+import flask
+
+from . import utils
+
+
+__all__ = ["buckets", "depth_buckets", "worst_window", "worst_size",
+           "stale_age", "Collector", "init_app", "lock_acquired",
+           "read_all", "render", "prometheus_text", "worst_waits"]
+
+
+logger = utils.getLogger(__name__)
+
+
+#: histogram bucket upper bounds (seconds), for both request latency and
+#: the time spent in queries
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#: histogram bucket upper bounds for lock queue depths
+depth_buckets = (0, 1, 2, 5, 10, 20, 50, 100)
+
+#: lock waits are kept for :func:`worst_waits` for this long (seconds)...
+worst_window = 600
+#: ... but only this many of them
+worst_size = 20
+
+#: leftover temporary and lock files are removed after this long (seconds)
+stale_age = 3600
+
+# app-pid-token.json, for a live (or not yet folded) process; app-dead.json
+_file_re = re.compile(r"^(?P<app>\w+)-(?:(?P<pid>\d+)-[0-9a-f]+|dead)"
+                      r"\.json$")
+_fold_lock = "fold.lock"
+
+
+def _histogram(bounds=buckets):
+    # a count per bucket, the +Inf bucket last; then the sum
+    return {"counts": [0] * (len(bounds) + 1), "sum": 0.0}
+
+def _observe(histogram, value, bounds=buckets):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            break
+    else:
+        i = len(bounds)
+    histogram["counts"][i] += 1
+    histogram["sum"] += value
+
+def _endpoint():
+    return {"requests": {}, "duration": _histogram(), "db": _histogram(),
+            "queries": 0, "rows": 0}
+
+def _lock():
+    return {"wait": _histogram(), "hold": _histogram(),
+            "depth": _histogram(depth_buckets)}
+
+def _data():
+    # what each process' file holds
+    return {"endpoints": {}, "locks": {}, "worst": []}
+
+def _recent_worst(waits, now):
+    waits = [w for w in waits if w["time"] > now - worst_window]
+    waits.sort(key=lambda w: w["wait"], reverse=True)
+    return waits[:worst_size]
+
+class Collector(object):
+    """
+    The request statistics of one process
+
+    :meth:`record` adds a request; at most every `flush_interval` seconds
+    it also writes everything to `directory`/`name`-`pid`-`token`.json,
+    where `directory` is ``config["METRICS_DIRECTORY"]``, if set. (`config`
+    is read when needed, so it may be filled in after the app is created.)
+
+    The random `token` means that a process that gets a dead one's pid does
+    not overwrite its file. While the process lives it holds a ``lockf``
+    lock on the matching .lock file, by which :func:`read_all` can tell
+    that it has died.
+    """
+
+    def __init__(self, name, config, flush_interval=5):
+        self.name = name
+        self.config = config
+        self.flush_interval = flush_interval
+        self._data = _data()
+        self._flushed = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._filename = None
+
+    def record(self, endpoint, status, duration, queries, query_time, rows,
+               locks=()):
+        """
+        Add a request to `endpoint` (a string) that took `duration`
+
+        `locks` are those it took: dicts of ``lock``, ``wait``, ``depth``
+        (``None`` if not measured) and ``hold``.
+        """
+
+        now = time.time()
+
+        with self._lock:
+            stats = self._data["endpoints"].get(endpoint)
+            if stats is None:
+                stats = self._data["endpoints"][endpoint] = _endpoint()
+
+            status = str(status)
+            stats["requests"][status] = stats["requests"].get(status, 0) + 1
+            _observe(stats["duration"], duration)
+            _observe(stats["db"], query_time)
+            stats["queries"] += queries
+            stats["rows"] += rows
+
+            for lock in locks:
+                lock_stats = self._data["locks"].get(lock["lock"])
+                if lock_stats is None:
+                    lock_stats = self._data["locks"][lock["lock"]] = _lock()
+
+                _observe(lock_stats["wait"], lock["wait"])
+                _observe(lock_stats["hold"], lock["hold"])
+                if lock["depth"] is not None:
+                    _observe(lock_stats["depth"], lock["depth"],
+                             depth_buckets)
+
+                if lock["wait"] > 0:
+                    wait = dict(lock, time=now, endpoint=endpoint,
+                                app=self.name)
+                    self._data["worst"] = \
+                            _recent_worst(self._data["worst"] + [wait], now)
+
+            due = now - self._flushed > self.flush_interval
+
+        if due and self.directory is not None:
+            self.flush()
+
+    @property
+    def directory(self):
+        return self.config.get("METRICS_DIRECTORY")
+
+    def snapshot(self):
+        """
+        Returns a copy of the statistics: a dict of ``endpoints``
+        (``{endpoint: stats}``), ``locks`` (``{lock: stats}``) and ``worst``
+        (a list of waits)
+        """
+        with self._lock:
+            return json.loads(json.dumps(self._data))
+
+    def flush(self):
+        """Write the statistics to this process' file"""
+
+        with self._lock:
+            data = json.dumps(self._data)
+            self._flushed = time.time()
+
+            try:
+                filename = self._own_file()
+            except (IOError, OSError):
+                logger.warning("failed to create a file in %s",
+                               self.directory, exc_info=True)
+                return
+
+        temp_filename = filename + ".tmp"
+
+        try:
+            with open(temp_filename, "w") as f:
+                f.write(data)
+            os.rename(temp_filename, filename)
+        except (IOError, OSError):
+            logger.warning("failed to write %s", filename, exc_info=True)
+
+    def _own_file(self):
+        # made on the first flush of each process (a forked child included)
+        if self._pid == os.getpid():
+            return self._filename
+
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        token = binascii.hexlify(os.urandom(4)).decode("ascii")
+        base = os.path.join(self.directory, "{0}-{1}-{2}"
+                                .format(self.name, os.getpid(), token))
+
+        # held until the process exits: the fd is deliberately never closed
+        fd = os.open(base + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        self._pid = os.getpid()
+        self._filename = base + ".json"
+        return self._filename
+
+def init_app(app, name):
+    """
+    Time `app`'s requests (and their queries), reporting them as `name`
+
+    Must be called after :class:`utils.PostgreSQL` has been set up on `app`.
+    The collector is ``app.snowball_metrics``.
+    """
+
+    collector = Collector(name, app.config)
+    app.snowball_metrics = collector
+    app.snowball_postgresql.query_observer = _observe_query
+
+    # first, so that the other before_request functions are timed too
+    app.before_request_funcs.setdefault(None, []).insert(0, _start)
+    app.after_request(_status)
+    app.teardown_request(_finish)
+
+def _start():
+    flask.g._metrics = {"start": time.time(), "status": None,
+                        "queries": 0, "query_time": 0.0, "rows": 0,
+                        "locks": []}
+
+def lock_acquired(lock, wait, depth):
+    """
+    Note that the current request waited `wait` seconds for the advisory
+    lock `lock` (a name), behind `depth` others (``None`` if not measured)
+
+    The lock is assumed to be held until the end of the request. Outside
+    requests (or apps without :func:`init_app`) this does nothing.
+    """
+
+    if not flask.has_request_context():
+        return
+    m = getattr(flask.g, "_metrics", None)
+    if m is not None:
+        m["locks"].append({"lock": lock, "wait": wait, "depth": depth,
+                           "acquired": time.time()})
+
+def _observe_query(seconds, rows):
+    m = getattr(flask.g, "_metrics", None)
+    if m is not None:
+        m["queries"] += 1
+        m["query_time"] += seconds
+        m["rows"] += rows
+
+def _status(response):
+    m = getattr(flask.g, "_metrics", None)
+    if m is not None:
+        m["status"] = response.status_code
+    return response
+
+def _finish(exception):
+    m = getattr(flask.g, "_metrics", None)
+    if m is None:
+        return
+    del flask.g._metrics
+
+    status = m["status"]
+    if status is None:
+        status = 500
+
+    # teardown_request runs before teardown_appcontext, so the COMMIT (run
+    # by an after_request function, and which releases advisory xact locks)
+    # is included but returning the connection to the pool is not
+    end = time.time()
+    locks = [{"lock": lock["lock"], "wait": lock["wait"],
+              "depth": lock["depth"], "hold": end - lock["acquired"]}
+             for lock in m["locks"]]
+
+    collector = flask.current_app.snowball_metrics
+    collector.record(flask.request.endpoint or "none", status,
+                     end - m["start"], m["queries"], m["query_time"],
+                     m["rows"], locks)
+
+def read_all(directory):
+    """
+    Add up the files in `directory`
+
+    Returns ``{app name: data}``, where `data` is as
+    :meth:`Collector.snapshot`.
+
+    The files of processes that have died are added to `app`-dead.json and
+    removed, so that they do not pile up. (Readers take turns, so that none
+    sees a process counted twice, or not at all.) Temporary files and lock
+    files left behind by dead processes are removed after
+    :data:`stale_age`.
+    """
+
+    merged = {}
+    dead = {}
+    now = time.time()
+
+    fd = os.open(os.path.join(directory, _fold_lock),
+                 os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+
+        filenames = set(os.listdir(directory))
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            m = _file_re.match(filename)
+            if not m:
+                _prune(path, filenames, now)
+                continue
+
+            data = _read(path)
+            if data is None:
+                continue
+
+            app = merged.get(m.group("app"))
+            if app is None:
+                app = merged[m.group("app")] = _data()
+            _add_data(app, data, now)
+
+            pid = m.group("pid")
+            # lockf locks are per process: we cannot test our own
+            if pid is not None and int(pid) != os.getpid() and \
+                    _owner_dead(path[:-len(".json")] + ".lock"):
+                dead.setdefault(m.group("app"), []).append((path, data))
+
+        for app, files in dead.items():
+            _fold(directory, app, files, now)
+    finally:
+        # releases the lock
+        os.close(fd)
+
+    return merged
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        logger.warning("could not read %s", path, exc_info=True)
+        return None
+
+def _owner_dead(lock_path):
+    try:
+        fd = os.open(lock_path, os.O_RDWR)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return True
+        raise
+
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+    finally:
+        os.close(fd)
+
+    return True
+
+def _fold(directory, app, files, now):
+    """Add `files` (``[(path, data)]``) to `app`-dead.json, and remove them"""
+
+    filename = os.path.join(directory, app + "-dead.json")
+    temp_filename = filename + ".tmp"
+
+    total = _data()
+    if os.path.exists(filename):
+        data = _read(filename)
+        if data is None:
+            # rather than lose what it held
+            return
+        _add_data(total, data, now)
+
+    for path, data in files:
+        _add_data(total, data, now)
+
+    with open(temp_filename, "w") as f:
+        json.dump(total, f)
+    os.rename(temp_filename, filename)
+
+    for path, data in files:
+        os.unlink(path)
+        try:
+            os.unlink(path[:-len(".json")] + ".lock")
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    logger.info("folded %s dead %s metrics files", len(files), app)
+
+def _prune(path, filenames, now):
+    filename = os.path.basename(path)
+    is_lock = filename.endswith(".lock") and filename != _fold_lock
+
+    if is_lock:
+        # a process that died before writing its file, or in _fold
+        if filename[:-len(".lock")] + ".json" in filenames:
+            return
+    elif not filename.endswith(".tmp"):
+        return
+
+    try:
+        # old first: a live process creates its lock file, then locks it
+        if os.stat(path).st_mtime >= now - stale_age:
+            return
+        if is_lock and not _owner_dead(path):
+            return
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    logger.info("removed stale %s", filename)
+
+def _add_data(app, data, now):
+    for endpoint, stats in data["endpoints"].items():
+        total = app["endpoints"].get(endpoint)
+        if total is None:
+            total = app["endpoints"][endpoint] = _endpoint()
+        _add_endpoint(total, stats)
+
+    for lock, stats in data["locks"].items():
+        total = app["locks"].get(lock)
+        if total is None:
+            total = app["locks"][lock] = _lock()
+        for key in ("wait", "hold", "depth"):
+            _add_histogram(total[key], stats[key])
+
+    app["worst"] = _recent_worst(app["worst"] + data["worst"], now)
+
+def _add_histogram(total, histogram):
+    for i, n in enumerate(histogram["counts"]):
+        total["counts"][i] += n
+    total["sum"] += histogram["sum"]
+
+def _add_endpoint(total, stats):
+    for status, n in stats["requests"].items():
+        total["requests"][status] = total["requests"].get(status, 0) + n
+    for key in ("duration", "db"):
+        _add_histogram(total[key], stats[key])
+    total["queries"] += stats["queries"]
+    total["rows"] += stats["rows"]
+
+def _label(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') \
+                      .replace("\n", "\\n") + '"'
+
+def _labels(**labels):
+    return "{" + ",".join(key + "=" + _label(value)
+                          for key, value in sorted(labels.items())) + "}"
+
+def _render_histogram(lines, metric, histogram, bounds=buckets, **labels):
+    cumulative = 0
+    for bound, n in zip(bounds + ("+Inf", ), histogram["counts"]):
+        cumulative += n
+        le = bound if bound == "+Inf" else repr(float(bound))
+        lines.append("{0}_bucket{1} {2}".format(
+                metric, _labels(le=le, **labels), cumulative))
+    lines.append("{0}_sum{1} {2!r}".format(
+            metric, _labels(**labels), histogram["sum"]))
+    lines.append("{0}_count{1} {2}".format(
+            metric, _labels(**labels), cumulative))
+
+def render(merged):
+    """Render the result of :func:`read_all` in Prometheus' text format"""
+
+    lines = []
+
+    def header(metric, type, help):
+        lines.append("# HELP {0} {1}".format(metric, help))
+        lines.append("# TYPE {0} {1}".format(metric, type))
+
+    def each(key="endpoints"):
+        for app in sorted(merged):
+            for name in sorted(merged[app][key]):
+                yield app, name, merged[app][key][name]
+
+    header("snowball_requests_total", "counter",
+           "Requests, by endpoint and response status")
+    for app, endpoint, stats in each():
+        for status, n in sorted(stats["requests"].items()):
+            lines.append("snowball_requests_total{0} {1}".format(
+                    _labels(app=app, endpoint=endpoint, status=status), n))
+
+    header("snowball_request_duration_seconds", "histogram",
+           "Time from the start of the request to the end of its commit")
+    for app, endpoint, stats in each():
+        _render_histogram(lines, "snowball_request_duration_seconds",
+                          stats["duration"], app=app, endpoint=endpoint)
+
+    header("snowball_request_db_seconds", "histogram",
+           "Time spent executing queries, per request")
+    for app, endpoint, stats in each():
+        _render_histogram(lines, "snowball_request_db_seconds",
+                          stats["db"], app=app, endpoint=endpoint)
+
+    for key, help in (("queries", "Queries executed"),
+                      ("rows", "Rows returned or affected by queries")):
+        metric = "snowball_db_{0}_total".format(key)
+        header(metric, "counter", help)
+        for app, endpoint, stats in each():
+            lines.append("{0}{1} {2}".format(
+                    metric, _labels(app=app, endpoint=endpoint), stats[key]))
+
+    for key, type, help, bounds in \
+            (("wait", "seconds", "Time spent waiting for an advisory lock",
+              buckets),
+             ("hold", "seconds", "Time an advisory lock was held (until the "
+                                 "end of the request)", buckets),
+             ("queue_depth", None, "Requests already waiting for an "
+                                   "advisory lock when another asked for it "
+                                   "(a sample of requests)",
+              depth_buckets)):
+        metric = "snowball_lock_" + key
+        if type is not None:
+            metric += "_" + type
+        header(metric, "histogram", help)
+        for app, lock, stats in each("locks"):
+            _render_histogram(lines, metric,
+                              stats["depth" if key == "queue_depth" else key],
+                              bounds, app=app, lock=lock)
+
+    return "\n".join(lines) + "\n"
+
+def prometheus_text(app):
+    """
+    The statistics of every process sharing `app`'s ``METRICS_DIRECTORY``
+
+    Without one, just those of this process.
+    """
+
+    return render(_merged(app))
+
+def _merged(app):
+    collector = app.snowball_metrics
+    if collector.directory is None:
+        return {collector.name: collector.snapshot()}
+    else:
+        # our own latest requests, too
+        collector.flush()
+        return read_all(collector.directory)
+
+def worst_waits(app):
+    """
+    The longest lock waits of the last :data:`worst_window` seconds, across
+    every process sharing `app`'s ``METRICS_DIRECTORY``
+
+    Returns a list of dicts of ``app``, ``endpoint``, ``lock``, ``wait``,
+    ``hold``, ``depth`` and ``time`` (a UTC :class:`datetime.datetime`),
+    longest wait first.
+    """
+
+    waits = []
+    for data in _merged(app).values():
+        waits += data["worst"]
+    waits = _recent_worst(waits, time.time())
+
+    for wait in waits:
+        wait["time"] = datetime.datetime.utcfromtimestamp(wait["time"])
+    return waits
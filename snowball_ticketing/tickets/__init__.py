@@ -21,36 +21,61 @@
 from __future__ import unicode_literals
 
 import re
-from datetime import datetime
+import time
+import itertools
+from datetime import datetime, timedelta
 
 import flask
 from werkzeug.datastructures import ImmutableDict
 
-from .. import utils, queries
+from .. import utils, queries, metrics
 
 
 __all__ = ["available", "quotas_per_person_sentence", "none_min",
-           "counts", "prices", "settings", "tickets",
+           "counts", "sweep_expired", "verify_counts", "reap_expired",
+           "prices", "settings", "tickets",
            "BuyFailed", "InsufficientSpare", "QPPAnyMet", "QPPTypeMet",
            "FormRace", "IncorrectMode", "QuotaMet", "QuotaNotMet",
            "WaitingQuotaMet",
-           "buy", "buy_lock", "user_pg_lock", "set_quota_met",
+           "buy", "reserve", "buy_lock", "quota_locks", "user_pg_lock",
+           "set_quota_met",
            "FinaliseRace", "AlreadyFinalised", "NonExistantTicket",
-           "finalise", "outstanding_balance",
+           "finalise", "finalise_many", "outstanding_balance", "home_snapshot",
            "mark_paid", "purge_unpaid", "waiting_release"]
 
 
 logger = utils.getLogger("snowball_ticketing.tickets")
 
 buy_pg_lock_num = (0x123abc, 100)
+quota_pg_lock_num = 0x123abd
 user_pg_lock_num = 0x124000
 
+#: lock modes for :func:`buy`; see :func:`quota_locks` and :func:`reserve`
+buy_lock_modes = ("global", "quota", "reserve")
+
+#: one advisory lock acquisition in this many has its queue depth measured
+#: (counting ``pg_locks`` takes every lock manager partition lock)
+lock_depth_sample = 10
+
+# quota_locks() takes locks in this order, which must never change
+_quota_lock_order = tuple((who, what)
+                          for who in ('all', 'members', 'alumni')
+                          for what in ('any', 'standard', 'vip'))
+
 _null_settings_row = \
     ImmutableDict({"quota": None, "quota_met": None,
                    "waiting_quota": None, "waiting_quota_met": None,
                    "waiting_smallquota": None, "quota_per_person": None,
                    "mode": 'available'})
 
+# see settings(); (rows, compiled rules), replaced (never modified) when
+# tickets_settings changes. The rules dict is filled in lazily by _rules().
+_settings_cache = None
+_settings_generation = 0
+
+# see _advisory_xact_lock()
+_lock_depth_counter = itertools.count()
+
 
 def available(ticket_type, user_group=None, pg=utils.postgres):
     """
@@ -71,75 +96,117 @@ def available(ticket_type, user_group=None, pg=utils.postgres):
     if user_group is None:
         user_group = _user_group_from_user(flask.session["user"])
 
+    rules = _rules(user_group, ticket_type, pg=pg)
+    return _evaluate(rules, counts(pg=pg))
+
+def _rules(user_group, ticket_type, pg=utils.postgres):
+    """
+    Get the compiled rules (see :func:`_compile_rules`) for a user/ticket type
+
+    These are cached alongside :func:`settings`: for the whole process,
+    while the settings are, and otherwise for the request.
+    """
+
     s = settings(pg=pg)
-    c = counts(pg=pg)
+    key = (user_group, ticket_type)
+
+    if flask.current_app:
+        compiled = flask.g._snowball_tickets_rules
+    else:
+        compiled = {}
+
+    try:
+        return compiled[key]
+    except KeyError:
+        rules = compiled[key] = _compile_rules(s, user_group, ticket_type)
+        return rules
 
-    result = {}
+def _compile_rules(s, user_group, ticket_type):
+    """
+    Boil the settings rows in `s` that apply to a user/ticket type down
+
+    Returns a tuple ``(mode, qpp_any, qpp_type, checks)``. The first three
+    do not depend on counts, so are worked out now. `checks` has a tuple
+    ``(test, count_key, waiting_count_key, quota, quota_met, waiting_quota,
+    waiting_quota_met, waiting_smallquota)`` for each row that has any quota.
+    """
+
+    mode = 'available'
+    qpp_any = None
+    qpp_type = None
+    checks = []
+
+    for test in _test_keys(user_group, ticket_type):
+        limits = s.get(test, _null_settings_row)
+
+        mode = _mode_precedence(mode, limits["mode"])
+
+        qpp = limits["quota_per_person"]
+        if test[1] == 'any':
+            qpp_any = none_min(qpp_any, qpp)
+        else:
+            qpp_type = none_min(qpp_type, qpp)
+
+        quotas = (limits["quota"], limits["quota_met"],
+                  limits["waiting_quota"], limits["waiting_quota_met"],
+                  limits["waiting_smallquota"])
+
+        if quotas[0] is not None or quotas[2] is not None or \
+                quotas[4] is not None:
+            keys = ("{0}_{1}".format(*test), "waiting_{0}_{1}".format(*test))
+            checks.append((test, ) + keys + quotas)
+
+    return mode, qpp_any, qpp_type, tuple(checks)
+
+def _evaluate(rules, c):
+    """Work out :func:`available`'s result from `rules` and counts `c`"""
+
+    mode, qpp_any, qpp_type, checks = rules
 
-    overall_mode = 'available'
     overall_spare = None
     overall_quota_met = None
     overall_waiting_spare = None
     overall_waiting_quota_met = None
-    overall_qpp_type = None
-    overall_qpp_any = None
     waiting_small = None
 
-    for test in _test_keys(user_group, ticket_type):
-        limits = s.get(test, _null_settings_row)
-        mode = limits["mode"]
-        quota = limits["quota"]
-        quota_met = limits["quota_met"]
-        count = c["{0}_{1}".format(*test)]
-        waiting_quota = limits["waiting_quota"]
-        waiting_quota_met = limits["waiting_quota_met"]
-        waiting_smallquota = limits["waiting_smallquota"]
-        waiting_count = c["waiting_{0}_{1}".format(*test)]
-
-        overall_mode = _mode_precedence(overall_mode, mode)
+    for test, key, waiting_key, quota, quota_met, waiting_quota, \
+            waiting_quota_met, waiting_smallquota in checks:
 
         if quota is not None:
-            spare = quota - count
+            spare = quota - c[key]
             if spare <= 0 and not quota_met:
                 logger.warning("quota_met should be set: %r", test)
                 quota_met = True
 
             overall_quota_met = overall_quota_met or quota_met
-        else:
-            spare = None
+            if overall_spare is None or spare < overall_spare:
+                overall_spare = spare
 
         if waiting_quota is not None:
-            waiting_spare = waiting_quota - waiting_count
+            waiting_spare = waiting_quota - c[waiting_key]
             if waiting_spare <= 0 and not waiting_quota_met:
                 logger.warning("waiting_quota_met should be set: %r", test)
                 waiting_quota_met = True
 
             overall_waiting_quota_met = \
                     overall_waiting_quota_met or waiting_quota_met
-        else:
-            waiting_spare = None
-
-        overall_spare = none_min(overall_spare, spare)
-        overall_waiting_spare = none_min(overall_waiting_spare, waiting_spare)
+            if overall_waiting_spare is None or \
+                    waiting_spare < overall_waiting_spare:
+                overall_waiting_spare = waiting_spare
 
-        waiting_small = \
-                _waiting_smallquota_test(waiting_small, waiting_smallquota,
-                                         waiting_count)
+        # a row whose smallquota is not met overrides those whose are
+        # (think Order allow, deny)
+        if waiting_smallquota is not None and waiting_small is not False:
+            waiting_small = c[waiting_key] < waiting_smallquota
 
-        qpp = limits["quota_per_person"]
-        if test[1] == 'any':
-            overall_qpp_any = none_min(overall_qpp_any, qpp)
-        else:
-            overall_qpp_type = none_min(overall_qpp_type, qpp)
-
-    return {"mode": overall_mode,
+    return {"mode": mode,
             "spare": overall_spare,
             "quota_met": overall_quota_met,
             "waiting_spare": overall_waiting_spare,
             "waiting_quota_met": overall_waiting_quota_met,
             "waiting_small": waiting_small,
-            "qpp_any": overall_qpp_any,
-            "qpp_type": overall_qpp_type}
+            "qpp_any": qpp_any,
+            "qpp_type": qpp_type}
 
 def _test_keys(user_group, ticket_type):
     return ((user_group, ticket_type), (user_group, "any"),
@@ -161,24 +228,6 @@ def _mode_precedence(a, b):
     else:
         raise AssertionError
 
-def _waiting_smallquota_test(old_value, quota, waiting_count):
-    if old_value is False:
-        # another rule's smallquota was not met,
-        # which takes precedence (think Order allow, deny)
-        return False
-
-    if quota is None:
-        # no smallquota for this row
-        # None -> None; True -> True
-        return old_value
-
-    if waiting_count < quota:
-        # (None, True) -> True
-        return True
-    else:
-        # (None, True) -> False
-        return False
-
 def quotas_per_person_sentence(user_group=None, pg=utils.postgres):
     """
     Get the quotas-per-person sentence for `user_group` (or the current user)
@@ -219,6 +268,9 @@ def counts(drop_cache=False, pg=utils.postgres):
     Returns a dict, with keys
     ``{,waiting_}{all,members,alumni}_{any,standard,vip}`` and values being the
     respective counts
+
+    The counts come from the trigger-maintained ``tickets_counts`` table
+    rather than from scanning ``tickets``; see :func:`sweep_expired`.
     """
 
     if not drop_cache and flask.current_app and \
@@ -226,7 +278,7 @@ def counts(drop_cache=False, pg=utils.postgres):
         return flask.g._snowball_tickets_counts
 
     with pg.cursor(True) as cur:
-        cur.execute(queries.unexpired_counts)
+        cur.execute_prepared(queries.tickets_counts)
         c = cur.fetchone()
 
     if flask.current_app:
@@ -234,6 +286,94 @@ def counts(drop_cache=False, pg=utils.postgres):
 
     return c
 
+def sweep_expired(pg=utils.postgres):
+    """
+    Stop counting tickets that have expired
+
+    A ticket leaves ``tickets_counts`` when its row is next written after it
+    expires; until then :func:`counts` has to subtract it separately. This
+    touches those rows so that the set stays small, returning how many
+    were swept.
+
+    The ``tickets_counts`` rows are locked up front, in a fixed order, so
+    that this cannot deadlock against other writers.
+    """
+
+    with pg.cursor() as cur:
+        cur.execute("SELECT 1 FROM tickets_counts "
+                    "ORDER BY user_group, ticket_type, waiting_list "
+                    "FOR UPDATE")
+        cur.execute("UPDATE tickets SET counted = FALSE "
+                    "WHERE counted AND expires <= utcnow()")
+        swept = cur.rowcount
+
+    if swept:
+        logger.info("swept %s expired tickets", swept)
+    else:
+        logger.debug("no expired tickets to sweep")
+
+    return swept
+
+def verify_counts(pg=utils.postgres):
+    """
+    Compare :func:`counts` against a full scan of the tickets table
+
+    Returns a dict mapping each key that differs to
+    ``(counts value, scanned value)``; an empty dict means all is well.
+    """
+
+    with pg.cursor(True) as cur:
+        cur.execute_prepared(queries.tickets_counts)
+        counted = cur.fetchone()
+        cur.execute_prepared(queries.unexpired_counts)
+        scanned = cur.fetchone()
+
+    bad = dict((key, (counted[key], scanned[key]))
+               for key in scanned if counted[key] != scanned[key])
+
+    if bad:
+        logger.error("tickets_counts disagrees with tickets: %r", bad)
+
+    return bad
+
+def reap_expired(batch_size=500, older_than=timedelta(days=1),
+                 pg=utils.postgres):
+    """
+    Move up to `batch_size` long-expired tickets into ``tickets_expired``
+
+    Tickets that expired more than `older_than` ago are moved, whole
+    (notes and all); the ``tickets_history`` view shows both tables.
+    Tickets expired by ``admin-intervention`` are left alone, since admins
+    may yet revive them.
+
+    Returns the number moved; call repeatedly (committing in between)
+    until it returns less than `batch_size`. Like :func:`sweep_expired`,
+    the ``tickets_counts`` rows are locked first.
+    """
+
+    query = "WITH moved AS (" \
+                "DELETE FROM tickets WHERE ticket_id IN (" \
+                    "SELECT ticket_id FROM tickets " \
+                    "WHERE expires <= utcnow() - %s AND " \
+                    "      expires_reason != 'admin-intervention' " \
+                    "ORDER BY ticket_id LIMIT %s FOR UPDATE) " \
+                "RETURNING *) " \
+            "INSERT INTO tickets_expired SELECT *, utcnow() FROM moved"
+
+    with pg.cursor() as cur:
+        cur.execute("SELECT 1 FROM tickets_counts "
+                    "ORDER BY user_group, ticket_type, waiting_list "
+                    "FOR UPDATE")
+        cur.execute(query, (older_than, batch_size))
+        reaped = cur.rowcount
+
+    if reaped:
+        logger.info("moved %s expired tickets to tickets_expired", reaped)
+    else:
+        logger.debug("no expired tickets to reap")
+
+    return reaped
+
 def prices(user_group=None, pg=utils.postgres):
     """
     Gets ticket prices for `user_group` (or the current user)
@@ -269,29 +409,71 @@ def _user_group_from_user(user):
     else:
         return 'members'
 
-def settings(pg=utils.postgres):
-    """Retrieve (with caching) the rows of the tickets_settings table"""
+def settings(drop_cache=False, pg=utils.postgres):
+    """
+    Retrieve (with caching) the rows of the tickets_settings table
+
+    The rows are cached for the whole process while
+    :data:`utils.notifications` is listening, since a trigger on
+    tickets_settings NOTIFYs ``tickets_settings`` whenever it changes.
+    Each request gets its own copy (cached on :data:`flask.g`), which
+    :func:`set_quota_met` may modify. Rules compiled by :func:`available`
+    from the rows are cached in the same way.
+
+    If `drop_cache` is ``True`` the rows are re-read in the current
+    transaction, bypassing both caches; :func:`buy` does this having taken
+    its locks.
+    """
+
+    global _settings_cache
 
-    if flask.current_app and hasattr(flask.g, '_snowball_tickets_settings'):
+    if not drop_cache and flask.current_app and \
+            hasattr(flask.g, '_snowball_tickets_settings'):
         return flask.g._snowball_tickets_settings
 
-    key = ("who", "what")
+    listening = utils.notifications.listening
+    cached = _settings_cache
 
-    s = {}
-    with pg.cursor(True) as cur:
-        cur.execute("SELECT * FROM tickets_settings")
-        for row in cur:
-            row_key = tuple([row[k] for k in key])
-            s[row_key] = row
+    if not drop_cache and listening and cached is not None:
+        s, rules = cached
+    else:
+        generation = _settings_generation
+        key = ("who", "what")
+
+        s = {}
+        with pg.cursor(True) as cur:
+            cur.execute("SELECT * FROM tickets_settings")
+            for row in cur:
+                row_key = tuple([row[k] for k in key])
+                s[row_key] = row
+
+        rules = {}
+
+        # don't save it if it was invalidated while we were loading it
+        if not drop_cache and listening and \
+                generation == _settings_generation:
+            _settings_cache = (s, rules)
+
+    s = dict((row_key, dict(row)) for row_key, row in s.iteritems())
 
     if flask.current_app:
         flask.g._snowball_tickets_settings = s
+        flask.g._snowball_tickets_rules = rules
 
     return s
 
+def _invalidate_settings(payload):
+    """Drop the process-wide settings cache (a notification callback)"""
+    global _settings_cache, _settings_generation
+    logger.debug("tickets_settings changed (%s); dropping cache", payload)
+    _settings_cache = None
+    _settings_generation += 1
+
+utils.notifications.subscribe("tickets_settings", _invalidate_settings)
+
 def tickets(user_id=None, vip=None, waiting_list=None, quota_exempt=None,
             finalised=None, paid=None, entered_ball=None, expired=None,
-            pg=utils.postgres):
+            include_archived=False, pg=utils.postgres):
     """
     Return tickets for a user `user_id`, with filtering.
     
@@ -302,6 +484,9 @@ def tickets(user_id=None, vip=None, waiting_list=None, quota_exempt=None,
     For `expires`, ``False`` demands the expires column be null, or in the
     future; ``True`` wants a non-null timestamp in the past.
 
+    If `include_archived` is set, tickets moved to ``tickets_expired`` by
+    :func:`reap_expired` are included (with an ``archived`` key).
+
     If `user_id` is ``None``, the current session's user is used.
     """
 
@@ -321,11 +506,18 @@ def tickets(user_id=None, vip=None, waiting_list=None, quota_exempt=None,
     else:
         expires_cond = "TRUE"
 
+    if include_archived:
+        table = "tickets_history"
+    else:
+        table = "tickets"
+
     cond = " AND ".join(["user_id = %s", expires_cond, cond1, cond2])
-    query = "SELECT * FROM tickets WHERE " + cond
+    query = "SELECT * FROM " + table + " WHERE " + cond
 
+    # there are only a few dozen combinations of conditions, so the
+    # connection can keep each one prepared
     with pg.cursor(True) as cur:
-        cur.execute(query, (user_id, ))
+        cur.execute_prepared(query, (user_id, ))
         return cur.fetchall()
 
 def _nully_conditions(**kwargs):
@@ -416,12 +608,30 @@ class WaitingQuotaMet(QuotaMet):
     """The waiting quota has been met"""
 
 def buy(ticket_type, waiting_list, number, 
-        user=None, quota_exempt=False, pg=utils.postgres):
-    """Buy `user` `number` `ticket_type` tickets / add to waiting list."""
+        user=None, quota_exempt=False, lock_mode=None, pg=utils.postgres):
+    """
+    Buy `user` `number` `ticket_type` tickets / add to waiting list.
+
+    `lock_mode` is one of :data:`buy_lock_modes`: ``global`` takes
+    :func:`buy_lock`, ``quota`` takes :func:`quota_locks`, and ``reserve``
+    takes only the shared :func:`buy_lock` (which keeps out purchases made
+    with the global lock), leaving :func:`reserve` to decide in the
+    database. It defaults to the app's ``TICKETS_BUY_LOCK_MODE`` config,
+    or ``global``.
+    """
 
     if user is None:
         user = flask.session["user"]
 
+    if lock_mode is None:
+        if flask.current_app:
+            lock_mode = flask.current_app.config \
+                    .get("TICKETS_BUY_LOCK_MODE", "global")
+        else:
+            lock_mode = "global"
+
+    assert lock_mode in buy_lock_modes
+
     user_id = user["user_id"]
     user_group = _user_group_from_user(user)
 
@@ -433,35 +643,48 @@ def buy(ticket_type, waiting_list, number,
             .format(verb[0], number, ticket_type, user_id, user_group, verb[1])
 
     # automatically released, recursive
-    buy_lock(pg=pg)
+    if lock_mode == "global":
+        buy_lock(pg=pg)
+    elif lock_mode == "quota":
+        quota_locks(user_group, ticket_type, pg=pg)
+    else:
+        _advisory_xact_lock("buy_shared", buy_pg_lock_num, shared=True, pg=pg)
     user_pg_lock(user["user_id"], pg=pg)
 
     vip = ticket_type == 'vip'
+    prereserved = False
 
-    # force a re-count having acquired the lock
-    ticket_counts = counts(drop_cache=True, pg=pg)
+    if lock_mode == "reserve":
+        ticket_counts = None
 
-    if not quota_exempt:
-        avail = available(ticket_type, user_group=user_group, pg=pg)
+        if not quota_exempt:
+            # quotas per person are protected by the user lock, so the
+            # cached settings will do for them
+            mode, qpp_any, qpp_type, checks = \
+                    _rules(user_group, ticket_type, pg=pg)
+            _check_qpp(user_id, vip, number, qpp_any, qpp_type,
+                       log_prefix=log_prefix, pg=pg)
 
-        qpp_any_count = 0
-        qpp_type_count = 0
+            reserve(user_group, ticket_type, waiting_list, number,
+                    log_prefix=log_prefix, pg=pg)
+            prereserved = True
 
-        for ticket in tickets(user_id=user_id, expired=False,
-                              quota_exempt=False, pg=pg):
-            qpp_any_count += 1
-            if ticket["vip"] == vip:
-                qpp_type_count += 1
+            # any counts cached on flask.g are now out of date
+            if flask.current_app and \
+                    hasattr(flask.g, '_snowball_tickets_counts'):
+                del flask.g._snowball_tickets_counts
 
-        qpp_any = avail["qpp_any"]
-        qpp_type = avail["qpp_type"]
+    else:
+        # force a re-count and re-read of the settings having acquired the
+        # lock
+        ticket_counts = counts(drop_cache=True, pg=pg)
+        settings(drop_cache=True, pg=pg)
+
+    if not quota_exempt and not prereserved:
+        avail = available(ticket_type, user_group=user_group, pg=pg)
 
-        if qpp_any is not None:
-            if qpp_any < qpp_any_count + number:
-                raise QPPAnyMet
-        if qpp_type is not None:
-            if qpp_type < qpp_type_count + number:
-                raise QPPTypeMet
+        _check_qpp(user_id, vip, number, avail["qpp_any"], avail["qpp_type"],
+                   log_prefix=log_prefix, pg=pg)
 
         if avail["mode"] != "available":
             logger.info("%s: not available (form race)", log_prefix)
@@ -498,25 +721,27 @@ def buy(ticket_type, waiting_list, number,
 
     # else... OK. Make some tickets
     query = "INSERT INTO tickets (user_id, vip, waiting_list, price, "\
-            " created, expires, expires_reason, quota_exempt) "
+            " created, expires, expires_reason, quota_exempt, prereserved) "
     values_row = "(%(user_id)s, %(vip)s, %(waiting_list)s, %(price)s, " \
                  "utcnow(), utcnow() + '10 minutes'::interval, " \
-                 "'not-finalised', %(quota_exempt)s)"
+                 "'not-finalised', %(quota_exempt)s, %(prereserved)s)"
     values = ', '.join([values_row] * number)
     query += "VALUES " + values + " RETURNING ticket_id"
 
     price = prices(user_group=user_group, pg=pg)[ticket_type]
     args = {"user_id": user_id, "vip": vip, "waiting_list": waiting_list,
-            "price": price, "quota_exempt": quota_exempt}
+            "price": price, "quota_exempt": quota_exempt,
+            "prereserved": prereserved}
 
     # if :func:`counts` is cached on flask.g, this will update it
-    if waiting_list:
-        p = "waiting_{0}_{1}"
-    else:
-        p = "{0}_{1}"
+    if ticket_counts is not None:
+        if waiting_list:
+            p = "waiting_{0}_{1}"
+        else:
+            p = "{0}_{1}"
 
-    for test in _test_keys(user_group, ticket_type):
-        ticket_counts[p.format(*test)] += number
+        for test in _test_keys(user_group, ticket_type):
+            ticket_counts[p.format(*test)] += number
 
     with pg.cursor() as cur:
         cur.execute(query, args)
@@ -525,12 +750,164 @@ def buy(ticket_type, waiting_list, number,
     logger.info("%s: inserted tickets %r", log_prefix, ids)
     return ids
 
+def _check_qpp(user_id, vip, number, qpp_any, qpp_type, log_prefix=None,
+               pg=utils.postgres):
+    """Raise :class:`QPPAnyMet` or :class:`QPPTypeMet` if apt."""
+
+    qpp_any_count = 0
+    qpp_type_count = 0
+
+    for ticket in tickets(user_id=user_id, expired=False,
+                          quota_exempt=False, pg=pg):
+        qpp_any_count += 1
+        if ticket["vip"] == vip:
+            qpp_type_count += 1
+
+    if qpp_any is not None:
+        if qpp_any < qpp_any_count + number:
+            if log_prefix is not None:
+                logger.info("%s: quota per person met (any)", log_prefix)
+            raise QPPAnyMet
+    if qpp_type is not None:
+        if qpp_type < qpp_type_count + number:
+            if log_prefix is not None:
+                logger.info("%s: quota per person met (type)", log_prefix)
+            raise QPPTypeMet
+
+def reserve(user_group, ticket_type, waiting_list, number, log_prefix=None,
+            pg=utils.postgres):
+    """
+    Reserve places for `number` tickets, without taking any quota lock
+
+    The ``tickets_reserve`` database function checks each quota that
+    applies against the ``tickets_counts`` rows under it (less tickets that
+    have expired but not yet been swept), and adds `number` to the ticket's
+    own row, so whether there is space is decided by the database in one
+    statement. Only the counter rows under those quotas are locked (until
+    the end of the transaction). The tickets must then be inserted with
+    ``prereserved`` set; a reservation is released when its ticket expires,
+    as with any other counted ticket.
+
+    Raises the same exceptions as :func:`buy` would; as there,
+    :func:`set_quota_met` is called if a quota is met or would be exceeded.
+    """
+
+    if log_prefix is None:
+        log_prefix = "reserving {0} {1} places for {2}" \
+                .format(number, ticket_type, user_group)
+
+    with pg.cursor() as cur:
+        cur.execute("SELECT tickets_reserve(%s, %s, %s, %s)",
+                    (user_group, ticket_type, waiting_list, number))
+        status = cur.fetchone()[0]
+
+    if status in ("met", "insufficient-spare"):
+        # set_quota_met needs to see the state of the database
+        counts(drop_cache=True, pg=pg)
+        settings(drop_cache=True, pg=pg)
+
+    if status == "ok":
+        return
+
+    elif status == "met":
+        # the reserved places are already in the counts
+        logger.info("%s: exactly met quota", log_prefix)
+        set_quota_met(user_group, ticket_type, waiting_list, 0, pg=pg)
+
+    elif status == "insufficient-spare":
+        logger.info("%s: insufficient spare", log_prefix)
+        set_quota_met(user_group, ticket_type, waiting_list, number, pg=pg)
+        raise InsufficientSpare
+
+    elif status == "quota-met":
+        logger.info("%s: quota met (form race)", log_prefix)
+        if waiting_list:
+            raise WaitingQuotaMet
+        else:
+            raise QuotaMet
+
+    elif status == "quota-not-met":
+        logger.info("%s: wanted waiting list but quota not met (form race)",
+                    log_prefix)
+        raise QuotaNotMet
+
+    elif status == "incorrect-mode":
+        logger.info("%s: not available (form race)", log_prefix)
+        raise IncorrectMode
+
+    else:
+        raise AssertionError("tickets_reserve returned " + status)
+
+def _advisory_xact_lock(name, keys, shared=False, pg=utils.postgres):
+    """
+    Take out a transaction level postgres advisory lock on `keys` (two ints)
+
+    The wait, and how many were already waiting, are passed to
+    :func:`metrics.lock_acquired` as lock `name`. A free lock costs a single
+    ``pg_try_advisory_xact_lock``. The depth is only measured (from
+    ``pg_locks``, if that fails) for one acquisition in
+    :data:`lock_depth_sample`, and is ``None`` for the rest.
+    """
+
+    mode = "_shared" if shared else ""
+    sampled = next(_lock_depth_counter) % lock_depth_sample == 0
+    depth = 0 if sampled else None
+
+    with pg.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_xact_lock" + mode + "(%s, %s)",
+                    keys)
+        if cur.fetchone()[0]:
+            metrics.lock_acquired(name, 0.0, depth)
+            return 0.0, depth
+
+        if sampled:
+            # two int4 keys are stored as classid, objid; objsubid 2
+            cur.execute("SELECT count(*) FROM pg_locks "
+                        "WHERE locktype = 'advisory' AND NOT granted AND "
+                        "classid = %s::oid AND objid = %s::oid AND "
+                        "objsubid = 2", keys)
+            depth = cur.fetchone()[0]
+
+        start = time.time()
+        cur.execute("SELECT pg_advisory_xact_lock" + mode + "(%s, %s)", keys)
+        wait = time.time() - start
+
+    metrics.lock_acquired(name, wait, depth)
+    return wait, depth
+
 def buy_lock(pg=utils.postgres):
     """Take out the transaction level postgres advisory lock for buying"""
     logger.debug("Acquiring buy lock")
-    with pg.cursor() as cur:
-        cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", buy_pg_lock_num)
-    logger.debug("buy lock acquired")
+    wait, depth = _advisory_xact_lock("buy", buy_pg_lock_num, pg=pg)
+    logger.debug("buy lock acquired (waited %.3fs behind %s)", wait, depth)
+
+def quota_locks(user_group, ticket_type, pg=utils.postgres):
+    """
+    Take out the transaction level postgres advisory locks for buying
+
+    Rather than serialising every purchase with :func:`buy_lock`, this
+    locks only those tickets_settings rows in
+    ``_test_keys(user_group, ticket_type)`` that have a quota, so purchases
+    against disjoint quotas may proceed concurrently. (Note that with a
+    quota on ``all``/``any``, nothing is disjoint.)
+
+    Locks are always taken in the order of ``_quota_lock_order``, so cannot
+    deadlock. :func:`buy_lock` is also taken, in shared mode, so that
+    purchases made with the global lock still exclude these.
+    """
+
+    s = settings(drop_cache=True, pg=pg)
+    tests = set(test for test in _test_keys(user_group, ticket_type)
+                if s.get(test, _null_settings_row)["quota"] is not None)
+    nums = [i for i, test in enumerate(_quota_lock_order) if test in tests]
+
+    logger.debug("Acquiring quota locks %r", nums)
+    _advisory_xact_lock("buy_shared", buy_pg_lock_num, shared=True, pg=pg)
+    for num in nums:
+        who, what = _quota_lock_order[num]
+        _advisory_xact_lock("quota_{0}_{1}".format(who, what),
+                            (quota_pg_lock_num, num), pg=pg)
+    logger.debug("quota locks acquired")
 
 def user_pg_lock(user_id, pg=utils.postgres):
     """
@@ -540,10 +917,10 @@ def user_pg_lock(user_id, pg=utils.postgres):
     :func:`receipt.send_update`.
     """
     logger.debug("Acquiring user %s lock", user_id)
-    with pg.cursor() as cur:
-        cur.execute("SELECT pg_advisory_xact_lock(%s, %s)",
-                    (user_pg_lock_num, user_id))
-    logger.debug("user %s lock acquired", user_id)
+    wait, depth = _advisory_xact_lock("user", (user_pg_lock_num, user_id),
+                                      pg=pg)
+    logger.debug("user %s lock acquired (waited %.3fs behind %s)",
+                 user_id, wait, depth)
 
 def set_quota_met(user_group, ticket_type, waiting_list, number,
                   pg=utils.postgres):
@@ -567,6 +944,46 @@ def set_quota_met(user_group, ticket_type, waiting_list, number,
     s = settings(pg=pg)
     c = counts(pg=pg)
 
+    # if `s` came from or was saved to the cache on flask.g, this will
+    # update it.
+    rows_quota_met, rows_waiting_quota_met = \
+            _quota_met_rows(s, c, user_group, ticket_type, waiting_list, number)
+
+    for test in rows_quota_met:
+        logger.warning("quota met: %r", test)
+    for test in rows_waiting_quota_met:
+        logger.warning("waiting quota met: %r", test)
+
+    if (rows_quota_met or rows_waiting_quota_met) and flask.current_app:
+        # `s` no longer matches the rules compiled from it, which may be
+        # shared with other requests: start afresh
+        flask.g._snowball_tickets_rules = {}
+
+    if rows_quota_met:
+        logger.info("set_quota_met: setting quota_met on rows %r", rows_quota_met)
+
+        with pg.cursor() as cur:
+            cur.execute("UPDATE tickets_settings SET quota_met = TRUE "
+                        "WHERE (who, what) IN %s", (tuple(rows_quota_met), ))
+
+    if rows_waiting_quota_met:
+        logger.info("set_quota_met: setting waiting_quota_met on rows %r",
+                    rows_waiting_quota_met)
+
+        with pg.cursor() as cur:
+            cur.execute("UPDATE tickets_settings SET waiting_quota_met = TRUE "
+                        "WHERE (who, what) IN %s",
+                        (tuple(rows_waiting_quota_met), ))
+
+def _quota_met_rows(s, c, user_group, ticket_type, waiting_list, number):
+    """
+    Work out which quotas are met by adding `number` tickets to counts `c`
+
+    Sets ``quota_met``/``waiting_quota_met`` in the settings rows `s`, and
+    returns two lists of the ``(who, what)`` keys of the rows changed. See
+    :func:`set_quota_met`.
+    """
+
     rows_quota_met = []
     rows_waiting_quota_met = []
 
@@ -581,12 +998,7 @@ def set_quota_met(user_group, ticket_type, waiting_list, number,
 
             if quota is not None and not limits["quota_met"] and \
                     count + number >= quota:
-
-                logger.warning("quota met: %r", test)
                 rows_quota_met.append(test)
-
-                # if `s` came from or was saved to the cache on flask.g,
-                # this will update it.
                 s.get(test, {})["quota_met"] = True
 
                 # now check if the waiting quota has been met; it could happen
@@ -603,26 +1015,10 @@ def set_quota_met(user_group, ticket_type, waiting_list, number,
 
             if quota is not None and not limits["waiting_quota_met"] and \
                     count + number2 >= quota:
-
-                logger.warning("waiting quota met: %r", test)
                 rows_waiting_quota_met.append(test)
                 s.get(test, {})["waiting_quota_met"] = True
 
-    if rows_quota_met:
-        logger.info("set_quota_met: setting quota_met on rows %r", rows_quota_met)
-
-        with pg.cursor() as cur:
-            cur.execute("UPDATE tickets_settings SET quota_met = TRUE "
-                        "WHERE (who, what) IN %s", (tuple(rows_quota_met), ))
-
-    if rows_waiting_quota_met:
-        logger.info("set_quota_met: setting waiting_quota_met on rows %r",
-                    rows_waiting_quota_met)
-
-        with pg.cursor() as cur:
-            cur.execute("UPDATE tickets_settings SET waiting_quota_met = TRUE "
-                        "WHERE (who, what) IN %s",
-                        (tuple(rows_waiting_quota_met), ))
+    return rows_quota_met, rows_waiting_quota_met
 
 class FinaliseRace(Exception):
     """A race condition occured in :func:`finalise`"""
@@ -642,6 +1038,13 @@ class AlreadyFinalised(FinaliseRace):
 class NonExistantTicket(FinaliseRace):
     """The ticket does not exist"""
 
+# columns that finalise() may update, and their types (for finalise_many)
+_finalise_columns = (("person_type", "person_type"),
+                     ("surname", "varchar"),
+                     ("othernames", "varchar"),
+                     ("college_id", "integer"),
+                     ("matriculation_year", "integer"))
+
 def finalise(ticket, update, pg=utils.postgres):
     """
     Finalise a ticket
@@ -661,48 +1064,104 @@ def finalise(ticket, update, pg=utils.postgres):
     :class:`NonExistantTicket` will be raised and `ticket` won't be modified.
 
     If the ticket was already finalised, :class:`AlreadyFinalised` is raised.
+
+    See also :func:`finalise_many`.
+    """
+
+    failed = finalise_many([(ticket, update)], pg=pg)
+    if ticket["ticket_id"] in failed:
+        raise failed[ticket["ticket_id"]]
+
+def finalise_many(tickets_updates, pg=utils.postgres):
     """
+    Finalise several tickets at once
 
-    assert ticket["finalised"] is None
-    assert set(update) <= {"person_type", "surname", "othernames",
-                           "college_id", "matriculation_year"}
+    `tickets_updates` is a list of ``(ticket, update)`` pairs, as would be
+    passed to :func:`finalise`. All the tickets are updated with a single
+    ``UPDATE``, and successfully finalised tickets are modified in place.
 
-    logger.debug("finalising ticket %s", ticket["ticket_id"])
+    Returns a dict mapping the ``ticket_id`` of each ticket that could
+    not be finalised to an :class:`AlreadyFinalised` or
+    :class:`NonExistantTicket` instance (the exception :func:`finalise`
+    would have raised), which is empty if all went well.
+    """
 
-    # protects against races with receipt
-    user_pg_lock(ticket["user_id"], pg=pg)
+    if not tickets_updates:
+        return {}
 
-    update = update.copy()
-    # special case finalise to use utcnow()
-    update["expires"] = None
-    update["expires_reason"] = None
+    columns = [column for column, column_type in _finalise_columns]
+    by_id = {}
+
+    for ticket, update in tickets_updates:
+        assert ticket["finalised"] is None
+        assert set(update) <= set(columns)
+        by_id[ticket["ticket_id"]] = ticket
 
-    sets = ', '.join("{0} = %({0})s".format(key) for key in update)
+    logger.debug("finalising tickets %r", sorted(by_id))
 
+    # protects against races with receipt
+    for user_id in sorted(set(t["user_id"] for t, u in tickets_updates)):
+        user_pg_lock(user_id, pg=pg)
+
+    # each column is only set for those tickets whose update includes it
+    row = ["%s::integer"]
+    for column, column_type in _finalise_columns:
+        row.append("%s::boolean")
+        row.append("%s::" + column_type)
+    row = "(" + ", ".join(row) + ")"
+
+    values = []
+    args = []
+    for ticket, update in tickets_updates:
+        values.append(row)
+        args.append(ticket["ticket_id"])
+        for column in columns:
+            args.append(column in update)
+            args.append(update.get(column))
+
+    names = ["ticket_id"]
+    sets = []
+    for column in columns:
+        names += ["set_" + column, column]
+        sets.append("{0} = CASE WHEN v.set_{0} THEN v.{0} "
+                    "ELSE tickets.{0} END".format(column))
+
+    # special case finalise to use utcnow()
     query1 = "UPDATE tickets " \
-             "SET finalised = utcnow(), " + sets + " " \
-             "WHERE ticket_id = %(ticket_id)s AND finalised IS NULL " \
-             "RETURNING *"
-    query2 = "SELECT * FROM tickets WHERE ticket_id = %s"
+             "SET finalised = utcnow(), expires = NULL, " \
+                 "expires_reason = NULL, " + ', '.join(sets) + " " \
+             "FROM (VALUES " + ', '.join(values) + ") " \
+                 "AS v (" + ', '.join(names) + ") " \
+             "WHERE tickets.ticket_id = v.ticket_id AND finalised IS NULL " \
+             "RETURNING tickets.*"
+    query2 = "SELECT * FROM tickets WHERE ticket_id IN %s"
 
-    args = update
-    args["ticket_id"] = ticket["ticket_id"]
+    failed = {}
 
     with pg.cursor(True) as cur:
         cur.execute(query1, args)
-        assert cur.rowcount in (0, 1)
+        finalised = []
+        for new_ticket in cur.fetchall():
+            by_id.pop(new_ticket["ticket_id"]).update(new_ticket)
+            finalised.append(new_ticket["ticket_id"])
 
-        if cur.rowcount == 1:
-            # success
-            ticket.update(cur.fetchone())
-        else:
+        # at info level, so that it reaches the log table (see replay)
+        if finalised:
+            logger.info("finalised tickets %r", sorted(finalised))
+
+        if by_id:
             # some race
-            cur.execute(query2, (ticket["ticket_id"], ))
-            assert cur.rowcount in (0, 1)
-            if cur.rowcount == 1:
-                raise AlreadyFinalised(cur.fetchone())
-            else:
-                raise NonExistantTicket
+            cur.execute(query2, (tuple(by_id), ))
+            for new_ticket in cur:
+                failed[new_ticket["ticket_id"]] = AlreadyFinalised(new_ticket)
+            for ticket_id in by_id:
+                if ticket_id not in failed:
+                    failed[ticket_id] = NonExistantTicket()
+
+    if failed:
+        logger.debug("failed to finalise tickets %r", sorted(failed))
+
+    return failed
 
 _reference_first_cleaner = re.compile("[^a-zA-Z0-9]")
 
@@ -741,6 +1200,41 @@ def outstanding_balance(user_id=None, ids_too=False, pg=utils.postgres):
     else:
         return bal
 
+def home_snapshot(user=None, pg=utils.postgres):
+    """
+    Everything :func:`snowball_ticketing.tickets.views.home` needs
+
+    Returns a dict with keys ``available`` (``{'standard': ...,
+    'vip': ...}``, see :func:`available`), ``tickets`` (the unexpired
+    tickets of `user`, or the current user), ``prices``, ``mode_sentence``,
+    ``qpp_sentence`` and ``outstanding_balance``.
+
+    Only two queries are made: :func:`counts` and :func:`tickets`; the rest
+    comes from :func:`settings` (cached) or is derived from the tickets,
+    which include all finalised tickets, since those never expire.
+    """
+
+    if user is None:
+        user = flask.session["user"]
+
+    user_group = _user_group_from_user(user)
+
+    avail = dict((t, available(t, user_group=user_group, pg=pg))
+                 for t in ('standard', 'vip'))
+    ts = tickets(user_id=user["user_id"], expired=False, pg=pg)
+
+    # as outstanding_balance()
+    balance = sum(t["price"] for t in ts
+                  if t["finalised"] is not None and t["paid"] is None and
+                     not t["waiting_list"])
+
+    return {"available": avail,
+            "tickets": ts,
+            "prices": prices(user_group=user_group, pg=pg),
+            "mode_sentence": mode_sentence(pg=pg),
+            "qpp_sentence": quotas_per_person_sentence(user_group, pg=pg),
+            "outstanding_balance": balance}
+
 def mark_paid(ticket_ids, add_note="", pg=utils.postgres):
     """Mark each of `ticket_ids` paid, optionally adding to `notes`"""
 
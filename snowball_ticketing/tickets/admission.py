@@ -0,0 +1,161 @@
+# Copyright 2013 Daniel Richman
+#
+# This file is part of The Snowball Ticketing System.
+#
+# The Snowball Ticketing System is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# The Snowball Ticketing System is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with The Snowball Ticketing System.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+admission - the launch-day waiting room
+
+When the all/any mode flips to ``available`` everyone arrives at once, and
+every worker ends up waiting on the buy lock. If ``TICKETS_ADMISSION_RATE``
+(users per minute) is configured, users must first be admitted: the first
+time a user hits the tickets blueprint they are given an ``admit_at``
+time, spaced ``1 / rate`` minutes after the last one handed out, and are
+shown a polling page (see :func:`views.queue`) until then. A rate of 0
+closes the queue: places already handed out are honoured, but no new ones
+are given until the rate is raised.
+
+Once admitted, a user may use the tickets pages for
+``TICKETS_ADMISSION_WINDOW`` minutes (default 60), after which they queue
+again. Nothing here touches the tickets table.
+"""
+
+from __future__ import unicode_literals, division
+
+from datetime import timedelta
+
+import flask
+from flask import session, request, redirect, url_for
+
+from .. import utils, tickets
+
+
+__all__ = ["rate", "window", "enabled", "position", "check"]
+
+
+logger = utils.getLogger("snowball_ticketing.tickets.admission")
+
+admission_pg_lock_num = 0x123abe
+
+#: endpoints in the tickets blueprint that never make the user queue
+exempt_endpoints = frozenset(["tickets.terms", "tickets.queue",
+                              "tickets.hide_instructions"])
+
+
+def rate():
+    """
+    Users admitted per minute, or ``None`` if there is no waiting room
+
+    0 means the queue is closed to newcomers.
+    """
+    return flask.current_app.config.get("TICKETS_ADMISSION_RATE")
+
+def window():
+    """How long an admitted user may use the tickets pages"""
+    minutes = flask.current_app.config.get("TICKETS_ADMISSION_WINDOW", 60)
+    return timedelta(minutes=minutes)
+
+def enabled(pg=utils.postgres):
+    """Is the waiting room configured, and are tickets (all/any) on sale?"""
+    if rate() is None:
+        return False
+    row = tickets.settings(pg=pg).get(("all", "any"))
+    return row is not None and row["mode"] == "available"
+
+def position(user_id, pg=utils.postgres):
+    """
+    Get (or give) `user_id` a place in the queue
+
+    Returns a dict with keys ``admitted`` (bool), ``wait`` (seconds,
+    if not admitted) and ``ahead`` (roughly how many users are in front).
+    If the queue is closed (:func:`rate` is 0) and the user has no current
+    place, ``wait`` and ``ahead`` are ``None``.
+
+    A user without a place, or whose window has passed, is put at the back
+    of the queue in a :meth:`utils.PostgreSQL.separate_transaction`, so
+    that the new place survives whatever happens to the rest of this
+    request (and the request's own transaction is left alone).
+    """
+
+    # extract() gives a numeric (a Decimal) on PostgreSQL 14 and later
+    query1 = "SELECT admit_at <= utcnow() AS admitted, " \
+                    "admit_at + %s < utcnow() AS stale, " \
+                    "extract(epoch FROM admit_at - utcnow())::float8 " \
+                        "AS wait " \
+             "FROM admission_queue WHERE user_id = %s"
+    query2 = "SELECT pg_advisory_xact_lock(%s)"
+    query3 = "SELECT GREATEST(utcnow(), MAX(admit_at) + %s) " \
+             "FROM admission_queue"
+    query4 = "UPDATE admission_queue " \
+             "SET joined = utcnow(), admit_at = %s WHERE user_id = %s"
+    query5 = "INSERT INTO admission_queue (user_id, joined, admit_at) " \
+             "VALUES (%s, utcnow(), %s)"
+
+    r = rate()
+    args1 = (window(), user_id)
+
+    with pg.cursor(True) as cur:
+        cur.execute(query1, args1)
+        row = cur.fetchone()
+
+    if row is None or row["stale"]:
+        with pg.separate_transaction() as conn, conn.cursor(True) as cur:
+            cur.execute(query2, (admission_pg_lock_num, ))
+
+            # someone may have queued us while we waited for the lock
+            cur.execute(query1, args1)
+            row = cur.fetchone()
+
+            if (row is None or row["stale"]) and r <= 0:
+                logger.debug("queue closed; not queueing user %s", user_id)
+                return {"admitted": False, "wait": None, "ahead": None}
+
+            if row is None or row["stale"]:
+                cur.execute(query3, (timedelta(seconds=60 / r), ))
+                admit_at = cur.fetchone()["greatest"]
+
+                if row is None:
+                    cur.execute(query5, (user_id, admit_at))
+                else:
+                    cur.execute(query4, (admit_at, user_id))
+
+                logger.info("user %s queued; admit at %s", user_id, admit_at)
+
+                cur.execute(query1, args1)
+                row = cur.fetchone()
+
+    if row["admitted"]:
+        return {"admitted": True, "wait": None, "ahead": 0}
+    else:
+        wait = max(row["wait"], 0)
+        return {"admitted": False, "wait": wait,
+                "ahead": int(wait * max(r, 0) / 60)}
+
+def check():
+    """
+    :meth:`flask.Blueprint.before_request` function for the tickets pages
+
+    Redirects users who have not been admitted to the queue page. Users
+    without a session are left to :func:`utils.requires_session`.
+    """
+
+    if request.endpoint in exempt_endpoints or not session.ok:
+        return None
+    if not enabled():
+        return None
+
+    if not position(session["user_id"])["admitted"]:
+        return redirect(url_for("tickets.queue"))
@@ -21,7 +21,6 @@
 from __future__ import unicode_literals
 
 from datetime import datetime, timedelta
-import psycopg2
 
 from .. import tickets, utils, users, queries
 
@@ -34,8 +33,7 @@ logger = utils.getLogger(__name__)
 
 def receipts_main(postgres_settings):
     """Setup a connection and run :func:`update_all`"""
-    conn = psycopg2.connect(connection_factory=utils.PostgreSQLConnection,
-                            **postgres_settings)
+    conn = utils.budget_connect(postgres_settings, "scripts")
     try:
         update_all(conn)
     except Exception:
@@ -58,7 +56,7 @@ def needs_update(pg):
     """
 
     with pg.cursor() as cur:
-        cur.execute(queries.needs_receipt)
+        cur.execute_prepared(queries.needs_receipt)
         rows = cur.fetchall()
 
     # don't hold the transaction open!
@@ -0,0 +1,412 @@
+# Copyright 2013 Daniel Richman
+#
+# This file is part of The Snowball Ticketing System.
+#
+# The Snowball Ticketing System is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# The Snowball Ticketing System is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with The Snowball Ticketing System.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+replay - rerun a sale from the log table against other settings
+
+:func:`tickets.buy`, :func:`tickets.finalise_many`,
+:func:`tickets.purge_unpaid` and :func:`tickets.waiting_release` log what
+they did (at info level, so it reaches the ``log`` table). :func:`parse`
+turns those messages back into events, and :func:`replay` reruns them
+against an in-memory model of the counts and of the checks in
+:func:`tickets.buy`, using whatever ``tickets_settings`` rows you like.
+The database is not touched, so a season's log replays in seconds.
+
+The model:
+
+* each purchase attempt is made again at the same time, by the same user,
+  for the same number and type of tickets. Whether it goes on the waiting
+  list is decided afresh, as the tickets page would: it does if the quota
+  has been met.
+* tickets bought both in the log and in the replay keep their ticket ids
+  and follow their logged fate: finalised, expired (if not finalised
+  within `expire_after`), purged or released from the waiting list.
+* tickets bought only in the replay are assumed to be finalised, and their
+  buyer not to try again: their attempts at the same type within
+  `retry_window` are dropped.
+
+Attempts turned away before reaching :func:`tickets.buy` (say, by the
+buttons on the tickets page) are not in the log, and quota exempt
+purchases are treated like any other.
+"""
+
+from __future__ import unicode_literals
+
+import re
+import csv
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from collections import Counter, defaultdict
+
+from .. import utils, tickets
+
+
+__all__ = ["parse", "read_log", "read_csv", "make_settings", "replay"]
+
+
+_buy_re = re.compile(r"^(?:buying|adding) (\d+) (standard|vip) tickets "
+                     r"for user (\d+) \((members|alumni)\)"
+                     r"(?: to the waiting list)?: (.*)$")
+_finalised_re = re.compile(r"^finalised tickets \[(.*)\]$")
+_purge_re = re.compile(r"^Purging ticket (\d+) \(not-paid\)$")
+_release_re = re.compile(r"^Releasing tickets \[(.*)\] from waiting list$")
+_ids_re = re.compile(r"\d+")
+
+# buy() outcomes, by the start of the message after the log prefix
+_buy_outcomes = (("inserted tickets", None),
+                 ("not available", "not-available"),
+                 ("wanted waiting list", "quota-not-met"),
+                 ("quota met", "quota-met"),
+                 ("insufficient spare", "insufficient-spare"),
+                 ("quota per person met (any)", "qpp-any"),
+                 ("quota per person met (type)", "qpp-type"))
+
+_count_keys = tuple("{0}{1}_{2}".format(prefix, who, what)
+                    for prefix in ("", "waiting_")
+                    for who in ("all", "members", "alumni")
+                    for what in ("any", "standard", "vip"))
+
+
+def _ids(text):
+    return [int(x) for x in _ids_re.findall(text)]
+
+def parse(rows):
+    """
+    Turn ``(created, message)`` rows from the log table into events
+
+    Returns a list of ``(time, kind, data)`` tuples in time order, where
+    `kind` is one of:
+
+    * ``buy``: `data` is a dict with keys ``user_id``, ``user_group``,
+      ``ticket_type``, ``number``, ``waiting_list``, ``ticket_ids``
+      (``None`` if it failed) and ``reason`` (why, if it did)
+    * ``finalise``, ``release``: `data` is a list of ticket ids
+    * ``purge``: `data` is a ticket id
+
+    Other messages are ignored.
+    """
+
+    events = []
+
+    for created, message in rows:
+        m = _buy_re.match(message)
+        if m:
+            number, ticket_type, user_id, user_group, outcome = m.groups()
+
+            for start, reason in _buy_outcomes:
+                if outcome.startswith(start):
+                    break
+            else:
+                # e.g., "exactly met quota", which precedes "inserted"
+                continue
+
+            if reason is None:
+                ticket_ids = _ids(outcome[len(start):])
+            else:
+                ticket_ids = None
+
+            events.append((created, "buy", {
+                "user_id": int(user_id), "user_group": user_group,
+                "ticket_type": ticket_type, "number": int(number),
+                "waiting_list": message.startswith("adding"),
+                "ticket_ids": ticket_ids, "reason": reason}))
+            continue
+
+        m = _finalised_re.match(message)
+        if m:
+            events.append((created, "finalise", _ids(m.group(1))))
+            continue
+
+        m = _purge_re.match(message)
+        if m:
+            events.append((created, "purge", int(m.group(1))))
+            continue
+
+        m = _release_re.match(message)
+        if m:
+            events.append((created, "release", _ids(m.group(1))))
+            continue
+
+    # stable, so log order is kept for events with the same timestamp
+    events.sort(key=lambda e: e[0])
+    return events
+
+def read_log(since=None, until=None, pg=utils.postgres):
+    """Read the :func:`parse`-able rows of the log table"""
+
+    conditions = ["logger = 'snowball_ticketing.tickets'", "level = 'info'"]
+    args = []
+    if since is not None:
+        conditions.append("created >= %s")
+        args.append(since)
+    if until is not None:
+        conditions.append("created < %s")
+        args.append(until)
+
+    query = "SELECT created, message FROM log " \
+            "WHERE " + " AND ".join(conditions) + " ORDER BY record_id"
+
+    with pg.cursor() as cur:
+        cur.execute(query, args)
+        return cur.fetchall()
+
+def _parse_time(text):
+    for format in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(text, format)
+        except ValueError:
+            pass
+    raise ValueError("bad timestamp: " + text)
+
+def read_csv(f):
+    """
+    Read rows exported from the log table as CSV
+
+    That is, the output of::
+
+        \\copy (SELECT created, message FROM log
+               WHERE logger = 'snowball_ticketing.tickets' AND level = 'info'
+               ORDER BY record_id) TO 'sale.csv' CSV
+    """
+
+    for created, message in csv.reader(f):
+        yield _parse_time(created), message.decode("utf-8")
+
+def make_settings(rows):
+    """
+    Build a complete set of settings rows, as :func:`tickets.settings` would
+
+    `rows` maps ``(who, what)`` to a dict of some of the columns of that
+    row; the rest default to no limits, nothing met, and mode
+    ``available``.
+    """
+
+    s = {}
+    for key, row in rows.iteritems():
+        full = dict(tickets._null_settings_row)
+        full.update(row)
+        if full["quota"] is not None and full["quota_met"] is None:
+            full["quota_met"] = False
+        if full["waiting_quota"] is not None and \
+                full["waiting_quota_met"] is None:
+            full["waiting_quota_met"] = False
+        s[tuple(key)] = full
+    return s
+
+class _Model(object):
+    """The state of a replay; see :func:`replay`"""
+
+    def __init__(self, settings, expire_after, retry_window):
+        self.settings = dict((key, dict(row))
+                             for key, row in settings.iteritems())
+        self.expire_after = expire_after
+        self.retry_window = retry_window
+
+        self.counts = dict((key, 0) for key in _count_keys)
+        self.rules = {}
+
+        # ticket_id -> [user_id, user_group, ticket_type, waiting, finalised]
+        self.live = {}
+        self.expiry = []
+        # user_id -> [any, vip]: for the quotas per person
+        self.held = defaultdict(lambda: [0, 0])
+        # (user_id, ticket_type) -> drop attempts until
+        self.satisfied = {}
+        self.synthetic_ids = itertools.count(-1, -1)
+
+        self.result = {"attempts": 0, "bought": 0, "waiting_list": 0,
+                       "released": 0, "dropped_retries": 0,
+                       "rejected": Counter(), "rejected_tickets": 0,
+                       "quota_met": {}, "waiting_quota_met": {},
+                       "peak_waiting_list": 0, "counts": self.counts}
+
+    def _adjust(self, user_group, ticket_type, waiting_list, number):
+        if waiting_list:
+            p = "waiting_{0}_{1}"
+        else:
+            p = "{0}_{1}"
+        for test in tickets._test_keys(user_group, ticket_type):
+            self.counts[p.format(*test)] += number
+
+    def _add(self, ticket_id, user_id, user_group, ticket_type,
+             waiting_list, finalised):
+        self.live[ticket_id] = \
+                [user_id, user_group, ticket_type, waiting_list, finalised]
+        self._adjust(user_group, ticket_type, waiting_list, 1)
+        held = self.held[user_id]
+        held[0] += 1
+        held[1] += ticket_type == "vip"
+
+    def _remove(self, ticket_id):
+        user_id, user_group, ticket_type, waiting_list, finalised = \
+                self.live.pop(ticket_id)
+        self._adjust(user_group, ticket_type, waiting_list, -1)
+        held = self.held[user_id]
+        held[0] -= 1
+        held[1] -= ticket_type == "vip"
+
+    def expire_until(self, when):
+        while self.expiry and self.expiry[0][0] <= when:
+            expires, ticket_id = heapq.heappop(self.expiry)
+            ticket = self.live.get(ticket_id)
+            if ticket is not None and not ticket[4]:
+                self._remove(ticket_id)
+
+    def _quota_met(self, when, user_group, ticket_type, waiting_list, number):
+        rows_quota_met, rows_waiting_quota_met = \
+                tickets._quota_met_rows(self.settings, self.counts,
+                                        user_group, ticket_type,
+                                        waiting_list, number)
+
+        for test in rows_quota_met:
+            self.result["quota_met"].setdefault(test, when)
+        for test in rows_waiting_quota_met:
+            self.result["waiting_quota_met"].setdefault(test, when)
+
+        if rows_quota_met or rows_waiting_quota_met:
+            self.rules = {}
+
+    def _reject(self, reason, number):
+        self.result["rejected"][reason] += 1
+        self.result["rejected_tickets"] += number
+
+    def buy(self, when, attempt):
+        user_id = attempt["user_id"]
+        user_group = attempt["user_group"]
+        ticket_type = attempt["ticket_type"]
+        number = attempt["number"]
+        logged_ids = attempt["ticket_ids"]
+
+        self.result["attempts"] += 1
+
+        retry_key = (user_id, ticket_type)
+        if self.satisfied.get(retry_key, when) > when:
+            self.result["dropped_retries"] += 1
+            return
+
+        key = (user_group, ticket_type)
+        rules = self.rules.get(key)
+        if rules is None:
+            rules = self.rules[key] = \
+                    tickets._compile_rules(self.settings, user_group,
+                                           ticket_type)
+        avail = tickets._evaluate(rules, self.counts)
+
+        held = self.held[user_id]
+        if ticket_type == "vip":
+            held_type = held[1]
+        else:
+            held_type = held[0] - held[1]
+
+        if avail["qpp_any"] is not None and \
+                avail["qpp_any"] < held[0] + number:
+            return self._reject("qpp-any", number)
+        if avail["qpp_type"] is not None and \
+                avail["qpp_type"] < held_type + number:
+            return self._reject("qpp-type", number)
+
+        if avail["mode"] != "available":
+            return self._reject("not-available", number)
+
+        waiting_list = bool(avail["quota_met"])
+        if waiting_list:
+            if avail["waiting_quota_met"]:
+                return self._reject("waiting-quota-met", number)
+            spare = avail["waiting_spare"]
+        else:
+            spare = avail["spare"]
+
+        if spare is not None and spare < number:
+            self._quota_met(when, user_group, ticket_type, waiting_list,
+                            number)
+            return self._reject("insufficient-spare", number)
+        elif spare == number:
+            self._quota_met(when, user_group, ticket_type, waiting_list,
+                            number)
+
+        if logged_ids is not None:
+            expires = when + self.expire_after
+            for ticket_id in logged_ids:
+                self._add(ticket_id, user_id, user_group, ticket_type,
+                          waiting_list, False)
+                heapq.heappush(self.expiry, (expires, ticket_id))
+        else:
+            for i in range(number):
+                self._add(next(self.synthetic_ids), user_id, user_group,
+                          ticket_type, waiting_list, True)
+            self.satisfied[retry_key] = when + self.retry_window
+
+        if waiting_list:
+            self.result["waiting_list"] += number
+            size = self.counts["waiting_all_any"]
+            if size > self.result["peak_waiting_list"]:
+                self.result["peak_waiting_list"] = size
+        else:
+            self.result["bought"] += number
+
+    def finalise(self, when, ticket_ids):
+        for ticket_id in ticket_ids:
+            ticket = self.live.get(ticket_id)
+            if ticket is not None:
+                ticket[4] = True
+
+    def purge(self, when, ticket_id):
+        ticket = self.live.get(ticket_id)
+        if ticket is not None and ticket[4] and not ticket[3]:
+            self._remove(ticket_id)
+
+    def release(self, when, ticket_ids):
+        for ticket_id in ticket_ids:
+            ticket = self.live.get(ticket_id)
+            if ticket is not None and ticket[4] and ticket[3]:
+                user_id, user_group, ticket_type = ticket[:3]
+                self._adjust(user_group, ticket_type, True, -1)
+                self._adjust(user_group, ticket_type, False, 1)
+                ticket[3] = False
+                self.result["released"] += 1
+
+def replay(events, settings, expire_after=timedelta(minutes=10),
+           retry_window=timedelta(minutes=30)):
+    """
+    Rerun `events` (from :func:`parse`) against the settings rows `settings`
+
+    `settings` is as returned by :func:`tickets.settings` (or
+    :func:`make_settings`), and is not modified. Returns a dict with keys:
+
+    * `attempts`, `dropped_retries`: purchase attempts replayed, and those
+      dropped as retries (see the module docstring)
+    * `bought`, `waiting_list`: tickets bought, and added to the waiting list
+    * `rejected`: a :class:`collections.Counter` of failed attempts, by
+      reason; `rejected_tickets`: the number of tickets they wanted
+    * `quota_met`, `waiting_quota_met`: ``(who, what)`` -> the time that
+      quota was met
+    * `peak_waiting_list`: the largest the (all/any) waiting list got
+    * `released`: tickets released from the waiting list
+    * `counts`: the counts at the end, as :func:`tickets.counts`
+    """
+
+    model = _Model(settings, expire_after, retry_window)
+    handlers = {"buy": model.buy, "finalise": model.finalise,
+                "purge": model.purge, "release": model.release}
+
+    for when, kind, data in events:
+        model.expire_until(when)
+        handlers[kind](when, data)
+
+    return model.result
@@ -28,10 +28,12 @@ import flask
 from flask import render_template, session, request, redirect, url_for, abort
 
 from .. import utils, users, tickets
+from . import admission
 
 
 #: the :class:`flask.Blueprint` containing (customer) ticket views
 bp = flask.Blueprint('tickets', __name__)
+bp.before_request(admission.check)
 
 
 @bp.route("/tickets")
@@ -40,12 +42,13 @@ def home():
     # A few of these queries could technically race against each other.
     # As far as I can tell, nothing bad can come of this.
 
+    snapshot = tickets.home_snapshot()
+
     # get availablity, modes - used below in qpp and buttons
-    avail = {}
+    avail = snapshot["available"]
     modes = {}
 
     for t in ('standard', 'vip'):
-        avail[t] = tickets.available(t)
         modes[t] = avail[t]["mode"]
 
         # use pseudo-modes for simplicity
@@ -62,7 +65,7 @@ def home():
     deadline = None
     finalised_tickets = []
 
-    for ticket in tickets.tickets(expired=False):
+    for ticket in snapshot["tickets"]:
         user_counts["any"] += 1
         if not ticket["quota_exempt"]:
             if ticket["vip"]:
@@ -112,10 +115,10 @@ def home():
         enable_buttons[t] = mode_ok and not qpp_reached[t]
 
     return render_template("tickets/home.html",
-            prices=tickets.prices(),
+            prices=snapshot["prices"],
             ticket_modes=modes,
-            mode_sentence=tickets.mode_sentence(),
-            qpp_sentence=tickets.quotas_per_person_sentence(),
+            mode_sentence=snapshot["mode_sentence"],
+            qpp_sentence=snapshot["qpp_sentence"],
             qpp_reached=qpp_reached,
             qpp_max_space=qpp_max_space,
             buy_more=bool(user_counts["any"]),
@@ -125,12 +128,30 @@ def home():
             unfinalised_tickets=user_counts["unfinalised"],
             deadline=deadline,
             payment_reference=tickets.reference(),
-            outstanding_balance=tickets.outstanding_balance())
+            outstanding_balance=snapshot["outstanding_balance"])
 
 @bp.route("/tickets/terms")
 def terms():
     return render_template("tickets/terms.html")
 
+@bp.route("/tickets/queue")
+@utils.requires_session
+def queue():
+    if not admission.enabled():
+        return redirect(url_for(".home"))
+
+    place = admission.position(session["user_id"])
+    if place["admitted"]:
+        return redirect(url_for(".home"))
+
+    # poll more often as the wait shortens
+    if place["wait"] is None:
+        refresh = 60
+    else:
+        refresh = int(min(max(place["wait"] / 4, 5), 60))
+
+    return render_template("tickets/queue.html", refresh=refresh, **place)
+
 @bp.route("/tickets/hide_instructions", methods=["POST"])
 @utils.requires_session
 @utils.requires_ajax
@@ -217,27 +238,38 @@ def details():
     non_expired_ids = set()
     already_finalised_ids = set()
 
+    ticket_forms = []
+    to_finalise = []
+
     for ticket in tickets.tickets(expired=False):
+        form = None
+
         # get changes from form
         if ticket["finalised"] is None:
             form = ticket.copy()
             _ticket_form(form)
 
-            # ... and maybe finalise
             if form["ok"] and request.method == "POST":
-                try:
-                    tickets.finalise(ticket, form["update"])
-                except AlreadyFinalised as e:
-                    # this will set "submitted_finalised"
-                    already_finalised_ids.add(ticket["ticket_id"])
-                    ticket = e.new_ticket
-                    assert ticket["finalised"] is not None
-                except NonExistantTicket:
-                    # thereby skipping "non_expired_ids.add" and setting
-                    # a submitted_expired error
-                    continue
+                to_finalise.append((ticket, form["update"]))
 
-        else:
+        ticket_forms.append((ticket, form))
+
+    # ... and maybe finalise (all at once). Successes modify `ticket`.
+    failed = tickets.finalise_many(to_finalise)
+
+    for ticket, form in ticket_forms:
+        error = failed.get(ticket["ticket_id"])
+
+        if isinstance(error, tickets.AlreadyFinalised):
+            # this will set "submitted_finalised"
+            already_finalised_ids.add(ticket["ticket_id"])
+            ticket = error.new_ticket
+            assert ticket["finalised"] is not None
+        elif isinstance(error, tickets.NonExistantTicket):
+            # thereby skipping "non_expired_ids.add" and setting
+            # a submitted_expired error
+            continue
+        elif form is None:
             already_finalised_ids.add(ticket["ticket_id"])
 
         # for tracking submissions to expired tickets
@@ -544,6 +544,9 @@ def update_user(user_id, pg=utils.postgres, **kwargs):
     return user
 
 def _update_session(user_id, update):
+    # other processes are told by the users trigger, on commit
+    utils.session_cache.drop_user(user_id)
+
     if flask.current_app and flask.session.ok and \
             flask.session["user_id"] == user_id:
         flask.session["user"].update(update)
@@ -21,9 +21,15 @@
 from __future__ import unicode_literals, division
 
 import os
+import re
 import sys
+import time
+import errno
+import fcntl
+import select
 import string
 import base64
+import hashlib
 import datetime
 import logging
 import functools
@@ -34,6 +40,8 @@ import smtplib
 import textwrap
 import traceback
 import threading
+import itertools
+import collections
 
 import flask
 import jinja2
@@ -44,16 +52,27 @@ import werkzeug.exceptions
 import psycopg2
 import psycopg2.extras
 import psycopg2.extensions
+import psycopg2.errorcodes
 import pytz
+import gevent.monkey
+import gevent.socket
 
 
 __all__ = ["LoggerAdaptor", "PostgreSQLHandler", "OptionalKeysFormatter",
            "getLogger",
-           "postgres", "PostgreSQLConnection", "PostgreSQL", "with_savepoint",
+           "postgres", "PostgreSQLCursor", "PostgreSQLRealDictCursor",
+           "PostgreSQLConnection", "gevent_wait_callback",
+           "make_psycopg_green", "Busy", "PoolTimeout", "BudgetExhausted",
+           "connection_budget_regions", "ConnectionBudget",
+           "connection_budget", "budget_connect", "ConnectionPool",
+           "PostgreSQL", "with_savepoint",
+           "PostgreSQLListener", "notifications",
            "SessionInvalid", "SessionExpired", "SessionAbsent",
            "SessionUserDetailsIncomplete", "SessionUserDisabled",
-           "BadSession", "SessionInterface", "SessionInstance",
-           "requires_session",
+           "BadSession", "SessionCache", "session_cache",
+           "SessionInterface", "SessionInstance",
+           "session_free", "requires_session",
+           "purge_sessions", "sessions_table_stats",
            "gen_secret", "customise_jinja",
            "add_history_urls", "sif", "format_datetime",
            "pounds_pence", "plural", "college_name",
@@ -90,27 +109,61 @@ class LoggerAdaptor(logging.LoggerAdapter):
 
     Relevant properties will be None, if there is no request context,
     or the session is bad.
+
+    The context is worked out once per request, once it has been routed,
+    and kept on :data:`flask.g`; :class:`SessionInstance` calls
+    :meth:`forget_context` when the session is loaded, created or
+    destroyed. Calls below the logger's effective level return before doing
+    any of this.
     """
 
+    _keys = ("request_path", "flask_endpoint", "remote_addr",
+             "session_id", "user_id")
+    _no_context = dict.fromkeys(_keys)
+
     def __init__(self, logger):
         super(LoggerAdaptor, self).__init__(logger, None)
 
+    @staticmethod
+    def forget_context():
+        """Discard this request's cached context"""
+        if flask.has_request_context():
+            flask.g.__dict__.pop("_log_context", None)
+
+    def _context(self):
+        if not flask.has_request_context():
+            return self._no_context
+
+        g = flask.g
+        add = getattr(g, "_log_context", None)
+        if add is not None:
+            return add
+
+        request = flask.request
+        add = dict(self._no_context)
+        add["request_path"] = request.path
+        add["flask_endpoint"] = request.endpoint
+        add["remote_addr"] = request.remote_addr
+        # in messages emitted by open_session, flask.session is None;
+        # don't load the session just to log
+        if getattr(flask.session, "loaded", False) and flask.session.ok:
+            add["session_id"] = flask.session["session_id"]
+            add["user_id"] = flask.session["user_id"]
+
+        # Flask >= 1.0 opens the session before routing: until the request
+        # has been matched, its endpoint is not known, so don't keep this
+        if request.url_rule is not None or \
+                request.routing_exception is not None:
+            g._log_context = add
+
+        return add
+
     def process(self, msg, kwargs):
         try:
-            add = {"request_path": None, "flask_endpoint": None,
-                   "remote_addr": None, "session_id": None, "user_id": None}
-
-            if flask.has_request_context():
-                add["request_path"] = flask.request.path
-                add["flask_endpoint"] = flask.request.endpoint
-                add["remote_addr"] = flask.request.remote_addr
-                # in messages emitted by open_session, flask.session is None
-                if getattr(flask.session, "ok", False):
-                    add["session_id"] = flask.session["session_id"]
-                    add["user_id"] = flask.session["user_id"]
+            add = self._context()
 
             extra = kwargs.setdefault("extra", {})
-            for key in add:
+            for key in self._keys:
                 if key not in extra:
                     extra[key] = add[key]
 
@@ -119,6 +172,48 @@ class LoggerAdaptor(logging.LoggerAdapter):
 
         return msg, kwargs
 
+    def _log(self, level, msg, args, kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        msg, kwargs = self.process(msg, kwargs)
+
+        exc_info = kwargs.get("exc_info")
+        if exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+
+        # as Logger._log, but the caller is known: not _log, nor the
+        # debug() (etc.) that called it, but the frame before
+        caller = sys._getframe(2)
+        record = self.logger.makeRecord(self.logger.name, level,
+                                        caller.f_code.co_filename,
+                                        caller.f_lineno, msg, args, exc_info,
+                                        caller.f_code.co_name,
+                                        kwargs.get("extra"))
+        self.logger.handle(record)
+
+    def debug(self, msg, *args, **kwargs):
+        self._log(logging.DEBUG, msg, args, kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self._log(logging.INFO, msg, args, kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self._log(logging.WARNING, msg, args, kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self._log(logging.ERROR, msg, args, kwargs)
+
+    def exception(self, msg, *args, **kwargs):
+        kwargs["exc_info"] = 1
+        self._log(logging.ERROR, msg, args, kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        self._log(logging.CRITICAL, msg, args, kwargs)
+
+    def log(self, level, msg, *args, **kwargs):
+        self._log(level, msg, args, kwargs)
+
 class PostgreSQLHandler(logging.Handler):
     """
     A :class:`logging.Handler` that logs to the `log` PostgreSQL table
@@ -135,73 +230,246 @@ class PostgreSQLHandler(logging.Handler):
         do not appear to block with INSERTs. If possible, touch the log table
         in autocommit mode only.
 
+    If `queued`, :meth:`emit` only appends the record to a queue, and a
+    daemon thread (a greenlet, under gevent's monkey patching) writes them,
+    up to `batch_size` rows per INSERT. If more than `max_queue` records are
+    waiting, new ones are dropped and counted in :attr:`dropped` (a warning
+    saying how many is logged once there is room). :meth:`flush` writes
+    everything queued so far, and is called by :func:`logging.shutdown` at
+    exit. The warning above still applies: the writer's INSERTs wait for
+    the same locks, it is just that the request no longer waits for them.
+
     `db_settings` is passed to :meth:`psycopg2.connect` as kwargs
-    (``connect(**db_settings)``).
+    (``connect(**db_settings)``). The connection counts against the
+    "background" region of the :data:`connection_budget`.
     """
 
-    _query = "INSERT INTO log " \
+    _insert = "INSERT INTO log " \
                 "(created, level, logger, message, function, " \
                 " filename, line_no, traceback, " \
                 " request_path, flask_endpoint, remote_addr, " \
                 " session_id, user_id) " \
-             "VALUES " \
-                "(utcnow(), %(level)s, %(logger)s, " \
-                " %(message)s, %(function)s, %(filename)s, " \
-                " %(line_no)s, %(traceback)s, " \
-                " %(request_path)s, %(flask_endpoint)s, %(remote_addr)s, " \
-                " %(session_id)s, %(user_id)s)"
+              "VALUES "
+    _values = "(%(created)s, %(level)s, %(logger)s, " \
+              " %(message)s, %(function)s, %(filename)s, " \
+              " %(line_no)s, %(traceback)s, " \
+              " %(request_path)s, %(flask_endpoint)s, %(remote_addr)s, " \
+              " %(session_id)s, %(user_id)s)"
+    _query = _insert + _values
 
     # see TYPE log_level
     _levels = ('debug', 'info', 'warning', 'error', 'critical')
 
-    def __init__(self, db_settings):
+    def __init__(self, db_settings, queued=False, max_queue=10000,
+                 batch_size=200):
         super(PostgreSQLHandler, self).__init__()
         self.db_settings = db_settings
         self.connection = None
         self.cursor = None
 
+        self.queued = queued
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        #: records dropped because the queue was full
+        self.dropped = 0
+        self._unreported_drops = 0
+        self._queue = collections.deque()
+        self._queue_cond = threading.Condition(threading.Lock())
+        # one writer at a time: the writer thread, or flush
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._writer_pid = None
+        self._pid = os.getpid()
+
+    def _forget_parent(self):
+        """
+        In a forked child, drop what was inherited from the parent
+
+        The queued rows are the parent's to write. The connection is shared
+        with the parent: it must not be used, nor closed, which would end
+        the parent's session too. The locks may have been held by threads
+        that do not exist in the child, and would never be released.
+        """
+
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self.connection = None
+        self.cursor = None
+        self._unreported_drops = 0
+        self._queue = collections.deque()
+        self._queue_cond = threading.Condition(threading.Lock())
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._writer_pid = None
+
+    def _row(self, record):
+        level = record.levelname.lower()
+        if level not in self._levels:
+            level = "debug"
+
+        if record.exc_info:
+            lines = traceback.format_exception(*record.exc_info)
+            traceback_text = ''.join(lines)
+        else:
+            traceback_text = None
+
+        return {
+            "created": datetime.datetime.utcfromtimestamp(record.created),
+            "level": level,
+            "message": record.getMessage(),
+            "logger": record.name,
+            "function": record.funcName,
+            "filename": record.pathname,
+            "line_no": record.lineno,
+            "traceback": traceback_text,
+            "request_path": getattr(record, "request_path", None),
+            "flask_endpoint": getattr(record, "flask_endpoint", None),
+            "remote_addr": getattr(record, "remote_addr", None),
+            "session_id": getattr(record, "session_id", None),
+            "user_id": getattr(record, "user_id", None)
+        }
+
     def emit(self, record):
         try:
-            level = record.levelname.lower()
-            if level not in self._levels:
-                level = "debug"
+            self._forget_parent()
+            row = self._row(record)
 
-            if record.exc_info:
-                lines = traceback.format_exception(*record.exc_info)
-                traceback_text = ''.join(lines)
+            if self.queued:
+                self._enqueue(row)
             else:
-                traceback_text = None
-
-            args = {
-                "level": level,
-                "message": record.getMessage(),
-                "logger": record.name,
-                "function": record.funcName,
-                "filename": record.pathname,
-                "line_no": record.lineno,
-                "traceback": traceback_text,
-                "request_path": getattr(record, "request_path", None),
-                "flask_endpoint": getattr(record, "flask_endpoint", None),
-                "remote_addr": getattr(record, "remote_addr", None),
-                "session_id": getattr(record, "session_id", None),
-                "user_id": getattr(record, "user_id", None)
-            }
-
-            try:
-                if self.connection is None:
-                    raise psycopg2.OperationalError
+                with self._write_lock:
+                    self._write([row])
 
-                self.cursor.execute(self._query, args)
+        except Exception:
+            self.handleError(record)
 
-            except psycopg2.OperationalError:
-                self.connection = psycopg2.connect(**self.db_settings)
-                self.connection.autocommit = True
-                self.cursor = self.connection.cursor()
+    def _enqueue(self, row):
+        if self._writer_pid != os.getpid():
+            self._start_writer()
 
-                self.cursor.execute(self._query, args)
+        with self._queue_cond:
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                self._unreported_drops += 1
+            else:
+                self._queue.append(row)
+                self._queue_cond.notify()
 
+    def _start_writer(self):
+        with self._queue_cond:
+            # another thread may have got here first
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            self._writer = threading.Thread(target=self._run_writer,
+                                            name="PostgreSQLHandler")
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _take(self):
+        """Take up to `batch_size` rows off the queue"""
+
+        with self._queue_cond:
+            rows = []
+            while self._queue and len(rows) < self.batch_size:
+                rows.append(self._queue.popleft())
+
+            if self._unreported_drops:
+                rows.append(self._drops_row(self._unreported_drops))
+                self._unreported_drops = 0
+
+            return rows
+
+    def _drops_row(self, count):
+        return {
+            "created": datetime.datetime.utcnow(),
+            "level": "warning",
+            "message": "dropped {0} log records: queue full".format(count),
+            "logger": __name__ + ".PostgreSQLHandler",
+            "function": "_take", "filename": __file__.rstrip("co"),
+            "line_no": 0,
+            "traceback": None, "request_path": None, "flask_endpoint": None,
+            "remote_addr": None, "session_id": None, "user_id": None
+        }
+
+    def _run_writer(self):
+        while True:
+            with self._queue_cond:
+                while not self._queue:
+                    self._queue_cond.wait()
+
+            # take rows only with the write lock held, so that flush cannot
+            # return while some are taken but not yet written
+            with self._write_lock:
+                rows = self._take()
+                if rows:
+                    self._write_or_drop(rows)
+
+    def _write_or_drop(self, rows):
+        try:
+            self._write(rows)
         except Exception:
-            self.handleError(record)
+            with self._queue_cond:
+                self.dropped += len(rows)
+            traceback.print_exc()
+
+    def _write(self, rows):
+        """INSERT `rows`, (re)connecting once if necessary"""
+
+        try:
+            if self.connection is None:
+                raise psycopg2.OperationalError
+
+            self._insert_rows(rows)
+
+        except psycopg2.OperationalError:
+            if self.connection is not None:
+                # returns it to the connection budget
+                self.connection.close()
+                self.connection = None
+
+            self.connection = budget_connect(self.db_settings,
+                                             "background")
+            self.connection.autocommit = True
+            self.cursor = self.connection.cursor()
+
+            self._insert_rows(rows)
+
+    def _insert_rows(self, rows):
+        if len(rows) == 1:
+            self.cursor.execute(self._query, rows[0])
+        else:
+            values = [self.cursor.mogrify(self._values, row) for row in rows]
+            query = self._insert.encode("utf8") + b", ".join(values)
+            self.cursor.execute(query)
+
+    def flush(self):
+        """Write all queued records now (in this thread)"""
+        if not self.queued:
+            return
+
+        self._forget_parent()
+
+        with self._write_lock:
+            while True:
+                rows = self._take()
+                if not rows:
+                    break
+                self._write_or_drop(rows)
+
+    def close(self):
+        """Flush, and close the connection"""
+        try:
+            self._forget_parent()
+            self.flush()
+            with self._write_lock:
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+        finally:
+            super(PostgreSQLHandler, self).close()
 
 class OptionalKeysFormatter(logging.Formatter):
     """
@@ -230,6 +498,100 @@ def getLogger(name):
 misc_logger = getLogger(__name__)
 
 
+_placeholder_re = re.compile(r"%(?:\((\w+)\))?s|%%")
+
+class _PreparedCursorMixin(object):
+    """Adds :meth:`execute_prepared` to a cursor class"""
+
+    def execute_prepared(self, query, args=None):
+        """
+        Like :meth:`execute`, but via a server side prepared statement
+
+        `query` is PREPAREd the first time this connection sees it (see
+        :meth:`PostgreSQLConnection.prepare`), and EXECUTEd thereafter.
+        Only use this for queries built from a small, fixed set of strings,
+        whose parameters are simple values (not tuples or lists, which
+        psycopg2 would expand).
+
+        PostgreSQL refuses to run a prepared statement whose result columns
+        have changed since it was prepared (say, a column was added to a
+        table it selects ``*`` from). The statement is then forgotten, and
+        prepared afresh next time; if nothing else had been done in the
+        transaction, that is done immediately (after rolling back), else
+        the error is raised.
+        """
+
+        idle = self.connection.get_transaction_status() == \
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+        try:
+            return self._execute_prepared(query, args)
+        except psycopg2.Error as e:
+            if e.pgcode != psycopg2.errorcodes.FEATURE_NOT_SUPPORTED or \
+                    "cached plan must not change result type" not in e.pgerror:
+                raise
+
+            self.connection.forget_prepared(query)
+            if not idle:
+                raise
+
+        misc_logger.warning("result type of a prepared statement changed; "
+                            "preparing it again")
+        self.connection.rollback()
+        return self._execute_prepared(query, args)
+
+    def _execute_prepared(self, query, args):
+        name, keys = self.connection.prepare(query)
+
+        if not keys:
+            return self.execute("EXECUTE " + name)
+
+        if keys[0] is None:
+            values = list(args)
+        else:
+            values = [args[key] for key in keys]
+        assert len(values) == len(keys)
+
+        placeholders = ", ".join(["%s"] * len(values))
+        return self.execute("EXECUTE " + name + " (" + placeholders + ")",
+                            values)
+
+class _TimedCursorMixin(object):
+    """
+    Reports each execute to the connection's ``query_observer``, if it has
+    one, as ``query_observer(seconds, rows)``
+    """
+
+    def execute(self, query, args=None):
+        observer = self.connection.query_observer
+        if observer is None:
+            return super(_TimedCursorMixin, self).execute(query, args)
+
+        start = time.time()
+        try:
+            return super(_TimedCursorMixin, self).execute(query, args)
+        finally:
+            observer(time.time() - start, max(self.rowcount, 0))
+
+    def executemany(self, query, args_list):
+        observer = self.connection.query_observer
+        if observer is None:
+            return super(_TimedCursorMixin, self).executemany(query, args_list)
+
+        start = time.time()
+        try:
+            return super(_TimedCursorMixin, self).executemany(query, args_list)
+        finally:
+            observer(time.time() - start, max(self.rowcount, 0))
+
+class PostgreSQLCursor(_PreparedCursorMixin, _TimedCursorMixin,
+                       psycopg2.extensions.cursor):
+    """The cursor returned by :meth:`PostgreSQLConnection.cursor`"""
+
+class PostgreSQLRealDictCursor(_PreparedCursorMixin, _TimedCursorMixin,
+                               psycopg2.extras.RealDictCursor):
+    """``PostgreSQLConnection.cursor(real_dict_cursor=True)``"""
+
 class PostgreSQLConnection(psycopg2.extensions.connection):
     """
     A custom `connection_factory` for :func:`psycopg2.connect`.
@@ -237,6 +599,12 @@ class PostgreSQLConnection(psycopg2.extensions.connection):
     This modifies the :meth:`cursor` method of a :class:`psycopg2.connection`,
     facilitating easy acquiring of cursors made from
     :class:`psycopg2.extras.RealDictCursor`.
+
+    Cursors also have an ``execute_prepared`` method; the statements it
+    prepares are remembered by the connection (see :meth:`prepare`).
+
+    If :attr:`query_observer` is set, cursors call
+    ``query_observer(seconds, rows)`` after each execute.
     """
 
     def __init__(self, *args, **kwargs):
@@ -244,6 +612,21 @@ class PostgreSQLConnection(psycopg2.extensions.connection):
         for type in (psycopg2.extensions.UNICODE,
                      psycopg2.extensions.UNICODEARRAY):
             psycopg2.extensions.register_type(type, self)
+        self._prepared = {}
+        self._prepared_names = itertools.count()
+        self._deallocate = []
+        self._budget_release = None
+        self.query_observer = None
+
+    def close(self):
+        """Close the connection, returning it to the :class:`ConnectionBudget`"""
+        try:
+            super(PostgreSQLConnection, self).close()
+        finally:
+            release = self._budget_release
+            self._budget_release = None
+            if release is not None:
+                release()
 
     def cursor(self, real_dict_cursor=False):
         """
@@ -252,10 +635,429 @@ class PostgreSQLConnection(psycopg2.extensions.connection):
         If real_dict_cursor is set, a RealDictCursor is returned
         """
 
-        kwargs = {}
         if real_dict_cursor:
-            kwargs["cursor_factory"] = psycopg2.extras.RealDictCursor
-        return super(PostgreSQLConnection, self).cursor(**kwargs)
+            cursor_factory = PostgreSQLRealDictCursor
+        else:
+            cursor_factory = PostgreSQLCursor
+        return super(PostgreSQLConnection, self) \
+                .cursor(cursor_factory=cursor_factory)
+
+    def prepare(self, query):
+        """
+        PREPARE `query` on this connection, unless it has been already
+
+        `query` uses psycopg2 placeholders: either all ``%s`` or all
+        ``%(name)s``. Returns ``(statement name, keys)``, where `keys`
+        gives the order of the parameters: ``None`` for each ``%s``, or the
+        names. Prepared statements are not transactional, so live as long as
+        the connection does, across :meth:`reset`.
+        """
+
+        try:
+            return self._prepared[query]
+        except KeyError:
+            pass
+
+        if self._deallocate:
+            with super(PostgreSQLConnection, self).cursor() as cur:
+                for name in self._deallocate:
+                    cur.execute("DEALLOCATE " + name)
+            self._deallocate = []
+
+        keys = []
+        def replace(match):
+            if match.group(0) == "%%":
+                return "%"
+            key = match.group(1)
+            if key is not None and key in keys:
+                return "$" + str(keys.index(key) + 1)
+            keys.append(key)
+            return "$" + str(len(keys))
+
+        converted = _placeholder_re.sub(replace, query)
+        if None in keys and len(set(keys)) != 1:
+            raise ValueError("mixed positional and named placeholders")
+
+        name = "snowball_{0}".format(next(self._prepared_names))
+
+        with super(PostgreSQLConnection, self).cursor() as cur:
+            cur.execute("PREPARE " + name + " AS " + converted)
+
+        misc_logger.debug("prepared %s (%s parameters)", name, len(keys))
+        self._prepared[query] = (name, tuple(keys))
+        return self._prepared[query]
+
+    def forget_prepared(self, query):
+        """
+        Stop using the statement :meth:`prepare` made for `query`
+
+        It is DEALLOCATEd before the next statement is prepared (not now, as
+        the transaction may have failed).
+        """
+
+        name, keys = self._prepared.pop(query)
+        self._deallocate.append(name)
+
+def gevent_wait_callback(conn, timeout=None):
+    """A :func:`psycopg2.extensions.set_wait_callback` callback for gevent"""
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            gevent.socket.wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            gevent.socket.wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError("bad poll state: %r" % state)
+
+def make_psycopg_green():
+    """
+    Make psycopg2 yield to other greenlets while it waits for the server
+
+    Without this, a query (or a wait for a lock, like :func:`tickets.buy`'s)
+    blocks every greenlet in the process. Does nothing unless gevent has
+    monkey patched :mod:`socket` (as gunicorn's gevent workers do), since
+    without patching there are no other greenlets to yield to.
+
+    Each connection must then only be used by one greenlet at a time.
+    """
+
+    if gevent.monkey.is_module_patched("socket"):
+        psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+
+class Busy(werkzeug.exceptions.ServiceUnavailable):
+    """
+    Too busy to take on this request: shed rather than queued
+
+    Responds 503 Service Unavailable, with a ``Retry-After`` header.
+    """
+
+    description = "The server is very busy. Please try again in a moment."
+    retry_after = 5
+
+    def get_headers(self, *args, **kwargs):
+        headers = super(Busy, self).get_headers(*args, **kwargs)
+        headers.append((b"Retry-After", str(self.retry_after)))
+        return headers
+
+class PoolTimeout(Busy):
+    """No database connection became free in time (see :class:`ConnectionPool`)"""
+
+class BudgetExhausted(Busy):
+    """
+    No database connection may be opened: the :class:`ConnectionBudget`
+    is all in use
+    """
+
+#: How the :data:`connection_budget` is divided. Ideally these total rather
+#: less than the server's ``max_connections`` (100 by default; a few are
+#: reserved for superusers): "shared" may be borrowed by anyone.
+connection_budget_regions = (("ticketing", 46), ("admin", 4),
+                             ("scripts", 6), ("background", 24),
+                             ("shared", 10))
+
+class ConnectionBudget(object):
+    """
+    Limits the database connections open at once across processes
+
+    The budget is a file of one (notional) byte per connection, divided
+    into named `regions` (a sequence of ``(name, size)``). A process opening
+    a connection takes an exclusive, non-blocking ``lockf`` lock on a byte
+    of its region, or failing that of the `shared` region, and unlocks it
+    when the connection is closed. Should a process die the kernel releases
+    its locks, so the budget cannot leak. All processes must use the same
+    file and the same `regions`.
+    """
+
+    def __init__(self, path, regions, shared="shared"):
+        self.path = path
+        self.shared = shared
+        self.regions = {}
+        start = 0
+        for name, size in regions:
+            self.regions[name] = (start, size)
+            start += size
+        self.size = start
+
+        self._fd = None
+        self._pid = None
+        # lockf locks are per process, so we must not lock a byte twice
+        self._held = set()
+        self._lock = threading.Lock()
+        self.logger = getLogger(__name__ + ".ConnectionBudget")
+
+    def _file(self):
+        # locks are not inherited across fork: start afresh in a child
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._pid = os.getpid()
+            self._held = set()
+        return self._fd
+
+    def acquire(self, region):
+        """
+        Take a byte of `region`, or of the shared region
+
+        Returns the byte (for :meth:`release`), or ``None`` if none are free.
+        """
+
+        ranges = [self.regions[region]]
+        if region != self.shared:
+            ranges.append(self.regions[self.shared])
+
+        with self._lock:
+            fd = self._file()
+            for start, size in ranges:
+                for slot in xrange(start, start + size):
+                    if slot in self._held:
+                        continue
+                    try:
+                        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                    except IOError as e:
+                        if e.errno in (errno.EACCES, errno.EAGAIN):
+                            continue
+                        raise
+                    self._held.add(slot)
+                    return slot
+
+        return None
+
+    def release(self, slot):
+        """Release a byte taken by :meth:`acquire`"""
+        with self._lock:
+            if self._pid != os.getpid() or slot not in self._held:
+                return
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, slot)
+            self._held.discard(slot)
+
+    def connect(self, region, **db_settings):
+        """
+        Connect (a :class:`PostgreSQLConnection`) within `region`
+
+        Raises :exc:`BudgetExhausted` if the region and the shared region
+        are used up. Closing the connection returns its byte.
+        """
+
+        slot = self.acquire(region)
+        if slot is None:
+            self.logger.warning("connection budget exhausted (%s)", region)
+            raise BudgetExhausted
+
+        try:
+            c = psycopg2.connect(connection_factory=PostgreSQLConnection,
+                                 **db_settings)
+        except:
+            self.release(slot)
+            raise
+
+        c._budget_release = functools.partial(self.release, slot)
+        return c
+
+    def held(self):
+        """How many bytes this process holds"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return 0
+            return len(self._held)
+
+def _connection_budget():
+    path = os.environ.get("SNOWBALL_CONNECTION_BUDGET")
+    if path:
+        return ConnectionBudget(path, connection_budget_regions)
+    else:
+        return None
+
+#: The :class:`ConnectionBudget` shared by the processes on this host,
+#: if the ``SNOWBALL_CONNECTION_BUDGET`` environment variable names its file
+#: (otherwise ``None``: connections are not limited)
+connection_budget = _connection_budget()
+
+def budget_connect(db_settings, region):
+    """
+    Connect (a :class:`PostgreSQLConnection`) within :data:`connection_budget`
+
+    `db_settings` is passed to :meth:`psycopg2.connect` as kwargs; `region`
+    is one of :data:`connection_budget_regions`. Raises
+    :exc:`BudgetExhausted`.
+    """
+
+    if connection_budget is None:
+        return psycopg2.connect(connection_factory=PostgreSQLConnection,
+                                **db_settings)
+    else:
+        return connection_budget.connect(region, **db_settings)
+
+class ConnectionPool(object):
+    """
+    A bounded pool of database connections, shared by a process's requests
+
+    At most `max_size` connections are open (or opening) at once. When
+    none is free, :meth:`get` waits in line (first come, first served) for
+    up to `timeout` seconds, then raises :exc:`PoolTimeout`. Under gevent's
+    monkey patching the waiting is done by greenlets.
+
+    Up to `max_idle` returned connections are kept for reuse. Those that
+    have sat idle for more than `check_after` seconds are tested (with
+    ``SELECT 1``) before being handed out, and only a connection that fails
+    is thrown away. Connections older than `max_lifetime` seconds are
+    closed when returned.
+
+    `connect` is called with no arguments to create a connection.
+    """
+
+    # handed to a waiter in place of a connection: "you may open one"
+    _slot = object()
+
+    def __init__(self, connect, max_size=10, max_idle=2, timeout=5,
+                 max_lifetime=3600, check_after=30):
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+
+        # (connection, idle since); the most recently returned last
+        self._idle = []
+        # [event, what was handed over]
+        self._waiters = collections.deque()
+        # connections open, or being opened
+        self._size = 0
+        self._created = 0
+        self._timeouts = 0
+        self._lock = threading.Lock()
+        self.logger = getLogger(__name__ + ".ConnectionPool")
+
+    def get(self):
+        """Get a connection, waiting for one if the pool is at `max_size`"""
+
+        while True:
+            waiter = None
+
+            with self._lock:
+                if self._idle:
+                    got = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    got = self._slot
+                else:
+                    waiter = [threading.Event(), None]
+                    self._waiters.append(waiter)
+
+            if waiter is not None:
+                self.logger.debug("waiting for a connection")
+                waiter[0].wait(self.timeout)
+
+                with self._lock:
+                    got = waiter[1]
+                    if got is None:
+                        self._waiters.remove(waiter)
+                        self._timeouts += 1
+
+                if got is None:
+                    self.logger.warning("timed out waiting for a connection")
+                    raise PoolTimeout
+
+            if got is self._slot:
+                return self._open()
+
+            c, idle_since = got
+            if self._healthy(c, idle_since):
+                return c
+
+            self._discard(c)
+
+    def _open(self):
+        # we hold a slot (counted in _size)
+        try:
+            c = self.connect()
+        except Exception:
+            self._discard(None)
+            raise
+
+        c._pool_created = time.time()
+        with self._lock:
+            self._created += 1
+        return c
+
+    def _healthy(self, c, idle_since):
+        if c.closed:
+            return False
+        if time.time() - idle_since < self.check_after:
+            return True
+
+        try:
+            with c.cursor() as cur:
+                cur.execute("SELECT 1")
+            c.rollback()
+        except psycopg2.Error:
+            self.logger.debug("idle connection failed check", exc_info=True)
+            return False
+        else:
+            return True
+
+    def _discard(self, c):
+        """Close `c` (if not ``None``) and give up its slot"""
+
+        if c is not None:
+            try:
+                c.close()
+            except psycopg2.Error:
+                pass
+
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter[1] = self._slot
+                waiter[0].set()
+            else:
+                self._size -= 1
+
+    def put(self, c):
+        """Return a connection got from :meth:`get`"""
+
+        try:
+            # ends the transaction, and resets any session settings
+            c.reset()
+        except psycopg2.Error:
+            self.logger.debug("reset failed", exc_info=True)
+            self._discard(c)
+            return
+
+        if time.time() - c._pool_created > self.max_lifetime:
+            self.logger.debug("closing connection: max lifetime")
+            self._discard(c)
+            return
+
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter[1] = (c, time.time())
+                waiter[0].set()
+                return
+            elif len(self._idle) < self.max_idle:
+                self._idle.append((c, time.time()))
+                return
+            else:
+                self._size -= 1
+
+        self.logger.debug("closing connection: max idle")
+        c.close()
+
+    def stats(self):
+        """
+        Returns a dict: connections ``in_use``, ``idle``; greenlets
+        ``waiting``; connections ``created`` and waits ``timed_out`` ever
+        """
+
+        with self._lock:
+            return {"in_use": self._size - len(self._idle),
+                    "idle": len(self._idle),
+                    "waiting": len(self._waiters),
+                    "created": self._created,
+                    "timed_out": self._timeouts,
+                    "max_size": self.max_size}
 
 class PostgreSQL(object):
     """
@@ -272,16 +1074,29 @@ class PostgreSQL(object):
     directly.
 
     Connections are created by ``psycopg2.connect(**app.config["POSTGRES"])``
-    (e.g., ``app.config["POSTGRES"] = {"database": "mydb"}``),
-    are pooled (you can adjust the pool size with `pool`) and are tested for
-    server shutdown before being given to the request.
+    (e.g., ``app.config["POSTGRES"] = {"database": "mydb"}``) and are
+    pooled by a :class:`ConnectionPool`: at most `max_connections` per
+    process, keeping up to `pool_size` idle. A request that waits more than
+    `timeout` seconds for one fails with :exc:`PoolTimeout`.
+
+    Connections count against the `budget_region` of the
+    :data:`connection_budget`; when that is used up, requests fail
+    immediately with :exc:`BudgetExhausted`.
+
+    While a request holds a connection, its
+    :attr:`PostgreSQLConnection.query_observer` is :attr:`query_observer`
+    (see :mod:`snowball_ticketing.metrics`).
     """
 
-    def __init__(self, app=None, pool_size=2):
+    def __init__(self, app=None, pool_size=2, max_connections=10, timeout=5,
+                 max_lifetime=3600, budget_region="ticketing"):
         self.app = app
-        self._pool = []
-        self.pool_size = pool_size
-        self._lock = threading.RLock()
+        self.budget_region = budget_region
+        self.query_observer = None
+        self.pool = ConnectionPool(self._new_connection,
+                                   max_size=max_connections,
+                                   max_idle=pool_size, timeout=timeout,
+                                   max_lifetime=max_lifetime)
         self.logger = getLogger(__name__ + ".PostgreSQL")
 
         if app is not None:
@@ -293,55 +1108,31 @@ class PostgreSQL(object):
 
         * Hook: ``app.after_request(self.commit)``
         * Hook: ``app.teardown_appcontext(self.teardown)``
+        * Hook: ``app.before_first_request``, which starts
+          :data:`notifications` listening
+
+        Also calls :func:`make_psycopg_green`.
         """
 
+        make_psycopg_green()
         app.after_request(self.commit)
         app.teardown_appcontext(self.teardown)
+        app.before_first_request(self._start_notifications)
         app.snowball_postgresql = self
 
-    def _connect(self):
-        """Returns a connection to the database"""
-
-        with self._lock:
-            c = None
-
-            if len(self._pool):
-                c = self._pool.pop()
-                try:
-                    # This tests if the connection is still alive.
-                    c.reset()
-                except psycopg2.OperationalError:
-                    self.logger.debug("assuming pool dead", exc_info=True)
-
-                    # assume that the entire pool is dead
-                    try:
-                        c.close()
-                    except psycopg2.OperationalError:
-                        pass
-
-                    for c in self._pool:
-                        try:
-                            c.close()
-                        except psycopg2.OperationalError:
-                            pass
-
-                    self._pool = []
-                    c = None
-                else:
-                    self.logger.debug("got connection from pool")
-
-            if c is None:
-                c = self._new_connection()
+    def _start_notifications(self):
+        notifications.start(flask.current_app.config["POSTGRES"])
 
-        return c
+    def _connect(self):
+        """Returns a connection to the database, from the pool"""
+        return self.pool.get()
 
     def _new_connection(self):
         """Create a new connection to the database"""
         s = flask.current_app.config["POSTGRES"]
         summary = ' '.join(k + "=" + v for k, v in s.iteritems())
         self.logger.debug("connecting (%s)", summary)
-        c = psycopg2.connect(connection_factory=PostgreSQLConnection, **s)
-        return c
+        return budget_connect(s, self.budget_region)
 
     @property
     def connection(self):
@@ -357,7 +1148,9 @@ class PostgreSQL(object):
 
         g = flask.g
         if not hasattr(g, '_postgresql'):
-            g._postgresql = self._connect()
+            c = self._connect()
+            c.query_observer = self.query_observer
+            g._postgresql = c
         return g._postgresql
 
     def cursor(self, real_dict_cursor=False):
@@ -374,6 +1167,29 @@ class PostgreSQL(object):
 
         return self.connection.cursor(real_dict_cursor)
 
+    @contextlib.contextmanager
+    def separate_transaction(self):
+        """
+        A connection other than this request's, for changes that must be
+        committed whatever becomes of the request's transaction
+
+        Yields a connection from the pool, which is committed at the end of
+        the block (or rolled back, if it raises) and then returned.
+        """
+
+        c = self._connect()
+        c.query_observer = self.query_observer
+        try:
+            yield c
+        except:
+            c.rollback()
+            raise
+        else:
+            c.commit()
+        finally:
+            c.query_observer = None
+            self.pool.put(c)
+
     def commit(self, response=None):
         """
         (Almost an) alias for self.connection.commit()
@@ -391,22 +1207,117 @@ class PostgreSQL(object):
         return response
 
     def teardown(self, exception):
-        """Either return the connection to the pool or close it"""
+        """Return the connection to the pool"""
         g = flask.g
         if hasattr(g, '_postgresql'):
             c = g._postgresql
             del g._postgresql
+            c.query_observer = None
+            self.pool.put(c)
 
-            with self._lock:
-                s = len(self._pool)
-                if s >= self.pool_size:
-                    self.logger.debug("teardown: pool size %i - closing", s)
-                    c.close()
+class PostgreSQLListener(object):
+    """
+    LISTENs for PostgreSQL notifications on a dedicated connection
+
+    A daemon thread (a greenlet, under gevent's monkey patching) holds its
+    own autocommit connection and calls ``callback(payload)`` for each
+    notification on a channel subscribed to with :meth:`subscribe`.
+
+    Notifications may be missed while the connection is down, so every
+    callback is also called with ``None`` whenever the connection is made or
+    lost; this should be taken to mean "invalidate everything".
+    :attr:`listening` is only true while notifications are being received:
+    anything caching on the strength of notifications should bypass its cache
+    when it is false.
+
+    `db_settings` (given to :meth:`start`) is passed to
+    :meth:`psycopg2.connect` as kwargs. The connection counts against the
+    "background" region of the :data:`connection_budget`.
+    """
+
+    def __init__(self, check_interval=60, retry_interval=5):
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.listening = False
+        self._callbacks = {}
+        self._thread = None
+        self._lock = threading.Lock()
+        self.logger = getLogger(__name__ + ".PostgreSQLListener")
+
+    def subscribe(self, channel, callback):
+        """Call ``callback(payload)`` on notifications to `channel`"""
+        with self._lock:
+            if self._thread is not None:
+                raise RuntimeError("subscribe after start")
+            self._callbacks.setdefault(channel, []).append(callback)
+
+    def start(self, db_settings):
+        """Start listening, unless already started or nothing subscribed"""
+        with self._lock:
+            if self._thread is not None or not self._callbacks:
+                return
+
+            self.db_settings = db_settings
+            self._thread = threading.Thread(target=self._run,
+                                            name="PostgreSQLListener")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                self.logger.warning("listen connection failed", exc_info=True)
+
+            self._set_listening(False)
+            time.sleep(self.retry_interval)
+
+    def _listen(self):
+        conn = budget_connect(self.db_settings, "background")
+
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            for channel in self._callbacks:
+                cur.execute("LISTEN " + channel)
+
+            self._set_listening(True)
+            self.logger.debug("listening on %s", ', '.join(self._callbacks))
+
+            while True:
+                readable, _, _ = \
+                        select.select([conn], [], [], self.check_interval)
+                if readable:
+                    conn.poll()
                 else:
-                    self.logger.debug("teardown: adding to pool, new size %i",
-                                      s + 1)
-                    c.reset()
-                    self._pool.append(c)
+                    # checks the connection is still alive
+                    cur.execute("SELECT 1")
+
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    self._dispatch(notify.channel, notify.payload)
+        finally:
+            conn.close()
+
+    def _set_listening(self, value):
+        self.listening = value
+        for callbacks in self._callbacks.values():
+            for callback in callbacks:
+                self._call(callback, None)
+
+    def _dispatch(self, channel, payload):
+        for callback in self._callbacks.get(channel, ()):
+            self._call(callback, payload)
+
+    def _call(self, callback, payload):
+        try:
+            callback(payload)
+        except Exception:
+            self.logger.exception("notification callback failed")
+
+#: the process-wide :class:`PostgreSQLListener`, started by :class:`PostgreSQL`
+notifications = PostgreSQLListener()
 
 @contextlib.contextmanager
 def with_savepoint(name, pg=postgres):
@@ -492,6 +1403,132 @@ class BadSession(object):
         """Raises :attr:`self.reason`"""
         raise self.reason
 
+class SessionCache(object):
+    """
+    A bounded, per-process cache of loaded sessions (with their users)
+
+    Entries are keyed by session_id and a hash of the secret, and live for
+    the app's ``SESSION_CACHE_TTL`` seconds (default 0: no caching); beyond
+    `max_size` entries, the least recently used are evicted.
+
+    Triggers on the `users` and `sessions` tables NOTIFY ``sessions`` when a
+    user changes or a session is destroyed (see :meth:`notified`), so
+    :class:`SessionInstance` only uses the cache while :data:`notifications`
+    is listening. This process's own changes are dropped straight away by
+    :meth:`drop_session` and :meth:`drop_user`.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._users = {}
+        self._lock = threading.Lock()
+        self.logger = getLogger(__name__ + ".SessionCache")
+
+    @staticmethod
+    def key(session_id, secret):
+        """The key for a session cookie"""
+        return session_id, hashlib.sha256(secret.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _copy(session):
+        session = dict(session)
+        session["user"] = dict(session["user"])
+        return session
+
+    def get(self, key):
+        """Get a copy of the session cached under `key`, or ``None``"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                self._forget(key, entry)
+                return None
+            self._entries[key] = entry
+
+        return self._copy(entry[0])
+
+    def put(self, key, session, ttl, generation):
+        """
+        Cache `session` under `key` for `ttl` seconds
+
+        `generation` is :attr:`generation` as it was before `session` was
+        loaded: if anything has been invalidated since, `session` may be out
+        of date and is not cached.
+        """
+
+        entry = (self._copy(session), time.time() + ttl)
+        user_id = session["user_id"]
+
+        with self._lock:
+            if generation != self.generation:
+                return
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+
+            self._entries[key] = entry
+            self._users.setdefault(user_id, set()).add(key)
+
+            while len(self._entries) > self.max_size:
+                self._forget(*self._entries.popitem(last=False))
+
+    def _forget(self, key, entry):
+        # with _lock held, and `key` already removed from _entries
+        keys = self._users.get(entry[0]["user_id"])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._users[entry[0]["user_id"]]
+
+    def drop_session(self, session_id):
+        """Drop `session_id` from the cache"""
+        with self._lock:
+            self.generation += 1
+            for key in [k for k in self._entries if k[0] == session_id]:
+                self._forget(key, self._entries.pop(key))
+
+    def drop_user(self, user_id):
+        """Drop all of `user_id`'s sessions from the cache"""
+        with self._lock:
+            self.generation += 1
+            for key in self._users.pop(user_id, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop everything"""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._users.clear()
+
+    def notified(self, payload):
+        """
+        Notification callback: `payload` is ``user <user_id>``,
+        ``session <session_id>``, or ``None`` (drop everything)
+        """
+
+        self.logger.debug("sessions notification %s", payload)
+
+        if payload is None:
+            self.clear()
+            return
+
+        what, _, which = payload.partition(" ")
+        if what == "user":
+            self.drop_user(int(which))
+        elif what == "session":
+            self.drop_session(int(which))
+        else:
+            self.clear()
+
+#: the process-wide :class:`SessionCache`
+session_cache = SessionCache()
+notifications.subscribe("sessions", session_cache.notified)
+
 class SessionInterface(flask.sessions.SessionInterface):
     """
     Thin interface that just spawns :class:`SessionInstace` objects`
@@ -501,12 +1538,13 @@ class SessionInterface(flask.sessions.SessionInterface):
     simply spawns :class:`SessionInstance` objects, which contain the main
     logic.
 
-    `pg` should be a :class:`PostgreSQL`.
+    `pg` should be a :class:`PostgreSQL`, and `cache` a :class:`SessionCache`.
     """
 
-    def __init__(self, pg=postgres):
+    def __init__(self, pg=postgres, cache=session_cache):
         super(SessionInterface, self).__init__()
         self.postgres = pg
+        self.cache = cache
         self.logger = getLogger(__name__ + ".session")
 
     def open_session(self, app, request):
@@ -554,14 +1592,22 @@ class SessionInstance(object):
     session has been loaded. In addition, it has methods on it that will
     create or remove rows.
 
-    It will attempt to load a session (by checking a request cookie) 
-    when instantiated by the :class:`SessionInterface` at the beginning of
-    every request. The :class:`SessionInterface` also calls :meth:`set_cookies`
-    at the end of each request.
+    It will attempt to load a session (by checking a request cookie) the
+    first time it is used in a request, so requests that never look at
+    :data:`flask.session` never query the `sessions` table; views decorated
+    with :func:`session_free` never load it at all. The
+    :class:`SessionInterface` also sets or deletes the cookie at the end of
+    each request, if the session was modified.
 
     Browser cookies are set to expire at the end of the session
     (_permanent is not implemented), and we refuse to load sessions if the
     `last` column in the `sessions` table is before now - 1 day.
+
+    To save a write on every request, `last` is only updated once it is
+    older than the app's ``SESSION_LAST_GRANULARITY`` (seconds, default 0).
+    A session may therefore expire up to that long before a full day of
+    inactivity, but never after. Sessions may also be served from the
+    :class:`SessionCache`, until `last` needs updating.
     """
 
     def __init__(self, session_interface, app, request):
@@ -570,8 +1616,26 @@ class SessionInstance(object):
         self._session = None
 
         self.postgres = session_interface.postgres
+        self.cache = session_interface.cache
         self.logger = session_interface.logger
-        self._load(app, request)
+        self._app = app
+        self._request = request
+
+    @property
+    def loaded(self):
+        """:class:`bool`: has the session been loaded (yet)?"""
+        return self._session is not None
+
+    def _get(self):
+        """Load the session, if that has not been done yet"""
+        if self._session is None:
+            view = self._app.view_functions.get(self._request.endpoint)
+            if getattr(view, "session_free", False):
+                self._session = BadSession(SessionAbsent)
+            else:
+                self._load(self._app, self._request)
+            LoggerAdaptor.forget_context()
+        return self._session
 
     def create(self, user):
         """
@@ -599,6 +1663,7 @@ class SessionInstance(object):
             self._session = cur.fetchone()
 
         self._session["user"] = user
+        LoggerAdaptor.forget_context()
         self.logger.info("Created session session_id=%s user_id=%s",
                          self._session["session_id"], user["user_id"])
 
@@ -611,8 +1676,8 @@ class SessionInstance(object):
         Loads the session from the database, or stores a BadSession object
         in its place to note that the loading failed.
 
-        Note: the act of loading the session includes updating the expires
-        column!
+        Note: the act of loading the session includes updating the `last`
+        column (if it is older than ``SESSION_LAST_GRANULARITY``)!
         """
 
         assert self._session is None
@@ -635,20 +1700,47 @@ class SessionInstance(object):
             self.logger.warning("Invalid session cookie: %s", reason)
             return
 
-        query1 = "SELECT *, " \
-                    "last + '1 day'::interval < utcnow() AS expired " \
-                 "FROM sessions " \
-                 "WHERE session_id = %s AND secret = %s AND NOT destroyed"
-        query2 = "UPDATE sessions " \
-                 "SET last = utcnow() " \
-                 "WHERE session_id = %s " \
-                 "RETURNING last"
-        # easier to not use a JOIN in query1 to simplify getting the user
-        # object with the DictCursor
-        query3 = "SELECT * FROM users WHERE user_id = %s"
+        granularity = datetime.timedelta(
+                seconds=app.config.get("SESSION_LAST_GRANULARITY", 0))
+        ttl = app.config.get("SESSION_CACHE_TTL", 0)
+        use_cache = ttl and notifications.listening
+        key = self.cache.key(session_id, secret)
+
+        if use_cache:
+            session = self.cache.get(key)
+            # if `last` needs touching, go to the database
+            if session is not None and \
+                    session["last"] + granularity > datetime.datetime.utcnow():
+                self.logger.debug("Session cached session_id=%s user_id=%s",
+                                  session_id, session["user_id"])
+                self._session = session
+                return
 
-        with self.postgres.cursor(True) as cur:
-            cur.execute(query1, (session_id, secret))
+        generation = self.cache.generation
+
+        # validates the session, touches `last` (if it is stale and the
+        # session has not expired) and fetches the user in one go. The
+        # sessions columns come before `touched`, and the users columns
+        # after it.
+        query = "WITH s AS ( " \
+                    "SELECT *, " \
+                        "last + '1 day'::interval < utcnow() AS expired, " \
+                        "last + %s::interval <= utcnow() AS stale " \
+                    "FROM sessions " \
+                    "WHERE session_id = %s AND secret = %s AND NOT destroyed" \
+                "), touched AS ( " \
+                    "UPDATE sessions SET last = utcnow() " \
+                    "FROM s " \
+                    "WHERE sessions.session_id = s.session_id AND " \
+                          "s.stale AND NOT s.expired " \
+                    "RETURNING sessions.last " \
+                ") " \
+                "SELECT s.*, touched.last AS touched, users.* " \
+                "FROM s JOIN users USING (user_id) " \
+                     "LEFT OUTER JOIN touched ON TRUE"
+
+        with self.postgres.cursor() as cur:
+            cur.execute_prepared(query, (granularity, session_id, secret))
             if cur.rowcount != 1:
                 self.logger.warning("bad session_id, bad secret or session "
                                     "destroyed (session %s)", session_id)
@@ -656,21 +1748,25 @@ class SessionInstance(object):
                 self.modified = True
                 return
 
-            session = cur.fetchone()
+            row = cur.fetchone()
+            names = [column[0] for column in cur.description]
 
-            if session["expired"]:
-                self.logger.warning("Session expired session_id=%s user_id=%s",
-                                    session_id, session["user_id"])
-                self._session = BadSession(SessionExpired)
-                self.modified = True
-                return
+        split = names.index("touched")
+        session = dict(zip(names[:split], row[:split]))
+        session["user"] = dict(zip(names[split + 1:], row[split + 1:]))
 
-            cur.execute(query2, (session_id, ))
-            session.update(cur.fetchone())
+        if session["expired"]:
+            self.logger.warning("Session expired session_id=%s user_id=%s",
+                                session_id, session["user_id"])
+            self._session = BadSession(SessionExpired)
+            self.modified = True
+            return
 
-            cur.execute(query3, (session["user_id"], ))
-            assert cur.rowcount == 1
-            session["user"] = cur.fetchone()
+        if row[split] is not None:
+            session["last"] = row[split]
+
+        if use_cache:
+            self.cache.put(key, session, ttl, generation)
 
         self.logger.debug("Session loaded session_id=%s user_id=%s",
                           session_id, session["user_id"])
@@ -688,7 +1784,9 @@ class SessionInstance(object):
             cur.execute(query, (self["session_id"], ))
             assert cur.rowcount == 1
 
+        self.cache.drop_session(self["session_id"])
         self._session = BadSession(SessionAbsent)
+        LoggerAdaptor.forget_context()
         self.modified = True
 
     @property
@@ -698,7 +1796,7 @@ class SessionInstance(object):
 
         Does not check `details_complete`; see :meth:`require`.
         """
-        s = self._session
+        s = self._get()
         assert isinstance(s, BadSession) or isinstance(s, dict)
         return not isinstance(s, BadSession)
 
@@ -721,7 +1819,7 @@ class SessionInstance(object):
         :exc:`SessionExpired`, :exc:`SessionUserDetailsIncomplete`,
         :exc:`SessionUserDisabled`, as appropriate.
         """
-        s = self._session
+        s = self._get()
         if isinstance(s, BadSession):
             self.logger.warning("rejecting: session required")
             raise s.reason
@@ -738,7 +1836,18 @@ class SessionInstance(object):
 
     def __getitem__(self, key):
         """Proxy to self._session[key]"""
-        return self._session[key]
+        return self._get()[key]
+
+def session_free(function):
+    """
+    Mark a view as never needing the session
+
+    :data:`flask.session` will then behave as if there were no session
+    cookie, without looking at the cookie or the database (and the cookie
+    is left as it is).
+    """
+    function.session_free = True
+    return function
 
 def requires_session(function):
     """Function decorator that calls `flask.session.require` first"""
@@ -751,6 +1860,48 @@ def requires_session(function):
     return wrapper
 
 
+def purge_sessions(batch_size=1000, pg=postgres):
+    """
+    Delete up to `batch_size` sessions that are destroyed or have expired
+
+    Returns the number deleted. Neither can be loaded again (nor be in any
+    :class:`SessionCache`), and the log table keeps its own copy of
+    session_id and user_id.
+    """
+
+    query = "DELETE FROM sessions WHERE session_id IN ( " \
+                "SELECT session_id FROM sessions " \
+                "WHERE destroyed OR last + '1 day'::interval < utcnow() " \
+                "ORDER BY session_id LIMIT %s)"
+
+    with pg.cursor() as cur:
+        cur.execute(query, (batch_size, ))
+        purged = cur.rowcount
+
+    if purged:
+        misc_logger.debug("purged %s sessions", purged)
+
+    return purged
+
+def sessions_table_stats(pg=postgres):
+    """
+    Measure the sessions table
+
+    Returns a dict with keys ``live``, ``dead`` (dead tuples, according to
+    the statistics collector, which lags a little), ``table_bytes`` and
+    ``total_bytes`` (including indexes and TOAST).
+    """
+
+    query = "SELECT (SELECT count(*) FROM sessions) AS live, " \
+                   "n_dead_tup AS dead, " \
+                   "pg_relation_size('sessions') AS table_bytes, " \
+                   "pg_total_relation_size('sessions') AS total_bytes " \
+            "FROM pg_stat_user_tables WHERE relname = 'sessions'"
+
+    with pg.cursor(True) as cur:
+        cur.execute(query)
+        return cur.fetchone()
+
 def gen_secret():
     """Returns a randomly generated string"""
     return base64.b64encode(os.urandom(15)).translate(b64_trans)